@@ -0,0 +1,174 @@
+#! /usr/local/bin/python
+# -*- Mode: Python; tab-width: 4 -*-
+
+# Run one of the parsers over a lot of files, using a pool of worker
+# processes.  Each worker maps its file into memory rather than reading
+# it, and hands back a plain value; the results come back as
+# batch_result records (filename, value, error), either in the order
+# the files were given or as they're finished.  A file that won't
+# parse gets its error recorded, and the batch carries on.
+#
+# $ python batch.py -j 8 gif-metadata ~/archive/gifs
+# $ python batch.py pgp-packets pgp/pubring.pgp
+
+import os
+import sys
+import mmap
+import string
+import multiprocessing
+
+import npstruct
+import gif
+import pgpformat
+
+batch_result = npstruct.make_record_class (
+    'Batch Result',
+    ('filename',
+     'value',                   # None if there was an error
+     'error')                   # None if there wasn't
+    )
+
+# ---------------------------------------------------------------------------
+# jobs
+# ---------------------------------------------------------------------------
+# each takes the (mapped) contents of a file, and returns something
+# that can be pickled back to the parent process.
+
+def gif_metadata (data):
+    return gif.scan_metadata_data (data).as_dict()
+
+def gif_frames (data):
+    # mmap objects have a file-like read()
+    index = gif.build_frame_index (data)
+    return map (lambda frame: frame.as_dict(), index.frames)
+
+def pgp_packets (data):
+    # (offset, description, length) for each packet
+    packets = []
+    for type, pos, header, length, result in pgpformat.iter_packets (data):
+        packets.append ((pos, pgpformat.ctb_type_table[type][0], header + length))
+    return packets
+
+# job name -> (function, extensions to look for in directories)
+jobs = {
+    'gif-metadata' : (gif_metadata, ('.gif',)),
+    'gif-frames'   : (gif_frames,   ('.gif',)),
+    'pgp-packets'  : (pgp_packets,  ('.pgp',)),
+    }
+
+def map_file (filename):
+    file = open (filename, 'rb')
+    try:
+        try:
+            return mmap.mmap (file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # empty files can't be mapped
+            return file.read()
+    finally:
+        file.close()
+
+def run_job (args):
+    # runs in a worker process
+    job, filename = args
+    try:
+        data = map_file (filename)
+        try:
+            value = jobs[job][0] (data)
+        finally:
+            if type(data) != type(''):
+                data.close()
+    except Exception, why:
+        return filename, None, '%s: %s' % (why.__class__.__name__, why)
+    return filename, value, None
+
+# ---------------------------------------------------------------------------
+# batches
+# ---------------------------------------------------------------------------
+
+def find_files (paths, extensions):
+    # files are taken as they are, directories are searched for files
+    # with one of <extensions> (in any case).
+    files = []
+    for path in paths:
+        if not os.path.isdir (path):
+            files.append (path)
+        else:
+            for dirpath, dirnames, filenames in os.walk (path):
+                dirnames.sort()
+                filenames.sort()
+                for name in filenames:
+                    if string.lower (os.path.splitext (name)[1]) in extensions:
+                        files.append (os.path.join (dirpath, name))
+    return files
+
+def process_files (job, filenames, processes=None, ordered=1, chunk_size=16):
+    # a generator of batch_results for <filenames>.  <processes> defaults
+    # to the number of cpus; with 1, the files are done in this process.
+    if not jobs.has_key (job):
+        raise ValueError, 'unknown job "%s"' % job
+    work = map (lambda filename, job=job: (job, filename), filenames)
+    if processes == 1:
+        for args in work:
+            yield batch_result (run_job (args))
+        return
+    pool = multiprocessing.Pool (processes)
+    try:
+        if ordered:
+            results = pool.imap (run_job, work, chunk_size)
+        else:
+            results = pool.imap_unordered (run_job, work, chunk_size)
+        for result in results:
+            yield batch_result (result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def process_paths (job, paths, processes=None, ordered=1, chunk_size=16):
+    # like process_files, but directories are searched
+    if not jobs.has_key (job):
+        raise ValueError, 'unknown job "%s"' % job
+    return process_files (
+        job, find_files (paths, jobs[job][1]), processes, ordered, chunk_size
+        )
+
+############################################################################
+# command line
+############################################################################
+
+usage = """usage: %s [-j processes] [-u] job file-or-directory ...
+  -j  number of worker processes (default: one per cpu)
+  -u  print results as they're finished, rather than in order
+jobs: """ + string.join (sorted (jobs.keys()), ', ')
+
+def main (argv):
+    import getopt
+    try:
+        opts, args = getopt.getopt (argv[1:], 'j:u')
+    except getopt.error, why:
+        print why
+        args = []
+    if len(args) < 2 or not jobs.has_key (args[0]):
+        print usage % argv[0]
+        return 2
+    processes = None
+    ordered = 1
+    for opt, value in opts:
+        if opt == '-j':
+            processes = string.atoi (value)
+        elif opt == '-u':
+            ordered = 0
+    errors = 0
+    for result in process_paths (args[0], args[1:], processes, ordered):
+        if result.error is None:
+            print '%s: %s' % (result.filename, repr (result.value))
+        else:
+            errors = errors + 1
+            print '%s: error: %s' % (result.filename, result.error)
+    if errors:
+        return 1
+    else:
+        return 0
+
+if __name__ == '__main__':
+    sys.exit (main (sys.argv))
@@ -0,0 +1,384 @@
+#! /usr/local/bin/python
+# -*- Mode: Python; tab-width: 4 -*-
+
+# Benchmarks for npstruct: packing and unpacking a few shapes of format
+# (mostly scalars, one long repeated field, bitfields, procfields),
+# Oracle records, and the GIF and PGP parsers on data made up on the
+# spot.  The formats are timed with each engine that's available: the
+# pure Python npstruct.py, the C module (if it's been built; its Oracles
+# come from oracle.py), and the struct module, where it can express the
+# format.  gif.py and pgpformat.py are written to npstruct.py, so the
+# parsers are only timed with that.
+#
+# Each benchmark reports operations and megabytes per second, and the
+# number of objects (that the garbage collector tracks) still alive after
+# a run - normally 0, anything else is a leak or a cache filling up.
+# Results can be saved as a baseline, and later runs compared with it;
+# a benchmark slower than the baseline by more than the threshold is
+# flagged, and makes the exit status 1.
+#
+# $ python bench.py -s baseline.json
+# $ python bench.py -b baseline.json -o bench_output.txt
+# $ python bench.py -k gif,pgp -e python
+
+import os
+import sys
+import imp
+import gc
+import time
+import random
+import string
+import struct
+import StringIO
+
+here = os.path.dirname (os.path.abspath (__file__))
+
+# ---------------------------------------------------------------------------
+# engines
+# ---------------------------------------------------------------------------
+# Both npstruct.py and the C module are called 'npstruct', so each is
+# loaded by hand.  gif and pgpformat get the Python one, and oracle.py
+# the C one.
+
+def load_engines ():
+    # returns (npstruct.py, the C module or None, oracle.py or None)
+    python = imp.load_source ('npstruct', os.path.join (here, 'npstruct.py'))
+    global gif, pgpformat
+    import gif
+    import pgpformat
+    c = oracle = None
+    extensions = []
+    for suffix, mode, kind in imp.get_suffixes():
+        if kind == imp.C_EXTENSION:
+            extensions.append (suffix)
+    for dir in [here] + sys.path:
+        for suffix in extensions:
+            path = os.path.join (dir or os.curdir, 'npstruct' + suffix)
+            if c is None and os.path.isfile (path):
+                # (an extension module is initialized into whatever
+                # module of its name is already in sys.modules)
+                del sys.modules['npstruct']
+                c = imp.load_dynamic ('npstruct', path)
+                if sys.modules.has_key ('oracle'):
+                    del sys.modules['oracle']
+                import oracle
+    sys.modules['npstruct'] = python
+    return python, c, oracle
+
+# ---------------------------------------------------------------------------
+# formats
+# ---------------------------------------------------------------------------
+
+def python_pascal_string (result, data, pos):
+    length = ord(data[pos])
+    return data[pos+1:pos+1+length], length+1
+
+def c_pascal_string (result, data, pos):
+    # C procfields hand back a tuple of values
+    length = ord(data[pos])
+    return (data[pos+1:pos+1+length],), length+1
+
+def write_pascal_string (value):
+    return chr(len(value)) + value
+
+# name, format, values, the struct module's format (or None)
+shapes = [
+    ('scalar',
+     'Lbhlbhlbhlbhl',
+     (1, 2000, 300000, 4, 5000, 600000, 7, 8000, 900000, 10, 11000, 1200000),
+     '<BHIBHIBHIBHI'),
+    ('repeat',
+     'L1024b',
+     (range (256) * 4,),
+     '<1024B'),
+    ('bitfield',
+     'B' + '(1 1 4 2)' * 8,
+     (1, 0, 9, 2) * 8,
+     None),
+    ('procfield',
+     'Bb[s]h[s]l[s]',
+     (1, 'hello', 2000, 'procfield', 300000, 'world' * 10),
+     None),
+    ]
+
+def format_benchmarks (engines):
+    python, c, oracle = engines
+    benchmarks = []
+    for name, format, values, struct_format in shapes:
+        for engine, module, read in (('python', python, python_pascal_string),
+                                     ('c', c, c_pascal_string)):
+            if module is None:
+                continue
+            reader = module.compile (format, {'s':read})
+            writer = module.compile (format, {'s':write_pascal_string})
+            data = writer.pack (values)
+            benchmarks.append (
+                ('%s unpack' % name, engine, lambda r=reader, d=data: r.unpack (d), len(data))
+                )
+            benchmarks.append (
+                ('%s pack' % name, engine, lambda w=writer, v=values: w.pack (v), len(data))
+                )
+        if struct_format is not None:
+            s = struct.Struct (struct_format)
+            flat = []
+            for value in values:
+                if type(value) == type([]):
+                    flat.extend (value)
+                else:
+                    flat.append (value)
+            data = s.pack (*flat)
+            benchmarks.append (
+                ('%s unpack' % name, 'struct', lambda s=s, d=data: s.unpack (d), len(data))
+                )
+            benchmarks.append (
+                ('%s pack' % name, 'struct', lambda s=s, v=flat: s.pack (*v), len(data))
+                )
+    return benchmarks
+
+lsd_names = (
+    'width',
+    'height',
+    'global color table flag',
+    'color resolution',
+    'sort flag',
+    'size of global color table',
+    'background color index',
+    'pixel aspect ratio'
+    )
+
+def oracle_benchmarks (engines):
+    python, c, oracle = engines
+    benchmarks = []
+    for engine, module in (('python', python), ('c', oracle)):
+        if module is None:
+            continue
+        o = module.Oracle ('Logical Screen Descriptor', 'Lhh(1 3 1 3)bb', lsd_names)
+        data = '\x40\x01\xf0\x00\xf7\x00\x00'
+        benchmarks.append (
+            ('oracle record', engine, lambda o=o, d=data: o.unpack (d)[0], len(data))
+            )
+        benchmarks.append (
+            ('oracle dict', engine, lambda o=o, d=data: o.unpack (d)[0].as_dict(), len(data))
+            )
+    return benchmarks
+
+# ---------------------------------------------------------------------------
+# parsers
+# ---------------------------------------------------------------------------
+
+def make_gif (width=320, height=240, frames=4, seed=1):
+    # random blobs of color, so the LZW data is neither trivial nor noise
+    r = random.Random (seed)
+    palette = string.join (map (lambda i: chr(i) + chr(255-i) + chr((i*7) & 0xff), range (256)), '')
+    parts = ['GIF89a', struct.pack ('<HHBBB', width, height, 0xf7, 0, 0), palette]
+    for frame in range (frames):
+        rows = []
+        for y in range (height):
+            row = []
+            x = 0
+            while x < width:
+                run = r.randint (1, 24)
+                row.append (chr (r.randint (0, 255)) * run)
+                x = x + run
+            rows.append (string.join (row, '')[:width])
+        pixels = string.join (rows, '')
+        parts.append (',' + struct.pack ('<HHHHB', 0, 0, width, height, 0))
+        parts.append (gif.encode_image_data (pixels, 8, width))
+    parts.append (';')
+    return string.join (parts, '')
+
+def make_keyring (keys=500, seed=1):
+    # PGP 2.x public keys: certificate, trust, user id, trust, signature
+    r = random.Random (seed)
+    def mpi (n):
+        digits = '%x' % n
+        if len(digits) % 2:
+            digits = '0' + digits
+        return struct.pack ('>H', n.bit_length()) + digits.decode ('hex')
+    def packet (type, body):
+        return chr (0x80 | (type << 2) | 1) + struct.pack ('>H', len(body)) + body
+    parts = []
+    for k in range (keys):
+        n = r.getrandbits (1024) | (1L << 1023) | 1
+        parts.append (packet (6, '\x03' + struct.pack ('>LHB', 800000000 + k, 0, 1) + mpi (n) + mpi (17L)))
+        parts.append ('\xb0\x01\x87')
+        user_id = 'User %d <user%d@example.com>' % (k, k)
+        parts.append ('\xb4' + chr (len (user_id)) + user_id)
+        parts.append ('\xb0\x01\x03')
+        sig = r.getrandbits (1020) | (1L << 1019)
+        parts.append (
+            packet (2, '\x03\x05\x10' + struct.pack ('>LQ', 800000100 + k, n & 0xffffffffffffffffL)
+                    + '\x01\x01ab' + mpi (sig))
+            )
+    return string.join (parts, '')
+
+def parser_benchmarks (engines):
+    gif_data = make_gif()
+    ring = make_keyring()
+    all_types = filter (lambda t: len (pgpformat.ctb_type_table[t]) > 1, pgpformat.ctb_type_table.keys())
+    return [
+        ('gif GIF_FILE', 'python', lambda d=gif_data: gif.GIF_FILE.unpack (d), len(gif_data)),
+        ('gif parse_file', 'python',
+         lambda d=gif_data: list (gif.parse_file (StringIO.StringIO (d))), len(gif_data)),
+        ('gif scan_metadata', 'python', lambda d=gif_data: gif.scan_metadata_data (d), len(gif_data)),
+        ('pgp keyring index', 'python', lambda d=ring: pgpformat.build_keyring_index (d), len(ring)),
+        ('pgp all packets', 'python',
+         lambda d=ring, t=all_types: list (pgpformat.iter_packets (d, t)), len(ring)),
+        ('pgp packet headers', 'python', lambda d=ring: list (pgpformat.iter_packets (d)), len(ring)),
+        ]
+
+# ---------------------------------------------------------------------------
+# timing
+# ---------------------------------------------------------------------------
+
+def run (fun, number):
+    start = time.time()
+    for i in xrange (number):
+        fun()
+    return time.time() - start
+
+def measure (fun, min_time=0.2, repeat=3):
+    # returns (seconds per call, objects left behind by a run)
+    number = 1
+    while 1:
+        elapsed = run (fun, number)
+        if elapsed >= min_time:
+            break
+        elif elapsed <= 0:
+            number = number * 10
+        else:
+            number = max (number * 2, int (number * min_time * 1.2 / elapsed))
+    best = elapsed
+    for i in range (repeat - 1):
+        best = min (best, run (fun, number))
+    gc.collect()
+    before = len (gc.get_objects())
+    run (fun, number)
+    gc.collect()
+    kept = len (gc.get_objects()) - before
+    return best / number, kept
+
+def run_benchmarks (benchmarks, min_time=0.2, repeat=3, report=None):
+    # returns {'name/engine': (ops/s, MB/s, objects kept)}
+    results = {}
+    for name, engine, fun, size in benchmarks:
+        seconds, kept = measure (fun, min_time, repeat)
+        results['%s/%s' % (name, engine)] = (1.0 / seconds, size / seconds / 1e6, kept)
+        if report:
+            report (name, engine, results['%s/%s' % (name, engine)])
+    return results
+
+# ---------------------------------------------------------------------------
+# baselines
+# ---------------------------------------------------------------------------
+
+def save_baseline (filename, results):
+    import json
+    file = open (filename, 'w')
+    try:
+        json.dump ({'python':sys.version, 'results':results}, file, indent=1, sort_keys=True)
+    finally:
+        file.close()
+
+def load_baseline (filename):
+    import json
+    return json.load (open (filename))['results']
+
+def compare (results, baseline, threshold=0.1):
+    # the keys of the benchmarks slower than <baseline> by more than <threshold>
+    slower = []
+    for key, (ops, mb, kept) in results.items():
+        if baseline.has_key (key) and ops < baseline[key][0] * (1 - threshold):
+            slower.append (key)
+    slower.sort()
+    return slower
+
+############################################################################
+# command line
+############################################################################
+
+usage = """usage: %s [options]
+  -k names      only run benchmarks whose names contain one of these (comma-separated)
+  -e engines    only these engines (python, c, struct)
+  -t seconds    minimum time for each timing run (default 0.2)
+  -r repeat     timing runs per benchmark, the best is taken (default 3)
+  -s file       save the results as a baseline
+  -b file       compare the results with a baseline
+  -x fraction   how much slower than the baseline is a regression (default 0.1)
+  -o file       write the report to a file too"""
+
+def main (argv):
+    import getopt
+    try:
+        opts, args = getopt.getopt (argv[1:], 'k:e:t:r:s:b:x:o:')
+    except getopt.error, why:
+        print why
+        opts, args = None, None
+    if opts is None or args:
+        print usage % argv[0]
+        return 2
+    names = engine_names = None
+    min_time, repeat, threshold = 0.2, 3, 0.1
+    save = baseline_file = output = None
+    for opt, value in opts:
+        if opt == '-k':
+            names = string.split (value, ',')
+        elif opt == '-e':
+            engine_names = string.split (value, ',')
+        elif opt == '-t':
+            min_time = string.atof (value)
+        elif opt == '-r':
+            repeat = string.atoi (value)
+        elif opt == '-s':
+            save = value
+        elif opt == '-b':
+            baseline_file = value
+        elif opt == '-x':
+            threshold = string.atof (value)
+        elif opt == '-o':
+            output = value
+    baseline = {}
+    if baseline_file:
+        baseline = load_baseline (baseline_file)
+    engines = load_engines()
+    benchmarks = format_benchmarks (engines) + oracle_benchmarks (engines) + parser_benchmarks (engines)
+    selected = []
+    for benchmark in benchmarks:
+        name, engine = benchmark[:2]
+        if engine_names and engine not in engine_names:
+            continue
+        elif names and not filter (lambda n, name=name: string.find (name, n) != -1, names):
+            continue
+        selected.append (benchmark)
+    lines = []
+    def write (line, lines=lines):
+        print line
+        sys.stdout.flush()
+        lines.append (line)
+    write ('%-20s %-7s %12s %9s %5s %9s' % ('benchmark', 'engine', 'ops/s', 'MB/s', 'kept', 'vs base'))
+    def report (name, engine, result, write=write, baseline=baseline, threshold=threshold):
+        ops, mb, kept = result
+        key = '%s/%s' % (name, engine)
+        if baseline.has_key (key):
+            ratio = ops / baseline[key][0]
+            change = '%8.2fx' % ratio
+            if ratio < 1 - threshold:
+                change = change + ' SLOWER'
+        else:
+            change = ''
+        write ('%-20s %-7s %12.1f %9.2f %5d %s' % (name, engine, ops, mb, kept, change))
+    results = run_benchmarks (selected, min_time, repeat, report)
+    slower = compare (results, baseline, threshold)
+    if slower:
+        write ('%d regression(s): %s' % (len (slower), string.join (slower, ', ')))
+    if output:
+        open (output, 'w').write (string.join (lines, '\n') + '\n')
+    if save:
+        save_baseline (save, results)
+    if slower:
+        return 1
+    else:
+        return 0
+
+if __name__ == '__main__':
+    sys.exit (main (sys.argv))
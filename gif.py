@@ -7,13 +7,46 @@
 # so it should be capable of handling any legal gif file, including
 # application, plain text, and comment extensions.
 
-# I have a separate C module for doing GIF lzw decompression, so
-# using this alone you're stuck with compressed data.
+# Image data is left compressed by the parser; decode_image() will
+# decompress it with npstruct's LZW decoder.
 
 import string
+import array
 import npstruct
 
-ParseError = 'gif parse error'
+# The parser needs npstruct.py (its Oracle and procfield conventions),
+# but if the C module has been built its LZW decoder is used for the
+# pixels.  Both modules are called 'npstruct', and an extension is
+# initialized into whatever module of its name is already in
+# sys.modules, so npstruct.py is set aside while the C one loads.
+
+def load_compiled_npstruct ():
+    # the C npstruct module, or None if it hasn't been built
+    import imp, os, sys
+    dirs = [os.path.dirname (os.path.abspath (__file__))] + sys.path
+    for dir in dirs:
+        for suffix, mode, kind in imp.get_suffixes():
+            if kind != imp.C_EXTENSION:
+                continue
+            path = os.path.join (dir or os.curdir, 'npstruct' + suffix)
+            if os.path.isfile (path):
+                python = sys.modules.get ('npstruct')
+                if python is not None:
+                    del sys.modules['npstruct']
+                try:
+                    try:
+                        return imp.load_dynamic ('npstruct', path)
+                    except ImportError:
+                        return None
+                finally:
+                    if python is not None:
+                        sys.modules['npstruct'] = python
+    return None
+
+compiled_npstruct = load_compiled_npstruct()
+
+class ParseError (Exception):
+    pass
 
 # Note: the functions in this file treat 'data' as a string array.
 # A file-object like interface could probably be cooked up using
@@ -23,25 +56,70 @@ ParseError = 'gif parse error'
 # store not only image data, but application and comment extension
 # data.
 
+# The blocks aren't copied out of the data they came from (the LZW
+# decoder reads them in place).  Only their count and total length
+# are worked out up front; 'extents', an array of (offset, length)
+# pairs, is made the first time a block is asked for.  A block asked
+# for by index is sliced out of the data (a string or buffer, as the
+# procfields are handed it) as a string of at most 255 bytes.
+
 class Data_Block_List:
-    def __init__ (self, blocks):
-        self.blocks = blocks
-        self.length = reduce (lambda x,y: x+y, map (len, blocks))
+    def __init__ (self, data, offset, count, length):
+        self.data = data
+        self.offset = offset
+        self.count = count
+        self.length = length
+
+    def __getattr__ (self, name):
+        if name == 'extents':
+            data = self.data
+            extents = array.array ('l')
+            pos = self.offset
+            for i in range(self.count):
+                block_size = ord(data[pos])
+                extents.append (pos + 1)
+                extents.append (block_size)
+                pos = pos + 1 + block_size
+            self.extents = extents
+            return extents
+        else:
+            raise AttributeError, name
+
     def __repr__ (self):
         return '<GIF Data Block List: %d bytes>' % self.length
 
+    def __len__ (self):
+        return self.count
+
+    def __getitem__ (self, i):
+        if i < 0:
+            i = i + self.count
+        if i < 0 or i >= self.count:
+            raise IndexError, 'data block index out of range'
+        start = self.extents[i*2]
+        return self.data[start:start+self.extents[i*2+1]]
+
+    def readinto (self, out, pos=0):
+        # copy the blocks end to end into the writable buffer <out>,
+        # starting at <pos>.  returns the number of bytes copied.
+        out = memoryview (out)
+        data = self.data
+        extents = self.extents
+        for i in range(0, len(extents), 2):
+            start, size = extents[i], extents[i+1]
+            out[pos:pos+size] = data[start:start+size]
+            pos = pos + size
+        return self.length
+
+    def join (self):
+        # all the blocks as one bytearray
+        out = bytearray (self.length)
+        self.readinto (out)
+        return out
+
 def read_data_blocks (results, data, pos):
-    start_pos = pos
-    blocks = []
-    while 1:
-        block_size = ord(data[pos])
-        if block_size:
-            blocks.append (data[pos+1:pos+1+block_size])
-            pos = pos + 1 + block_size
-        else:
-            pos = pos + 1
-            break
-    return Data_Block_List (blocks), (pos - start_pos)
+    count, length, end = npstruct.skip_sub_blocks (data, pos)
+    return Data_Block_List (data, pos, count, length), (end - pos)
 
 header = npstruct.Oracle ('GIF Header',
                           'L3c3c',
@@ -164,38 +242,68 @@ def read_gif_header (results, data, pos):
         raise ParseError, 'Unknown GIF version "%s"' % ver
     return (sig, ver), l
 
+# The table is kept as it appears in the file, a run of r,g,b bytes:
+# read() just takes a buffer onto the data, and colors are only made
+# into (r, g, b) tuples when they're asked for.
+
 class Color_Table:
     def __init__ (self, table=None):
         if table == None:
-            self.table = []
+            self.table = ''
+        elif type(table) == type([]):
+            # a list of (r, g, b) tuples
+            self.table = string.join (map (lambda c: string.join (map (chr, c), ''), table), '')
         else:
             self.table = table
+        self.translations = None
 
     def read (self, results, data, pos, size):
-        table = range(size)
-        for i in range(size):
-            table[i] = tuple (map (ord, data[pos:pos+3]))
-            pos = pos + 3
-        self.table = table
+        self.table = data[pos:pos+size*3]
+        self.translations = None
 
     def __len__ (self):
-        return len(self.table)
+        return len(self.table) / 3
+
+    def __getitem__ (self, i):
+        if i < 0:
+            i = i + len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError, 'color index out of range'
+        return tuple (map (ord, self.table[i*3:i*3+3]))
 
     def __repr__ (self):
-        return '<GIF color table: %d entries>' % len(self.table)
+        return '<GIF color table: %d entries>' % len(self)
+
+    def as_array (self):
+        # an (N, 3) numpy array of uint8, sharing the table's memory
+        numpy = npstruct.numpy
+        if numpy is None:
+            raise ParseError, 'numpy is not available'
+        return numpy.frombuffer (self.table, numpy.uint8).reshape ((-1, 3))
+
+    def apply (self, pixels):
+        # the r,g,b bytes for a string (or bytearray) of palette indices,
+        # e.g. from decode_image().  indices past the end of the table
+        # come out black.
+        if self.translations is None:
+            # a translation table for each of red, green and blue
+            table = str (self.table) + '\0' * (768 - len(self.table))
+            self.translations = table[0::3], table[1::3], table[2::3]
+        red, green, blue = self.translations
+        out = bytearray (len(pixels) * 3)
+        out[0::3] = pixels.translate (red)
+        out[1::3] = pixels.translate (green)
+        out[2::3] = pixels.translate (blue)
+        return out
 
 # Sort of like a 'desktop' for the images to sit on,
 # though usually there's only a single image.
 
 def read_logical_screen (results, data, pos):
+    # the descriptor reads the global color table itself
     lsd, lsd_len = logical_screen_descriptor.unpack (data, pos)
     if lsd['global color table flag']:
-        size = 2<<lsd['global color table size']
-        color_table = range(size)
-        for i in range(len(color_table)):
-            color_table[i] = tuple (map (ord, data[pos:pos+3]))
-            pos = pos + 3
-        return (lsd, Color_Table(color_table)), lsd_len + (size * 3)
+        return (lsd, lsd['global color table']), lsd_len
     else:
         return (lsd, []), lsd_len
 
@@ -264,6 +372,40 @@ table_based_image = npstruct.Oracle (
     data=read_data_blocks
     )
 
+# LZW-compressed image data
+#
+# decoded with the C module's lzw_decode when it's been built (see
+# load_compiled_npstruct above), otherwise npstruct.py's.  Both read
+# the sub-blocks in place.
+
+if compiled_npstruct is None:
+    lzw_decode = npstruct.lzw_decode
+else:
+    def lzw_decode (data, offset, code_size, out, width=0, interlace=0):
+        try:
+            return compiled_npstruct.lzw_decode (data, offset, code_size, out, width, interlace)
+        except ValueError, why:
+            # the same error npstruct.py's decoder would raise
+            raise npstruct.error, str (why)
+
+def decode_image (image, out=None):
+    # the pixels (palette indices) of a table-based image, in <out>
+    # (any writable buffer of width*height bytes) or a new bytearray.
+    # interlaced rows are put back in order.
+    id = image['image descriptor']
+    width = id['width']
+    if out is None:
+        out = bytearray (width * id['height'])
+    blocks = image['image data']
+    lzw_decode (
+        blocks.data, blocks.offset, image['lzw code size'], out, width, id['interlace flag']
+        )
+    return out
+
+def encode_image_data (pixels, code_size, width=0, interlace=0):
+    # the 'lzw code size' byte and data sub-blocks for an image
+    return chr(code_size) + npstruct.lzw_encode (pixels, code_size, width, interlace)
+
 def read_trailer (results, data, pos):
     if data[pos] != chr(0x3b):
         raise ParseError, 'expected trailer missing'
@@ -291,14 +433,14 @@ def describe_gif_file (stuff):
             if gce:
                 if gce['transparent color flag']:
                     print 'Transparent Color: R:%3d G:%3d B:%3d' % (
-                        global_color_table.table[gce['transparent color index']]
+                        global_color_table[gce['transparent color index']]
                         )
             if type == 'image':
                 id = info['image descriptor']
                 lct = info['local color table']
                 lzw_size = info['lzw code size']
                 print 'Image Data: %d blocks, %d bytes' % (
-                    len(info['image data'].blocks),
+                    len(info['image data']),
                     info['image data'].length
                     )
                 print 'Local Color Table: ',
@@ -322,9 +464,9 @@ def describe_gif_file (stuff):
                     map (lambda x: string.upper(hex(x)[2:]),
                          ae['identifier']),
                     ''))
-            print 'Sample from first Data Block: %s' % repr(ae['data'].blocks[0])
+            print 'Sample from first Data Block: %s' % repr(str(ae['data'][0]))
         elif thing[0] == 'comment extension':
-            print 'Comment: "%s"' % string.joinfields (thing[1]['data'].blocks, '')
+            print 'Comment: "%s"' % str (thing[1]['data'].join())
 
 GIF_FILE = npstruct.Oracle (
     'GIF file format Top-Level Parser',
@@ -340,6 +482,366 @@ GIF_FILE = npstruct.Oracle (
     trailer=read_trailer
     )
 
+# ---------------------------------------------------------------------------
+# incremental parsing
+# ---------------------------------------------------------------------------
+# A Parser is fed a GIF a chunk at a time, and hands back each part
+# of it as soon as that part is complete, as (kind, value) pairs:
+#
+#   ('header', (signature, version))
+#   ('logical screen', <logical screen descriptor>)
+#   ('graphic block', (<graphic control extension or None>, ('image', <table-based image>)))
+#   ('graphic block', (<graphic control extension or None>, ('text', <plain text extension>)))
+#   ('application extension', <application extension>)
+#   ('comment extension', <comment extension>)
+#   ('trailer', 0x3b)
+#
+# which are the pieces GIF_FILE.unpack() returns for the whole file.
+# Only the unfinished part is buffered, so at most one frame (plus a
+# chunk) is held in memory, however long the file is.  Each part is
+# parsed from a copy of just its own bytes, so holding on to a frame
+# doesn't hold on to the rest of the file.
+
+class Parser:
+
+    def __init__ (self):
+        self.data = bytearray()
+        self.state = 'header'
+        self.scan = None        # next sub-block size byte, while looking for the end
+        self.gce = None         # graphic control extension for the next graphic
+        self.screen = None
+        self.pos = 0            # where in the stream the next part starts
+
+    def feed (self, data):
+        self.data.extend (data)
+        results = []
+        while self.state != 'done':
+            end = self.block_end()
+            if end is None:
+                break
+            block = str (self.data[:end])
+            del self.data[:end]
+            self.scan = None
+            result = self.parse_block (block)
+            self.pos = self.pos + end
+            if result is not None:
+                results.append (result)
+        return results
+
+    def close (self):
+        if self.state != 'done':
+            raise ParseError, 'truncated GIF data'
+
+    def chain_end (self, start):
+        # the end of the sub-blocks beginning at <start>, if they're all here.
+        # picks up where the last look left off.
+        if self.scan is None:
+            self.scan = start
+        data = self.data
+        while self.scan < len(data):
+            size = data[self.scan]
+            if not size:
+                return self.scan + 1
+            self.scan = self.scan + 1 + size
+        return None
+
+    def block_end (self):
+        # how much of the buffer makes up the next part, or None if it isn't all here yet
+        data = self.data
+        if self.state == 'header':
+            if len(data) >= 6:
+                return 6
+        elif self.state == 'screen':
+            if len(data) >= 7:
+                size = 7
+                if data[4] & 0x80:
+                    size = size + (3 * (2 << (data[4] & 0x07)))
+                if len(data) >= size:
+                    return size
+        elif not data:
+            return None
+        elif data[0] == 0x3b:
+            return 1
+        elif data[0] == 0x21:
+            if len(data) >= 2:
+                return self.chain_end (2)
+        elif data[0] == 0x2c:
+            if len(data) >= 10:
+                start = 10
+                if data[9] & 0x80:
+                    start = start + (3 * (2 << (data[9] & 0x07)))
+                # the lzw code size byte, then the image data
+                if len(data) > start:
+                    return self.chain_end (start + 1)
+        else:
+            raise ParseError, 'unknown block type 0x%02x' % data[0]
+        return None
+
+    def parse_block (self, block):
+        if self.state == 'header':
+            self.state = 'screen'
+            return 'header', read_gif_header ([], block, 0)[0]
+        elif self.state == 'screen':
+            self.state = 'blocks'
+            self.screen = logical_screen_descriptor.unpack (block, 0)[0]
+            return 'logical screen', self.screen
+        elif block[0] == chr(0x3b):
+            self.state = 'done'
+            return 'trailer', 0x3b
+        elif block[0] == chr(0x2c):
+            image = table_based_image.procfield_function ([], block, 0)[0]
+            gce, self.gce = self.gce, None
+            return 'graphic block', (gce, ('image', image))
+        label = block[1]
+        if label == chr(0xf9):
+            self.gce = graphic_control_extension.unpack (block, 0)[0]
+        elif label == chr(0x01):
+            pte = plain_text_extension.unpack (block, 0)[0]
+            gce, self.gce = self.gce, None
+            return 'graphic block', (gce, ('text', pte))
+        elif label == chr(0xff):
+            return 'application extension', application_extension.unpack (block, 0)[0]
+        elif label == chr(0xfe):
+            return 'comment extension', comment_extension.unpack (block, 0)[0]
+        # other extensions are skipped
+        return None
+
+def parse_file (file, chunk_size=65536):
+    # generate the parts of the GIF in <file> (see Parser), reading
+    # a chunk at a time
+    parser = Parser()
+    while 1:
+        chunk = file.read (chunk_size)
+        if not chunk:
+            break
+        for part in parser.feed (chunk):
+            yield part
+    parser.close()
+
+# ---------------------------------------------------------------------------
+# frame index
+# ---------------------------------------------------------------------------
+# A Frame_Index records where each frame (table-based image) of a GIF
+# is, along with its position, delay and disposal method, so a single
+# frame can be read and decoded without parsing the ones before it.
+# It's built with one pass over the file (without keeping any image
+# data), and can be saved: a header, then an entry per frame.
+
+frame_index_header = npstruct.Oracle (
+    'GIF Frame Index Header',
+    'L4cll',
+    ('magic',                   # 'GIFX'
+     'file size',               # of the GIF, to spot a stale index
+     'frame count')
+    )
+
+frame_index_entry = npstruct.Oracle (
+    'GIF Frame Index Entry',
+    'Lllhhhhhbbbb',
+    ('offset',                  # of the image descriptor
+     'size',                    # through the end of the image data
+     'left',
+     'top',
+     'width',
+     'height',
+     'delay time',
+     'disposal method',
+     'transparent color flag',
+     'transparent color index',
+     'interlace flag')
+    )
+
+class Frame_Index:
+
+    def __init__ (self, frames, file_size):
+        self.frames = frames
+        self.file_size = file_size
+
+    def __repr__ (self):
+        return '<GIF frame index: %d frames>' % len(self.frames)
+
+    def __len__ (self):
+        return len(self.frames)
+
+    def __getitem__ (self, n):
+        return self.frames[n]
+
+    def read_frame (self, file, n):
+        # the table-based image for frame <n>, read from the (seekable) <file>
+        frame = self.frames[n]
+        file.seek (frame['offset'])
+        block = file.read (frame['size'])
+        if len(block) != frame['size']:
+            raise ParseError, 'truncated GIF data'
+        return table_based_image.procfield_function ([], block, 0)[0]
+
+    def decode_frame (self, file, n, out=None):
+        return decode_image (self.read_frame (file, n), out)
+
+    def save (self, file):
+        file.write (
+            frame_index_header.pack (
+                {'magic':'GIFX', 'file size':self.file_size, 'frame count':len(self.frames)}
+                )
+            )
+        file.write (string.join (map (frame_index_entry.pack, self.frames), ''))
+
+class Frame_Index_Builder (Parser):
+
+    # a Parser that just notes where the images are
+
+    def __init__ (self):
+        Parser.__init__ (self)
+        self.frames = []
+
+    def parse_block (self, block):
+        if self.state != 'blocks' or block[0] != chr(0x2c):
+            return Parser.parse_block (self, block)
+        id = image_descriptor.unpack (block, 0)[0]
+        gce, self.gce = self.gce, None
+        if gce is None:
+            delay = disposal = transparent = transparent_index = 0
+        else:
+            delay = gce['delay time']
+            disposal = gce['disposal method']
+            transparent = gce['transparent color flag']
+            transparent_index = gce['transparent color index']
+        self.frames.append (
+            frame_index_entry.record ((
+                self.pos, len(block), id['left'], id['top'], id['width'], id['height'],
+                delay, disposal, transparent, transparent_index, id['interlace flag']
+                ))
+            )
+        return None
+
+def build_frame_index (file, chunk_size=65536):
+    builder = Frame_Index_Builder()
+    size = 0
+    while 1:
+        chunk = file.read (chunk_size)
+        if not chunk:
+            break
+        size = size + len(chunk)
+        builder.feed (chunk)
+    builder.close()
+    return Frame_Index (builder.frames, size)
+
+def load_frame_index (file, file_size=None):
+    # read an index saved by Frame_Index.save.  if the size of the GIF
+    # is given, it has to match the one the index was built from.
+    data = file.read()
+    header, pos = frame_index_header.unpack (data, 0)
+    if string.join (header['magic'], '') != 'GIFX':
+        raise ParseError, 'not a GIF frame index'
+    elif file_size is not None and file_size != header['file size']:
+        raise ParseError, 'stale GIF frame index'
+    frames = list (frame_index_entry.iter_unpack (data, pos))
+    if len(frames) != header['frame count']:
+        raise ParseError, 'truncated GIF frame index'
+    return Frame_Index (frames, header['file size'])
+
+# ---------------------------------------------------------------------------
+# metadata scanning
+# ---------------------------------------------------------------------------
+# For crawling lots of files: the size, frame count, loop count and
+# total duration of a GIF, without parsing any image or extension data.
+# Sub-blocks are hopped over by their size bytes, and a file is mapped
+# rather than read.  As with decode_image, the C module's
+# skip_sub_blocks is used when it's been built.
+
+if compiled_npstruct is None:
+    skip_sub_blocks = npstruct.skip_sub_blocks
+else:
+    def skip_sub_blocks (data, pos):
+        try:
+            return compiled_npstruct.skip_sub_blocks (data, pos)
+        except ValueError, why:
+            raise npstruct.error, str (why)
+
+gif_metadata = npstruct.make_record_class (
+    'GIF Metadata',
+    ('version',
+     'width',
+     'height',
+     'frame count',
+     'loop count',              # None without a NETSCAPE2.0 extension, 0 is forever
+     'duration')                # in hundredths of a second
+    )
+
+def scan_metadata (source):
+    # <source> is a filename, or the data as a buffer, bytearray or mmap
+    # (to scan a string of data, pass buffer(data)).
+    import mmap
+    if type(source) == type(''):
+        file = open (source, 'rb')
+        try:
+            try:
+                data = mmap.mmap (file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                # empty files can't be mapped
+                data = file.read()
+            try:
+                return scan_metadata_data (data)
+            finally:
+                if type(data) != type(''):
+                    data.close()
+        finally:
+            file.close()
+    elif type(source) == type(bytearray()):
+        return scan_metadata_data (buffer (source))
+    else:
+        return scan_metadata_data (source)
+
+def scan_metadata_data (data):
+    size = len(data)
+    if size < 13:
+        raise ParseError, 'truncated GIF data'
+    (sig, version), pos = read_gif_header ([], data, 0)
+    # the logical screen descriptor, 7 bytes little-endian
+    width = ord(data[6]) | (ord(data[7]) << 8)
+    height = ord(data[8]) | (ord(data[9]) << 8)
+    flags = ord(data[10])
+    pos = 13
+    if flags & 0x80:
+        pos = pos + (3 << ((flags & 7) + 1))
+    frames = duration = delay = 0
+    loops = None
+    while 1:
+        if pos >= size:
+            raise ParseError, 'truncated GIF data'
+        introducer = data[pos]
+        if introducer == ',':
+            # image descriptor, [local color table], lzw code size, image data
+            if pos + 11 > size:
+                raise ParseError, 'truncated GIF data'
+            flags = ord(data[pos+9])
+            pos = pos + 10
+            if flags & 0x80:
+                pos = pos + (3 << ((flags & 7) + 1))
+            frames = frames + 1
+            duration = duration + delay
+            delay = 0
+            pos = skip_sub_blocks (data, pos + 1)[2]
+        elif introducer == '!':
+            # every extension is a label followed by sub-blocks
+            if pos + 2 > size:
+                raise ParseError, 'truncated GIF data'
+            label = ord(data[pos+1])
+            if label == 0xf9 and pos + 6 <= size:
+                delay = ord(data[pos+4]) | (ord(data[pos+5]) << 8)
+            elif label == 0x01:
+                # the delay goes with the plain text
+                delay = 0
+            elif label == 0xff and data[pos+2:pos+15] == '\x0bNETSCAPE2.0\x03' and pos + 19 <= size:
+                if data[pos+15] == '\x01':
+                    loops = ord(data[pos+16]) | (ord(data[pos+17]) << 8)
+            pos = skip_sub_blocks (data, pos + 2)[2]
+        elif introducer == ';':
+            break
+        else:
+            raise ParseError, 'unknown block type 0x%02x' % ord(introducer)
+    return gif_metadata ((version, width, height, frames, loops, duration))
+
 def test (filename):
     data = open (filename, 'rb').read()
     describe_gif_file (GIF_FILE.unpack (data))
@@ -350,8 +852,8 @@ def test_files (files):
         print filename
         try:
             test (filename)
-        except:
-            print 'error parsing %s' % filename
+        except Exception, why:
+            print 'error parsing %s: %s' % (filename, why)
     
 def scan_directory (dname):
     def gif_filter (name):
@@ -0,0 +1,242 @@
+# -*- Mode: Python; tab-width: 4 -*-
+
+# The pieces of the Oracle layer that don't depend on the engine
+# underneath, shared by npstruct.py and oracle.py (which puts the
+# same Oracle over the C module).  The two engines can't import each
+# other, since both are called npstruct, so they both import this.
+
+import string
+import keyword
+import operator
+import sys
+import time
+
+# ---------------------------------------------------------------------------
+# records
+# ---------------------------------------------------------------------------
+# Oracle.unpack returns a record: just the tuple of unpacked fields,
+# in an Oracle's own tuple subclass.  It can be indexed by field name
+# like a dict, and each field is an attribute too, its name cleaned up
+# into an identifier ('global color table flag' -> global_color_table_flag).
+# Records have no per-instance dict, so lots of parsed headers can be
+# kept around cheaply.
+
+identifier_chars = string.ascii_letters + string.digits + '_'
+
+def identifier (name, taken):
+    result = ''
+    for ch in name:
+        if ch in identifier_chars:
+            result = result + ch
+        else:
+            result = result + '_'
+    if not result or result[0] in string.digits:
+        result = '_' + result
+    while keyword.iskeyword (result) or taken.has_key (result):
+        result = result + '_'
+    taken[result] = 1
+    return result
+
+class record (tuple):
+
+    __slots__ = ()
+    names = ()
+    attributes = ()
+    field_index = {}
+    attribute_index = {}
+
+    def __getitem__ (self, key):
+        if isinstance (key, basestring):
+            key = self.field_index[key]
+        return tuple.__getitem__ (self, key)
+
+    def __repr__ (self):
+        fields = map (lambda name, value: '%s=%s' % (name, repr(value)), self.attributes, self)
+        return '%s(%s)' % (self.__class__.__name__, string.join (fields, ', '))
+
+    def as_dict (self):
+        return dict (zip (self.names, self))
+
+    def keys (self):
+        return list (self.names)
+
+    def has_key (self, key):
+        return self.field_index.has_key (key)
+
+    def get (self, key, default=None):
+        if self.field_index.has_key (key):
+            return self[key]
+        else:
+            return default
+
+# Oracle.view (data, offset) is a lazy record: nothing is decoded until
+# a field is asked for.  Fields in front of the first procfield sit at
+# known offsets and are decoded one at a time; asking for anything
+# past that unpacks the whole record.  Decoded fields are kept.
+#
+# A view finds field attributes itself (in __getattr__), so its own
+# attributes are kept under 'view_' names, which aren't reserved in
+# the record classes; a field with one of those names, or the name of
+# a view method, is still there as view[name].
+
+class record_view:
+
+    view_oracle = None
+    view_data = None
+    view_offset = 0
+    view_values = None
+    view_record = None
+    view_length = None
+
+    def __init__ (self, oracle, data, offset=0):
+        self.view_oracle = oracle
+        self.view_data = data
+        self.view_offset = offset
+        self.view_values = {}
+
+    def __repr__ (self):
+        return '<%s view at %d>' % (self.view_oracle.name, self.view_offset)
+
+    def __getitem__ (self, key):
+        if isinstance (key, basestring):
+            key = self.view_oracle.record.field_index[key]
+        try:
+            return self.view_values[key]
+        except KeyError:
+            pass
+        field = self.view_oracle.fixed_fields.get (key)
+        if field is None:
+            return self.as_record()[key]
+        values = self.view_oracle.decode_field (field, self.view_data, self.view_offset)
+        first = field[2]
+        for i in range(len(values)):
+            self.view_values[first + i] = values[i]
+        return values[key - first]
+
+    def __getattr__ (self, name):
+        try:
+            index = self.view_oracle.record.attribute_index[name]
+        except KeyError:
+            raise AttributeError, name
+        return self[index]
+
+    def as_record (self):
+        if self.view_record is None:
+            self.view_record, self.view_length = self.view_oracle.unpack (
+                self.view_data, self.view_offset
+                )
+        return self.view_record
+
+    def as_dict (self):
+        return self.as_record().as_dict()
+
+    def record_length (self):
+        if self.view_oracle.variable:
+            self.as_record()
+            return self.view_length
+        else:
+            return self.view_oracle.size
+
+def make_record_class (name, names):
+    taken = {}
+    for attr in dir (record):
+        taken[attr] = 1
+    attributes = []
+    members = {'__slots__':(), 'names':tuple (names), 'field_index':{}, 'attribute_index':{}}
+    for i in range(len(names)):
+        attr = identifier (names[i], taken)
+        attributes.append (attr)
+        members['field_index'][names[i]] = i
+        members['attribute_index'][attr] = i
+        members[attr] = property (operator.itemgetter (i))
+    members['attributes'] = tuple (attributes)
+    return type (identifier (name, {}), (record,), members)
+
+profile_entry = make_record_class (
+    'Profile Entry',
+    ('kind',                    # 'oracle' or 'procfield'
+     'name',
+     'calls',
+     'bytes',
+     'seconds')
+    )
+
+# ---------------------------------------------------------------------------
+# profiling
+# ---------------------------------------------------------------------------
+# Each engine keeps its own <profiling> flag (checked before every
+# count, so that it costs nothing when off) and its own dict of counts:
+#   (kind, function or oracle) -> [calls, bytes consumed, seconds]
+# and wraps the helpers here with set_profiling, reset_profile and
+# profile_counts of its own.
+
+profile_clock = time.clock
+
+def profile_count (data, kind, object, bytes, seconds):
+    try:
+        counts = data[kind, object]
+    except KeyError:
+        counts = data[kind, object] = [0, 0, 0.0]
+    counts[0] = counts[0] + 1
+    counts[1] = counts[1] + bytes
+    counts[2] = counts[2] + seconds
+
+def profile_counts (data, counts=None):
+    # a snapshot of <data>, added to <counts>
+    if counts is None:
+        counts = {}
+    for key, value in data.items():
+        counts[key] = tuple (value)
+    return counts
+
+class profile:
+
+    "turns profiling on for a 'with' block, starting from zero unless <reset> is false"
+
+    def __init__ (self, set_profiling, reset_profile, reset=1):
+        self.set_profiling = set_profiling
+        self.reset_profile = reset_profile
+        self.reset = reset
+
+    def __enter__ (self):
+        if self.reset:
+            self.reset_profile()
+        self.old = self.set_profiling (1)
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        self.set_profiling (self.old)
+
+def is_oracle (object):
+    # either engine's
+    return hasattr (object, 'procfield_function') and hasattr (object, 'name')
+
+def profile_name (object):
+    # an Oracle's procfield methods are named after it
+    if is_oracle (object):
+        return object.name
+    elif is_oracle (getattr (object, 'im_self', None)):
+        return '%s.%s' % (object.im_self.name, object.__name__)
+    else:
+        return getattr (object, '__name__', repr (object))
+
+def profile_stats (counts):
+    # a list of profile_entry records, the most time first
+    entries = []
+    for (kind, object), (calls, bytes, seconds) in counts.items():
+        entries.append (
+            profile_entry ((kind, profile_name (object), calls, bytes, seconds))
+            )
+    entries.sort (lambda a, b: cmp (b[4], a[4]) or cmp (a[:2], b[:2]))
+    return entries
+
+def profile_report (counts, file=None):
+    if file is None:
+        file = sys.stdout
+    file.write ('%-9s %-40s %9s %11s %9s %9s\n' % (
+        'kind', 'name', 'calls', 'bytes', 'seconds', 'usec/call'
+        ))
+    for kind, name, calls, bytes, seconds in profile_stats (counts):
+        file.write ('%-9s %-40s %9d %11d %9.3f %9.1f\n' % (
+            kind, name[:40], calls, bytes, seconds, seconds * 1e6 / calls
+            ))
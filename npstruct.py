@@ -1,6 +1,7 @@
 # -*- Mode: Python; tab-width: 4 -*-
 
-error = 'npstruct module error'
+class error (Exception):
+    pass
 
 # A version of pack/unpack that doesn't pad.
 # Useful for portable binary data, like images, network packets,
@@ -14,6 +15,8 @@ error = 'npstruct module error'
 # 3) 'Procfields' - fields that crack open with user-specified
 #    functions.  Useful for variable-length fields, and higher-level
 #    parsing.
+# 4) Multi-precision integers - 'm', a word bit count followed by
+#    the bytes of a number of that many bits (as in PGP).
 
 # Missing features compared to the struct module:
 # 1) well, no way to specify any alignment.
@@ -54,176 +57,796 @@ def big_decode_long (data):
            ord(data[2])<<8  | ord(data[3])
 
 import string
+import array
+import binascii
+import sys
+import operator
+import struct
 
-def pack (format, args, funs={}):
-    if format[0] == 'L':
-        encode_word = little_encode_word
-        encode_long = little_encode_long
-    elif format[0] == 'B':
-        encode_word = big_encode_word
-        encode_long = big_encode_long
+# multi-precision integers ('m'): a word holding the number of bits,
+# then just enough bytes to hold them, most significant first (or
+# least, with 'L').  The digits are converted in one go through hex.
+
+def decode_mpi (byte_order, data, pos):
+    header = data[pos:pos+2]
+    if len(header) != 2:
+        raise error, 'not enough data'
+    elif byte_order == 'L':
+        bits = little_decode_word (header)
+    else:
+        bits = big_decode_word (header)
+    size = (bits + 7) / 8
+    digits = data[pos+2:pos+2+size]
+    if len(digits) != size:
+        raise error, 'not enough data'
+    elif not size:
+        return 0L, 2
+    if byte_order == 'L':
+        digits = digits[::-1]
+    return long (binascii.hexlify (digits), 16), size + 2
+
+def encode_mpi (byte_order, value):
+    if not isinstance (value, (int, long)):
+        raise error, 'bad argument type to pack'
+    elif value < 0:
+        raise error, 'negative number in mpi'
+    bits = value.bit_length()
+    if bits > 0xffff:
+        raise error, 'number too big for an mpi'
+    elif not bits:
+        digits = ''
     else:
+        digits = '%x' % value
+        if len(digits) & 1:
+            digits = '0' + digits
+        digits = binascii.unhexlify (digits)
+    if byte_order == 'L':
+        return little_encode_word (bits) + digits[::-1]
+    else:
+        return big_encode_word (bits) + digits
+
+converter = {'b':1,
+             'c':1,
+             'h':2,
+             'l':4
+             }  
+
+# repeated numeric fields are decoded a whole run at a time with
+# an array of the same width.
+array_typecode = {'b':'B', 'h':'H', 'l':'L'}
+if array.array ('L').itemsize != 4:
+    array_typecode['l'] = 'I'
+
+if sys.byteorder == 'little':
+    native_byte_order = 'L'
+else:
+    native_byte_order = 'B'
+
+# ---------------------------------------------------------------------------
+# compiled formats
+# ---------------------------------------------------------------------------
+# A format string is scanned once into a list of 'codes', which
+# pack and unpack then walk without looking at the string again:
+#
+#   ('b',) ('c',) ('h',) ('l',)     simple fields
+#   ('*', count, format_code)       repeat count, like '8b'
+#   ('(', bit_lengths, size)        bitfield
+#   ('[', index, procname)          procfield; <index> is its position
+#                                   in the list of procedure names
+#   ('m',)                          multi-precision integer
+#
+# For unpacking, each run of simple and repeated fields is then
+# handed to the struct module, which decodes the lot in one call:
+#
+#   ('s', struct, pieces, size, codes)
+#
+# <pieces> says how to share out the values struct returns: -1 for a
+# single value, n for a tuple of n (a repeated field), or None if
+# they're all single values.  <codes> are the fields it replaces.
+#
+# The scanned form of the most recently used formats is cached, so
+# the module-level pack() and unpack() get this for free.  compile()
+# goes one step further and looks up the procfield functions once.
+
+def scan_format (format):
+    if not format:
+        raise error, 'empty format'
+    if format[0] not in 'LB':
         raise error, 'unsupported byte order code'
-    result = ''
+    codes = []
+    procnames = []
+    size = 0
     i = 1
-    argnum = 0
     while i < len(format):
         ch = format[i]
-        if ch == 'h':
-            result = result + encode_word (args[argnum])
-        elif ch == 'l':
-            result = result + encode_long (args[argnum])
-        elif ch == 'b':
-            result = result + chr(args[argnum])
-        elif ch == 'c':
-            result = result + args[argnum]
-        elif ch in string.digits:
+        if ch in string.digits:
             num_digits = 0
-            while format[i] in string.digits:
+            while i < len(format) and format[i] in string.digits:
                 num_digits = num_digits + 1
                 i = i + 1
-            num = string.atoi(format[i-num_digits:i])
-            format_code = format[i]
-            sub_result = pack(format[0] + format_code * num, args[argnum])
-            result = result + sub_result
+            num = string.atoi (format[i-num_digits:i])
+            format_code = format[i:i+1]
+            if not converter.has_key (format_code):
+                raise error, 'unsupported repeated field "%s"' % format_code
+            codes.append (('*', num, format_code))
+            size = size + converter[format_code] * num
+        elif converter.has_key (ch):
+            codes.append ((ch,))
+            size = size + converter[ch]
+        elif ch == 'm':
+            # variable-length: not counted in the size
+            codes.append ((ch,))
         elif ch == '[':
             # procfield
             procname_end = string.find (format, ']', i+1)
             if procname_end == -1:
                 raise error, 'no closing bracket for procedure name'
-            else:
-                procname = format[i+1:procname_end]
-            if funs.has_key(procname):
-                fun = funs[procname]
-                sub_result  = apply (fun, (args[argnum],))
-                result = result + sub_result
-            else:
-                raise error, 'procfield function "%s" missing!' % procname
+            procname = format[i+1:procname_end]
+            codes.append (('[', len(procnames), procname))
+            procnames.append (procname)
             i = procname_end
         elif ch == '(':
             # bitfield
-            bit_lengths = []
-            while 1:
-                if format[i] == ')':
-                    break
-                else:
-                    i = i + 1
-                num_digits = 0
-                while format[i] in string.digits:
-                    num_digits = num_digits + 1
-                    i = i + 1
-                num = string.atoi (format[i-num_digits:i])
-                bit_lengths.append (num)
+            end = string.find (format, ')', i+1)
+            if end == -1:
+                raise error, 'unterminated bitfield description'
+            bit_lengths = map (string.atoi, string.split (format[i+1:end]))
             total_bits = reduce (lambda x,y: x + y, bit_lengths)
             if (total_bits % 8) != 0:
                 raise error, 'bitfield not a multiple of 8 bits %s' % (format)
-            bitfield_size = total_bits / 8
+            codes.append (('(', bit_lengths, total_bits / 8))
+            size = size + total_bits / 8
+            i = end
+        else:
+            raise error, 'unsupported format character "%s"' % ch
+        i = i + 1
+    return format[0], codes, procnames, size
+
+struct_codes = {'b':'B', 'c':'c', 'h':'H', 'l':'I'}
+
+def delegate_codes (byte_order, codes, compact=0):
+    # <codes>, with runs of simple and repeated fields made into 's' codes
+    if byte_order == 'L':
+        prefix = '<'
+    else:
+        prefix = '>'
+    result = []
+    run = []
+    for code in codes + [None]:
+        if code is not None and (converter.has_key (code[0]) or (
+            code[0] == '*' and not (compact and code[2] in 'hl'))):
+            # (compact repeated words and longs are left as arrays)
+            run.append (code)
+            continue
+        if len(run) == 1 and run[0][0] != '*':
+            # not worth it for one field
+            result.extend (run)
+        elif run:
+            format = prefix
+            pieces = []
+            size = 0
+            for field in run:
+                if field[0] != '*':
+                    format = format + struct_codes[field[0]]
+                    pieces.append (-1)
+                    size = size + converter[field[0]]
+                else:
+                    count, format_code = field[1], field[2]
+                    if compact:
+                        # a string
+                        format = format + '%ds' % count
+                        pieces.append (-1)
+                    else:
+                        format = format + '%d%s' % (count, struct_codes[format_code])
+                        pieces.append (count)
+                    size = size + converter[format_code] * count
+            if pieces.count (-1) == len(pieces):
+                pieces = None
+            result.append (('s', struct.Struct (format), pieces, size, run))
+        if code is not None:
+            result.append (code)
+        run = []
+    return result
+
+# least-recently-used cache of scanned formats:
+#   {format: [scanned_format, last_use, codes for unpacking]}
+format_cache = {}
+format_cache_size = 100
+format_cache_tick = 0
+
+def format_entry (format):
+    global format_cache_tick
+    format_cache_tick = format_cache_tick + 1
+    try:
+        entry = format_cache[format]
+    except KeyError:
+        parsed = scan_format (format)
+        if len(format_cache) >= format_cache_size:
+            oldest = None
+            for key, (unused, tick, unused) in format_cache.items():
+                if oldest is None or tick < oldest_tick:
+                    oldest, oldest_tick = key, tick
+            del format_cache[oldest]
+        entry = format_cache[format] = [parsed, 0, None]
+    entry[1] = format_cache_tick
+    return entry
+
+def parse_format (format):
+    return format_entry (format)[0]
+
+def parse_unpack_format (format):
+    # like parse_format, but with the codes from delegate_codes
+    entry = format_entry (format)
+    if entry[2] is None:
+        byte_order, codes, procnames, size = entry[0]
+        entry[2] = byte_order, delegate_codes (byte_order, codes), procnames, size
+    return entry[2]
+
+def variable_format (codes):
+    # procfields and mpis have no fixed size
+    for code in codes:
+        if code[0] == '[' or code[0] == 'm':
+            return 1
+    return 0
+
+def get_procs (procnames, funs):
+    # missing procfield functions are reported when they're needed
+    return map (funs.get, procnames)
+
+# ---------------------------------------------------------------------------
+# profiling
+# ---------------------------------------------------------------------------
+# While <profiling> is set, every procfield call made by unpack, and
+# every Oracle.unpack, is counted in <profile_data>:
+#   (kind, function or oracle) -> [calls, bytes consumed, seconds]
+# The times include any unpacking done inside (by a procfield that
+# runs another Oracle, say).  The C module keeps the same counts for
+# procfields; oracle.py adds its Oracles.  The counting and reporting
+# are in npcommon.py, shared with oracle.py.
+#
+# >>> with npstruct.profile():
+# ...     gif.test ('test.gif')
+# >>> npstruct.profile_report()
+
+import npcommon
+from npcommon import profile_clock, profile_count
+
+profiling = 0
+profile_data = {}
+
+def set_profiling (flag):
+    global profiling
+    old, profiling = profiling, flag
+    return old
+
+def reset_profile ():
+    profile_data.clear()
+
+def profile_counts ():
+    return npcommon.profile_counts (profile_data)
+
+def profile (reset=1):
+    "turns profiling on for a 'with' block, starting from zero unless <reset> is false"
+    return npcommon.profile (set_profiling, reset_profile, reset)
+
+def profile_stats (counts=None):
+    # a list of profile_entry records, the most time first
+    if counts is None:
+        counts = profile_counts()
+    return npcommon.profile_stats (counts)
+
+def profile_report (file=None, counts=None):
+    if counts is None:
+        counts = profile_counts()
+    npcommon.profile_report (counts, file)
+
+# pack writes into a buffer preallocated to the fixed size of the
+# format.  Each field overwrites its own slot; procfield output (and
+# a multi-character 'c' argument) is spliced in, growing the buffer,
+# so packing is linear in the size of the output.
+
+def pack_codes (byte_order, codes, procs, size, args):
+    if byte_order == 'L':
+        encode_word = little_encode_word
+        encode_long = little_encode_long
+    else:
+        encode_word = big_encode_word
+        encode_long = big_encode_long
+    buffer = bytearray (size)
+    pos = 0
+    argnum = 0
+    for code in codes:
+        kind = code[0]
+        if kind == 'h':
+            buffer[pos:pos+2] = encode_word (args[argnum])
+            pos = pos + 2
+        elif kind == 'l':
+            buffer[pos:pos+4] = encode_long (args[argnum])
+            pos = pos + 4
+        elif kind == 'b':
+            buffer[pos] = args[argnum]
+            pos = pos + 1
+        elif kind == 'c':
+            sub_result = args[argnum]
+            buffer[pos:pos+1] = sub_result
+            pos = pos + len(sub_result)
+        elif kind == 'm':
+            sub_result = encode_mpi (byte_order, args[argnum])
+            buffer[pos:pos] = sub_result
+            pos = pos + len(sub_result)
+        elif kind == '*':
+            width = converter[code[2]] * code[1]
+            sub_result = pack_repeat (byte_order, code[1], code[2], args[argnum])
+            buffer[pos:pos+width] = sub_result
+            pos = pos + len(sub_result)
+        elif kind == '[':
+            # procfield
+            fun = procs[code[1]]
+            if fun is None:
+                raise error, 'procfield function "%s" missing!' % code[2]
+            sub_result = fun (args[argnum])
+            buffer[pos:pos] = sub_result
+            pos = pos + len(sub_result)
+        elif kind == '(':
+            # bitfield
+            bit_lengths = code[1]
             sub_result = pack_bitfield (
                     bit_lengths,
-                    #args[argnum]
                     args[argnum:argnum+len(bit_lengths)]
                     )
-            #print args, argnum, argnum+len(bit_lengths)
             argnum = argnum + (len(bit_lengths)-1)
-            result = result + sub_result
-        else:
-            raise error, 'unsupported format character "%s"' % ch
-        i = i + 1
+            buffer[pos:pos+code[2]] = sub_result
+            pos = pos + code[2]
         argnum = argnum + 1
-    return result
+    del buffer[pos:]
+    return str (buffer)
 
-converter = {'b':1,
-             'c':1,
-             'h':2,
-             'l':4
-             }  
-
-def unpack (format, data, offset=0, funs={}):
-    if format[0] == 'L':
+def unpack_codes (byte_order, codes, procs, data, offset, compact=0):
+    if byte_order == 'L':
         decode_word = little_decode_word
         decode_long = little_decode_long
-    elif format[0] == 'B':
+    else:
         decode_word = big_decode_word
         decode_long = big_decode_long
-    else:
-        raise error, 'unsupported byte order code'
+    data = as_buffer (data)
     result = []
     pos = offset
-    i = 1
-    while i < len(format):
-        ch = format[i]
+    for code in codes:
+        kind = code[0]
+        # a run of fields, for the struct module
+        if kind == 's':
+            try:
+                values = code[1].unpack_from (data, pos)
+            except struct.error:
+                raise error, 'not enough data'
+            except TypeError:
+                # not something struct can read
+                values, length = unpack_codes (byte_order, code[4], procs, data, pos, compact)
+                result.extend (values)
+                pos = pos + length
+                continue
+            if code[2] is None:
+                result.extend (values)
+            else:
+                i = 0
+                for count in code[2]:
+                    if count < 0:
+                        result.append (values[i])
+                        i = i + 1
+                    else:
+                        result.append (values[i:i+count])
+                        i = i + count
+            pos = pos + code[3]
         # word
-        if ch == 'h':
+        elif kind == 'h':
             result.append (decode_word (data[pos:pos+2]))
             pos = pos + 2
         # long
-        elif ch == 'l':
+        elif kind == 'l':
             result.append (decode_long (data[pos:pos+4]))
             pos = pos + 4
         # byte
-        elif ch == 'b':
+        elif kind == 'b':
             result.append (ord (data[pos:pos+1]))
             pos = pos + 1
         # character
-        elif ch == 'c':
+        elif kind == 'c':
             result.append (data[pos:pos+1])
             pos = pos + 1
-        # numeric argument
-        elif ch in string.digits:
-            num_digits = 0
-            while format[i] in string.digits:
-                num_digits = num_digits+1
-                i = i + 1
-            num = string.atoi (format[i-num_digits:i])
-            format_code = format[i]
-
-            sub_result, sub_len = unpack (
-                # this is cheating somewhat, should probably do
-                # it in a loop. 8^)
-                format[0] + format_code * num, data, pos
-                )
+        # multi-precision integer
+        elif kind == 'm':
+            value, length = decode_mpi (byte_order, data, pos)
+            result.append (value)
+            pos = pos + length
+        # repeated field
+        elif kind == '*':
+            count, format_code = code[1], code[2]
+            size = converter[format_code] * count
+            sub_result = data[pos:pos+size]
+            if len(sub_result) != size:
+                raise error, 'not enough data'
+            if format_code == 'h' or format_code == 'l':
+                sub_result = array.array (array_typecode[format_code], sub_result)
+                if byte_order != native_byte_order:
+                    sub_result.byteswap()
+            if compact:
+                pass
+            elif format_code == 'c':
+                sub_result = tuple (sub_result)
+            elif format_code == 'b':
+                sub_result = tuple (array.array ('B', sub_result))
+            else:
+                # (the 4-byte array type hands back longs)
+                sub_result = tuple (map (int, sub_result))
             result.append (sub_result)
-            pos = pos + sub_len
+            pos = pos + size
         # 'procfield' (used for variable-length fields)
         # a procedure is invoked to decode at this point.
-        elif ch == '[':
-            procname_end = string.find (format, ']', i+1)
-            if procname_end == -1:
-                raise error, 'no closing bracket for procedure name'
-            else:
-                procname = format[i+1:procname_end]
-            if funs.has_key(procname):
-                fun = funs[procname]
-                sub_result, length = apply (fun, (result, data, pos))
-                result.append (sub_result)
-                pos = pos + length
+        elif kind == '[':
+            fun = procs[code[1]]
+            if fun is None:
+                raise error, 'procfield function "%s" missing!' % code[2]
+            if isinstance (data, memoryview_reader):
+                data = data.tostring()
+            if profiling:
+                start = profile_clock()
+                sub_result, length = fun (result, data, pos)
+                profile_count (profile_data, 'procfield', fun, length, profile_clock() - start)
             else:
-                raise error, 'procfield function "%s" missing!' % procname
-            i = procname_end
-        # start of a bitfield
-        elif ch == '(':
-            bit_lengths = []
-            while 1:
-                if format[i] == ')':
-                    break
-                else:
-                    i = i + 1
-                num_digits = 0
-                while format[i] in string.digits:
-                    num_digits = num_digits + 1
-                    i = i + 1
-                num = string.atoi (format[i-num_digits:i])
-                bit_lengths.append (num)
-            total_bits = reduce (lambda x,y: x + y, bit_lengths)
-            if (total_bits % 8) != 0:
-                raise error, 'bitfield not a multiple of 8 bits %s' % (format)
-            bitfield_size = total_bits / 8
-            result = result + (unpack_bitfield (bit_lengths, data[pos:pos+bitfield_size]))
+                sub_result, length = fun (result, data, pos)
+            result.append (sub_result)
+            pos = pos + length
+        # bitfield
+        elif kind == '(':
+            bitfield_size = code[2]
+            result.extend (unpack_bitfield (code[1], data[pos:pos+bitfield_size]))
             pos = pos + bitfield_size
-        i = i + 1
     # return the result, and the length of parsed data
     return tuple(result), pos-offset
 
+# Repeat counts are handled with a counted loop (really, a single
+# array conversion) rather than by expanding the format string.
+# Packing accepts any sequence of the right length - a tuple, a list,
+# an array, or for 'c' and 'b' a string.  When unpacking, a 'compact'
+# Struct returns repeated 'c' and 'b' fields as a string and repeated
+# 'h' and 'l' fields as an array.array instead of a tuple of numbers.
+
+def pack_repeat (byte_order, count, format_code, value):
+    if len(value) != count:
+        raise error, 'wrong number of repeated values'
+    if format_code == 'c':
+        if type(value) != type(''):
+            value = string.join (value, '')
+        return value
+    elif format_code == 'b' and type(value) == type(''):
+        return value
+    typecode = array_typecode[format_code]
+    try:
+        a = array.array (typecode, value)
+    except OverflowError:
+        # out-of-range values get the same masking the encoders use
+        mask = (1L << (converter[format_code] * 8)) - 1
+        a = array.array (typecode, map (lambda x,m=mask: x & m, value))
+    if byte_order != native_byte_order:
+        a.byteswap()
+    return a.tostring()
+
+class Struct:
+
+    "a format string compiled for repeated use, with its procfields bound to <funs>"
+
+    def __init__ (self, format, funs={}, compact=0):
+        self.format = format
+        self.compact = compact
+        (self.byte_order,
+         self.codes,
+         self.procnames,
+         self.size) = parse_format (format)
+        self.variable = variable_format (self.codes)
+        self.decode_codes = delegate_codes (self.byte_order, self.codes, compact)
+        self.funs = funs
+        self.procs = get_procs (self.procnames, funs)
+
+    def __repr__ (self):
+        return '<npstruct.Struct %s>' % repr(self.format)
+
+    def pack (self, args):
+        return pack_codes (self.byte_order, self.codes, self.procs, self.size, args)
+
+    def unpack (self, data, offset=0):
+        return unpack_codes (
+            self.byte_order, self.decode_codes, self.procs, data, offset, self.compact
+            )
+
+    unpack_from = unpack
+
+    def pack_into (self, buffer, offset, args):
+        return write_buffer (buffer, offset, self.pack (args))
+
+    def iter_unpack (self, source, offset=0):
+        if readable (source):
+            return iter_buffer (self, as_buffer (source), offset)
+        elif self.variable or not self.size:
+            raise error, 'reading from a file or chunks needs a fixed-size format'
+        elif hasattr (source, 'read'):
+            return iter_chunks (self, iter_file (source, self.size), offset)
+        else:
+            return iter_chunks (self, iter (source), offset)
+
+# ---------------------------------------------------------------------------
+# buffers
+# ---------------------------------------------------------------------------
+# unpack works on anything that indexes and slices like a string.
+# Other buffer objects (bytearray, mmap, array) are wrapped in a
+# read-only buffer(), which doesn't copy them; only the slices the
+# fields are decoded from are copied.  A memoryview can't be wrapped
+# that way, so procfields, which are always handed a string or a
+# buffer(), get a copy of it (made once, and only if they're called).
+
+class memoryview_reader:
+
+    "index and slice a memoryview like a string"
+
+    def __init__ (self, view):
+        self.view = view
+        self.string = None
+
+    def tostring (self):
+        if self.string is None:
+            self.string = self.view.tobytes()
+        return self.string
+
+    def __len__ (self):
+        return len(self.view)
+
+    def __getitem__ (self, index):
+        return self.view[index]
+
+    def __getslice__ (self, start, end):
+        return self.view[start:end].tobytes()
+
+def readable (data):
+    if type(data) == type('') or isinstance (data, memoryview):
+        return 1
+    try:
+        buffer (data)
+    except TypeError:
+        return 0
+    else:
+        return 1
+
+def as_string (data):
+    if type(data) == type(''):
+        return data
+    elif isinstance (data, memoryview):
+        return data.tobytes()
+    else:
+        return str (buffer (data))
+
+def as_buffer (data):
+    if type(data) == type(''):
+        return data
+    elif isinstance (data, memoryview):
+        return memoryview_reader (data)
+    else:
+        try:
+            return buffer (data)
+        except TypeError:
+            return data
+
+def write_buffer (buffer, offset, data):
+    # the pure-python engine packs into a string first, then writes
+    # that into <buffer> in one go.
+    if offset < 0 or offset + len(data) > len(buffer):
+        raise error, 'not enough room in buffer for pack'
+    if isinstance (buffer, array.array):
+        if buffer.itemsize != 1:
+            raise error, 'pack_into needs a buffer of bytes'
+        data = array.array (buffer.typecode, data)
+    elif numpy is not None and isinstance (buffer, numpy.ndarray):
+        data = numpy.frombuffer (data, buffer.dtype)
+    buffer[offset:offset+len(data)] = data
+    return len(data)
+
+def compile (format, funs={}, compact=0):
+    return Struct (format, funs, compact)
+
+def pack (format, args, funs={}):
+    byte_order, codes, procnames, size = parse_format (format)
+    return pack_codes (byte_order, codes, get_procs (procnames, funs), size, args)
+
+def unpack (format, data, offset=0, funs={}):
+    byte_order, codes, procnames, size = parse_unpack_format (format)
+    return unpack_codes (byte_order, codes, get_procs (procnames, funs), data, offset)
+
+# pack_into (format, buffer, offset, args) packs into any writable
+# buffer (bytearray, memoryview, mmap, array of bytes), returning the
+# number of bytes written.  unpack_from (format, buffer, offset)
+# unpacks from any readable one without copying it.
+
+def pack_into (format, buffer, offset, args, funs={}):
+    return write_buffer (buffer, offset, pack (format, args, funs))
+
+unpack_from = unpack
+
+# ---------------------------------------------------------------------------
+# iter_unpack (format, source, offset) iterates over records packed
+# back-to-back.  <source> is a buffer, read in place, or a file object
+# or an iterator of chunks (strings), which are only supported for
+# fixed-size formats.  Only the unread tail of a chunk is carried over
+# to the next one, so a large file is never read in all at once.
+# ---------------------------------------------------------------------------
+
+def iter_buffer (struct, data, pos):
+    end = len(data)
+    while pos < end:
+        if not struct.variable and pos + struct.size > end:
+            raise error, 'not enough data'
+        result, length = struct.unpack (data, pos)
+        if not length:
+            # we'd go around forever
+            raise error, 'record has zero length'
+        pos = pos + length
+        yield result
+
+def iter_file (file, size):
+    # read a good number of whole records at a time
+    size = size * ((65536 / size) + 1)
+    while 1:
+        chunk = file.read (size)
+        if not chunk:
+            break
+        yield chunk
+
+def iter_chunks (struct, chunks, pos):
+    size = struct.size
+    pending = ''
+    for chunk in chunks:
+        chunk = as_string (chunk)
+        if pos >= len(pending):
+            # nothing left over (or still skipping the initial offset)
+            pos = pos - len(pending)
+            pending = chunk
+        else:
+            pending = pending[pos:] + chunk
+            pos = 0
+        while pos + size <= len(pending):
+            yield struct.unpack (pending, pos)[0]
+            pos = pos + size
+    if pos < len(pending):
+        raise error, 'not enough data'
+
+def iter_unpack (format, source, offset=0, funs={}):
+    return Struct (format, funs).iter_unpack (source, offset)
+
+# ---------------------------------------------------------------------------
+# numpy arrays
+# ---------------------------------------------------------------------------
+# unpack_array (format, data, count, offset) decodes <count> records
+# of a fixed-size format in one go, into a numpy record array with a
+# field per format code.  A repeat count is a single field of that
+# shape (a string, for 'c'), and each bit length of a bitfield gets a
+# field of its own, cut out of the whole column at once.  Fields are
+# named 'f0', 'f1', ... unless <names> are given.  Without bitfields
+# the result is a view of <data>, not a copy.  pack_array does the
+# reverse, from a record array or a dict of columns.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+numpy_typecode = {'b':'u1', 'c':'S1', 'h':'u2', 'l':'u4'}
+
+def bit_typecode (length):
+    if length <= 8:
+        return 'u1'
+    elif length <= 16:
+        return 'u2'
+    elif length <= 32:
+        return 'u4'
+    else:
+        return 'u8'
+
+def array_layout (format, names=None):
+    # returns the dtype of a packed record, the dtype of the decoded
+    # fields, a list of (raw_name, [(name, bit_length), ...]) for the
+    # bitfields, and the size of a record.
+    if numpy is None:
+        raise error, 'numpy is not available'
+    byte_order, codes, procnames, size = parse_format (format)
+    if variable_format (codes):
+        raise error, 'numpy arrays need a fixed-size format'
+    if byte_order == 'L':
+        order = '<'
+    else:
+        order = '>'
+    num_fields = 0
+    for code in codes:
+        if code[0] == '(':
+            num_fields = num_fields + len(code[1])
+        else:
+            num_fields = num_fields + 1
+    if names is None:
+        names = map (lambda i: 'f%d' % i, range (num_fields))
+    elif len(names) != num_fields:
+        raise error, 'format has %d fields, got %d names' % (num_fields, len(names))
+    raw = []
+    fields = []
+    bitfields = []
+    i = 0
+    for code in codes:
+        if code[0] == '(':
+            bit_lengths, width = code[1], code[2]
+            if width > 8:
+                raise error, 'bitfield too wide for a numpy array'
+            raw_name = 'bitfield %d' % len(bitfields)
+            raw.append ((raw_name, 'u1', (width,)))
+            columns = []
+            for length in bit_lengths:
+                fields.append ((names[i], bit_typecode (length)))
+                columns.append ((names[i], length))
+                i = i + 1
+            bitfields.append ((raw_name, columns))
+        else:
+            if code[0] == '*' and code[2] == 'c':
+                field = (names[i], 'S%d' % code[1])
+            elif code[0] == '*':
+                field = (names[i], order + numpy_typecode[code[2]], (code[1],))
+            else:
+                field = (names[i], order + numpy_typecode[code[0]])
+            raw.append (field)
+            fields.append (field)
+            i = i + 1
+    return numpy.dtype (raw), numpy.dtype (fields), bitfields, size
+
+def unpack_array (format, data, count=None, offset=0, names=None):
+    raw, fields, bitfields, size = array_layout (format, names)
+    if count is None:
+        count, extra = divmod (len(data) - offset, size)
+        if extra:
+            raise error, 'not enough data'
+    elif offset + count * size > len(data):
+        raise error, 'not enough data'
+    records = numpy.frombuffer (data, raw, count, offset)
+    if not bitfields:
+        return records
+    result = numpy.empty (count, fields)
+    for name in fields.names:
+        if name in raw.names:
+            result[name] = records[name]
+    for raw_name, columns in bitfields:
+        # gather the bytes MSB first, then shift and mask each field out
+        bytes = records[raw_name]
+        value = numpy.zeros (count, numpy.uint64)
+        for i in range (bytes.shape[1]):
+            value = (value << numpy.uint64 (8)) | bytes[:, i]
+        shift = bytes.shape[1] * 8
+        for name, length in columns:
+            shift = shift - length
+            mask = numpy.uint64 ((1L << length) - 1)
+            result[name] = (value >> numpy.uint64 (shift)) & mask
+    return result
+
+def pack_array (format, records, names=None):
+    raw, fields, bitfields, size = array_layout (format, names)
+    count = len (records[fields.names[0]])
+    result = numpy.zeros (count, raw)
+    for name in fields.names:
+        if name in raw.names:
+            result[name] = records[name]
+    for raw_name, columns in bitfields:
+        value = numpy.zeros (count, numpy.uint64)
+        for name, length in columns:
+            mask = numpy.uint64 ((1L << length) - 1)
+            column = numpy.asarray (records[name]).astype (numpy.uint64)
+            value = (value << numpy.uint64 (length)) | (column & mask)
+        bytes = result[raw_name]
+        for i in range (bytes.shape[1]-1, -1, -1):
+            bytes[:, i] = value & numpy.uint64 (0xff)
+            value = value >> numpy.uint64 (8)
+    return result.tostring()
+
 #
 # To my mind, there should never be a question of what order
 # to read bits in.  They should be read MSB to LSB, and interpreted
@@ -235,59 +858,334 @@ def unpack (format, data, offset=0, funs={}):
 # reference.  It may be necessary to reverse the list of bitfields!
 #
 
+# The bit streams read and write fields of any width at any bit
+# position.  Bits go MSB first unless <lsb_first> is set, in which
+# case each byte is used from its least significant bit up, and the
+# first bit is the least significant bit of the field (as in GIF's
+# LZW codes).  A field is pulled out of (or pushed into) the bytes
+# around it as one number, not a bit at a time.  The reader works on
+# any buffer without copying it.
+
 class bit_stream_reader:
-    def __init__ (self, data, byte_pos=0, bit_pos=0):
-        self.data = data
-        self.byte_pos = byte_pos
-        self.bit_pos = bit_pos
+    def __init__ (self, data, byte_pos=0, bit_pos=0, lsb_first=0):
+        self.data = as_buffer (data)
+        self.pos = byte_pos * 8 + bit_pos
+        self.lsb_first = lsb_first
+        self.length = len(self.data) * 8
+        if not 0 <= self.pos <= self.length:
+            raise error, 'position out of range'
 
-    def next_bit (self):
-        byte = ord(self.data[self.byte_pos])
-        result = (byte & (1<< (7-self.bit_pos)) and 1)
-        self.bit_pos = self.bit_pos + 1
-        if self.bit_pos == 8:
-            self.bit_pos = 0
-            self.byte_pos = self.byte_pos + 1
-        return result
+    def __getattr__ (self, name):
+        # the position used to be kept as these two
+        if name == 'byte_pos':
+            return self.pos >> 3
+        elif name == 'bit_pos':
+            return self.pos & 7
+        else:
+            raise AttributeError, name
 
-    def read_bits (self, num_bits):
+    def peek_bits (self, num_bits):
         # [76543210][76543210][76543210][76543210][76543210]
-        #    bit_pos---^ (== 2)
-        # byte_pos--^ (== 1)
+        #    pos -------^ (== 10)
+        if num_bits < 0:
+            raise error, 'negative number of bits'
+        end = self.pos + num_bits
+        if end > self.length:
+            raise error, 'not enough data'
+        elif not num_bits:
+            return 0
+        bytes = self.data[self.pos >> 3:(end + 7) >> 3]
         r = 0
-        for i in range(num_bits):
-            bit = self.next_bit()
-            r = r << 1
-            if bit:
-                r = r + 1
+        if self.lsb_first:
+            for i in range (len(bytes)-1, -1, -1):
+                r = (r << 8) | ord (bytes[i])
+            r = r >> (self.pos & 7)
+        else:
+            for ch in bytes:
+                r = (r << 8) | ord (ch)
+            r = r >> ((8 - (end & 7)) & 7)
+        return r & ((1 << num_bits) - 1)
+
+    def read_bits (self, num_bits):
+        r = self.peek_bits (num_bits)
+        self.pos = self.pos + num_bits
         return r
 
+    def read_many (self, num_bits, count):
+        if num_bits * count > self.length - self.pos:
+            raise error, 'not enough data'
+        return map (self.read_bits, [num_bits] * count)
+
+    def next_bit (self):
+        return self.read_bits (1)
+
+    def skip_bits (self, num_bits):
+        if not (0 <= self.pos + num_bits <= self.length):
+            raise error, 'skip out of range'
+        self.pos = self.pos + num_bits
+
+    def align (self):
+        # skip to the next byte boundary
+        self.pos = min ((self.pos + 7) & ~7, self.length)
+
+    def tell (self):
+        return self.pos
+
+    def bits_left (self):
+        return self.length - self.pos
+
 class bit_stream_writer:
-    def __init__ (self):
-        self.bit_pos = 0
+    def __init__ (self, lsb_first=0):
+        self.lsb_first = lsb_first
+        self.pos = 0
+        # whole bytes written, and the bits of the one after them
+        self.bytes = []
         self.byte = 0
-        self.result = ''
 
     def write_bits (self, number, num_bits):
-        if number >= (1L << num_bits):
+        if number < 0 or number >= (1L << num_bits):
             raise error, 'number too big for specified number of bits'
-        while num_bits:
-            if self.bit_pos == 8:
-                # start a new output byte
-                self.result = self.result + chr(self.byte)
-                self.byte = 0
-                self.bit_pos = 0
-            num_bits = num_bits - 1
-            self.byte = self.byte << 1
-            if number & (1<<num_bits):
-                self.byte = self.byte | 1
-            self.bit_pos = self.bit_pos + 1
-
-    def done (self):
-        if self.bit_pos != 8:
+        used = self.pos & 7
+        if self.lsb_first:
+            r = self.byte | (number << used)
+        else:
+            r = (self.byte << num_bits) | number
+        whole = (used + num_bits) >> 3
+        left = (used + num_bits) & 7
+        if self.lsb_first:
+            for i in range (whole):
+                self.bytes.append (chr (r & 0xff))
+                r = r >> 8
+        else:
+            for i in range (whole-1, -1, -1):
+                self.bytes.append (chr ((r >> (left + i * 8)) & 0xff))
+            r = r & ((1 << left) - 1)
+        self.byte = r
+        self.pos = self.pos + num_bits
+
+    def done (self, pad=0):
+        # unless <pad> is true, the stream has to end on a byte boundary
+        left = self.pos & 7
+        if left and not pad:
             raise error, "didn't finish on a byte boundary!"
-        self.result = self.result + chr(self.byte)
-        return self.result
+        result = string.join (self.bytes, '')
+        if left and self.lsb_first:
+            result = result + chr (self.byte)
+        elif left:
+            result = result + chr (self.byte << (8 - left))
+        return result
+
+    def tell (self):
+        return self.pos
+
+# ---------------------------------------------------------------------------
+# GIF LZW
+# ---------------------------------------------------------------------------
+# lzw_decode (data, offset, code_size, out, width, interlace) decodes
+# the GIF image data sub-blocks at data[offset:] into the writable
+# buffer <out> (a bytearray, a numpy array of bytes...), putting
+# interlaced rows of <width> pixels back in order.  It returns the
+# number of pixels written, and the number of bytes of <data> used,
+# through the terminating empty sub-block.  Like the C module's, it
+# reads codes straight out of the sub-blocks rather than joining them
+# into a string first, and writes each row as it fills.  lzw_encode
+# does the reverse, returning the sub-blocks and terminator.
+
+lzw_max_codes = 4096
+
+def interlace_rows (height, interlace):
+    # the destination row of each row, in the order they're stored
+    if not interlace:
+        return range (height)
+    rows = []
+    for start, step in ((0, 8), (4, 8), (2, 4), (1, 2)):
+        rows.extend (range (start, height, step))
+    return rows
+
+def skip_sub_blocks (data, pos):
+    # hop over the sub-blocks at data[pos:] looking only at their size
+    # bytes; returns (blocks, bytes of payload, position just past the
+    # terminator)
+    count = length = 0
+    while 1:
+        if pos >= len(data):
+            raise error, 'truncated data blocks'
+        size = ord (data[pos])
+        pos = pos + 1 + size
+        if not size:
+            break
+        count = count + 1
+        length = length + size
+    if pos > len(data):
+        raise error, 'truncated data blocks'
+    return count, length, pos
+
+class lzw_input:
+
+    # reads codes straight out of the sub-blocks of <data>, starting
+    # with the size byte at <pos>, without joining them together
+
+    def __init__ (self, data, pos):
+        self.data = data
+        self.pos = pos
+        self.block_left = 0
+        self.done = 0
+        self.bits = 0
+        self.num_bits = 0
+
+    def read_code (self, size):
+        # the next <size> bits, LSB first, or None at the end of the data
+        data = self.data
+        while self.num_bits < size:
+            if not self.block_left:
+                if self.done:
+                    return None
+                elif self.pos >= len(data):
+                    raise error, 'truncated image data'
+                self.block_left = ord (data[self.pos])
+                self.pos = self.pos + 1
+                if not self.block_left:
+                    self.done = 1
+                    return None
+            if self.pos >= len(data):
+                raise error, 'truncated image data'
+            self.bits = self.bits | (ord (data[self.pos]) << self.num_bits)
+            self.pos = self.pos + 1
+            self.num_bits = self.num_bits + 8
+            self.block_left = self.block_left - 1
+        code = self.bits & ((1 << size) - 1)
+        self.bits = self.bits >> size
+        self.num_bits = self.num_bits - size
+        return code
+
+    def skip_blocks (self):
+        # skip whatever follows the end-of-information code, up to and
+        # including the terminator
+        if not self.done:
+            self.pos = skip_sub_blocks (self.data, self.pos + self.block_left)[2]
+            self.block_left = 0
+            self.done = 1
+
+def lzw_decode (data, offset, code_size, out, width=0, interlace=0):
+    if not 2 <= code_size <= 8:
+        raise error, 'bad lzw code size'
+    data = as_buffer (data)
+    if not 0 <= offset <= len(data) or width < 0:
+        raise error, 'offset out of range'
+    input = lzw_input (data, offset)
+    if not width:
+        # one long row
+        width = len(out)
+        height = len(out) and 1
+    else:
+        height = len(out) / width
+    rows = interlace_rows (height, interlace)
+    clear = 1 << code_size
+    eoi = clear + 1
+    table = map (chr, range (clear)) + [None, None]
+    size = code_size + 1
+    prev = None
+    # pixels of the current row, written out as each row fills
+    row = 0
+    pending = []
+    pending_len = 0
+    written = 0
+    while 1:
+        code = input.read_code (size)
+        if code is None or code == eoi:
+            break
+        elif code == clear:
+            table = table[:eoi+1]
+            size = code_size + 1
+            prev = None
+            continue
+        elif prev is None:
+            if code > clear:
+                raise error, 'bad lzw code'
+            entry = table[code]
+        else:
+            if code < len(table):
+                entry = table[code]
+            elif code == len(table) < lzw_max_codes:
+                entry = prev + prev[0]
+            else:
+                raise error, 'bad lzw code'
+            if len(table) < lzw_max_codes:
+                table.append (prev + entry[0])
+                if len(table) == (1 << size) and size < 12:
+                    size = size + 1
+        prev = entry
+        if row < height:
+            pending.append (entry)
+            pending_len = pending_len + len(entry)
+            while pending_len >= width and row < height:
+                pixels = string.join (pending, '')
+                write_buffer (out, rows[row] * width, pixels[:width])
+                written = written + width
+                row = row + 1
+                pending = [pixels[width:]]
+                pending_len = len(pixels) - width
+    if row < height and pending_len:
+        # a short last row
+        write_buffer (out, rows[row] * width, string.join (pending, ''))
+        written = written + pending_len
+    input.skip_blocks()
+    return written, input.pos - offset
+
+def lzw_encode (pixels, code_size, width=0, interlace=0):
+    if not 2 <= code_size <= 8:
+        raise error, 'bad lzw code size'
+    pixels = as_string (pixels)
+    if width:
+        if len(pixels) % width:
+            raise error, "image data isn't a whole number of rows"
+        rows = interlace_rows (len(pixels) / width, interlace)
+        pixels = string.join (map (lambda r,p=pixels,w=width: p[r*w:(r+1)*w], rows), '')
+    clear = 1 << code_size
+    eoi = clear + 1
+    table = {}
+    next = eoi + 1
+    size = code_size + 1
+    writer = bit_stream_writer (1)
+    writer.write_bits (clear, size)
+    cur = None
+    for ch in pixels:
+        if ord (ch) >= clear:
+            raise error, 'pixel value too big for the code size'
+        elif cur is None:
+            cur = ch
+            continue
+        if table.has_key (cur + ch):
+            cur = cur + ch
+            continue
+        writer.write_bits (table.get (cur, ord (cur[0])), size)
+        if next < lzw_max_codes:
+            table[cur + ch] = next
+            next = next + 1
+            if next > (1 << size) and size < 12:
+                size = size + 1
+        else:
+            # table full: start over
+            writer.write_bits (clear, size)
+            table = {}
+            next = eoi + 1
+            size = code_size + 1
+        cur = ch
+    if cur is not None:
+        writer.write_bits (table.get (cur, ord (cur[0])), size)
+        # the decoder adds an entry on the last code, and may widen
+        if next < lzw_max_codes:
+            next = next + 1
+            if next > (1 << size) and size < 12:
+                size = size + 1
+    writer.write_bits (eoi, size)
+    stream = writer.done (1)
+    blocks = []
+    for i in range (0, len(stream), 255):
+        block = stream[i:i+255]
+        blocks.append (chr (len (block)) + block)
+    blocks.append ('\000')
+    return string.join (blocks, '')
 
 def print_binary (num, width=8):
     result = ''
@@ -300,45 +1198,54 @@ def print_binary (num, width=8):
         width = width - 1
     return result
 
+# A bitfield is read as one big number (MSB first), and each field
+# is cut out of that with a shift and a mask, rather than a bit at a
+# time.
+
 def unpack_bitfield (bit_lengths, data):
-    br = bit_stream_reader (data)
-    result = map (lambda x,y=br: y.read_bits (x), bit_lengths)
+    if len(data) * 8 < reduce (operator.add, bit_lengths, 0):
+        raise error, 'not enough data for bitfields'
+    value = 0
+    for ch in data:
+        value = (value << 8) | ord(ch)
+    shift = len(data) * 8
+    result = []
+    for length in bit_lengths:
+        shift = shift - length
+        result.append ((value >> shift) & ((1 << length) - 1))
     return result
 
 def pack_bitfield (bit_lengths, data):
-    bw = bit_stream_writer()
-    map (bw.write_bits, data, bit_lengths)
-    return bw.done()
+    value = 0
+    total = 0
+    for i in range(len(bit_lengths)):
+        length = bit_lengths[i]
+        if data[i] >= (1 << length) or data[i] < 0:
+            raise error, 'number too big for specified number of bits'
+        value = (value << length) | data[i]
+        total = total + length
+    if total % 8:
+        raise error, "didn't finish on a byte boundary!"
+    result = []
+    for i in range(total / 8):
+        result.append (chr (value & 0xff))
+        value = value >> 8
+    result.reverse()
+    return string.join (result, '')
 
 def calcsize (format):
-    size = 0
-    i = 1
-    while i < len(format):
-        if format[i] in string.digits:
-            num_digits = 0
-            while format[i] in string.digits:
-                num_digits = num_digits+1
-                i = i + 1
-                num = string.atoi (format[i-num_digits:i])
-            format_code = format[i]
-            size = size + converter[format[i]] * num
-        elif format[i] == '(':
-            end = string.index (format, ')', i)
-            bits = reduce (lambda x,y: x+ y,
-                           map (string.atoi, string.split (format[i+1:end])))
-            if (bits % 8) != 0:
-                raise error, 'bitfield not a multiple of 8 bits %s' % (format)
-            size = size + bits/8
-            i = end
-        elif format[i] == '[':
-            # this is a variable-sized struct.  should this ignore the
-            # variable parts, or return -1 or something? [how about
-            # -s, where s is the size of the fixed part?]
-            i = string.find (format, ']', i+1)
-        else:
-            size = size + converter[format[i]]
-        i = i + 1
-    return size
+    # variable-sized fields (procfields and mpis) are ignored.  should this
+    # return -1 or something? [how about -s, where s is the size of
+    # the fixed part?]
+    return parse_format (format)[3]
+
+# ---------------------------------------------------------------------------
+# records
+# ---------------------------------------------------------------------------
+# Oracle.unpack returns a record, and Oracle.view a record_view; both
+# are in npcommon.py, which is shared with oracle.py.
+
+from npcommon import identifier, record, record_view, make_record_class, profile_entry
 
 # ---------------------------------------------------------------------------
 # an Oracle can be used to divine the contents of mysterious block
@@ -360,7 +1267,9 @@ def calcsize (format):
 #    'pixel aspect ratio'))
 # 
 # >>> logical_screen_descriptor.unpack (strange_data)
-# ({'width':100, 'height':100, 'global color table flag':1 ...}, <size_of_struct>)
+# (Logical_Screen_Descriptor(width=100, height=100, global_color_table_flag=1 ...), <size_of_struct>)
+# >>> _[0]['width'], _[0].global_color_table_flag
+# (100, 1)
 
 # 'functions' values are optionally a tuple of two functions,
 # one for unpacking, and one for packing.  Otherwise, this expects
@@ -387,7 +1296,12 @@ class Oracle:
         self.names = names
         self.functions = functions
         (self.read_functions, self.write_functions) = get_functions (functions)
-        self.size = calcsize (format)
+        self.reader = Struct (format, self.read_functions)
+        self.writer = Struct (format, self.write_functions)
+        self.size = self.reader.size
+        self.record = make_record_class (name, names)
+        self.variable = self.reader.variable
+        self.fixed_fields = self.fixed_layout()
 
     def __repr__ (self):
         return '<%s oracle>' % self.name
@@ -399,11 +1313,50 @@ class Oracle:
         return self.unpack (self.new_raw())[0]
 
     def unpack (self, data, offset=0):
-        members, length = unpack (self.format, data, offset, self.read_functions)
-        result = {}
-        for i in range(len(self.names)):
-            result[self.names[i]] = members[i]
-        return result, length
+        if profiling:
+            start = profile_clock()
+            members, length = self.reader.unpack (data, offset)
+            profile_count (profile_data, 'oracle', self, length, profile_clock() - start)
+        else:
+            members, length = self.reader.unpack (data, offset)
+        return self.record (members), length
+
+    def iter_unpack (self, data, offset=0):
+        for members in self.reader.iter_unpack (data, offset):
+            yield self.record (members)
+
+    def unpack_array (self, data, count=None, offset=0):
+        return unpack_array (self.format, data, count, offset, self.names)
+
+    def pack_array (self, records):
+        return pack_array (self.format, records, self.names)
+
+    def view (self, data, offset=0):
+        return record_view (self, data, offset)
+
+    def fixed_layout (self):
+        # {value index: (codes, position, index of its first value)}
+        # for each field in front of the first variable-sized one.
+        layout = {}
+        pos = first = 0
+        for code in self.reader.codes:
+            if code[0] == '[' or code[0] == 'm':
+                break
+            elif code[0] == '(':
+                size, num_values = code[2], len(code[1])
+            elif code[0] == '*':
+                size, num_values = converter[code[2]] * code[1], 1
+            else:
+                size, num_values = converter[code[0]], 1
+            for i in range(num_values):
+                layout[first + i] = ([code], pos, first)
+            pos = pos + size
+            first = first + num_values
+        return layout
+
+    def decode_field (self, field, data, offset):
+        codes, pos, first = field
+        return unpack_codes (self.reader.byte_order, codes, [], data, offset + pos)[0]
 
     def procfield_function (self, results, data, offset):
         return self.unpack (data, offset)
@@ -415,8 +1368,10 @@ class Oracle:
         return self.pack (dict)
 
     def pack (self, dict):
-        members = map (lambda x,d=dict: d[x], self.names)
-        return pack (self.format, members, self.write_functions)
+        # a record is already in field order
+        if not isinstance (dict, self.record):
+            dict = map (lambda x,d=dict: d[x], self.names)
+        return self.writer.pack (dict)
 
     def describe (self, dict):
         print '%s:' % self.name
@@ -433,6 +1388,24 @@ def test_procfield ():
     data = '\001\005abcde\000\004\313/'
     print unpack (format, data, 0, {'read_pascal_string':read_pascal_string})
 
+def test_procfield_buffers ():
+    # the procfield gets a string or a read-only buffer, whatever
+    # the data came in
+    def read_pascal_string (result, data, pos):
+        assert type(data) in (type(''), type(buffer(''))), type(data)
+        length = ord(data[pos])
+        return str (buffer (data, pos+1, length)), 1+length
+
+    format = 'Bb[read_pascal_string]l'
+    data = '\001\005abcde\000\004\313/'
+    funs = {'read_pascal_string':read_pascal_string}
+    expected = unpack (format, data, 0, funs)
+    for source in (memoryview (data), bytearray (data)):
+        result = unpack_from (format, source, 0, funs)
+        assert result == expected, result
+        assert list (iter_unpack (format, source, 0, funs)) == [expected[0]]
+        print type(source).__name__, result
+
 def test_oracle_with_procfield():
     def read_pascal_string (result, data, pos):
         length = ord(data[pos])
@@ -6,6 +6,8 @@
  */
 
 #include "Python.h"
+#include "structmember.h"
+#include <time.h>
 
 #define LITTLE_ENCODE_WORD(x,s)                 \
   do {                                          \
@@ -199,159 +201,3366 @@
 
 static int endian = 0;          /* 0 == little; 1 == big */
 
+/* ------------------------------------------------------------------
+ * compiled formats
+ *
+ * A format string is scanned once into an array of field ops.
+ * pack() and unpack() walk the ops instead of re-parsing the
+ * string, the multipliers and the bitfield descriptions (and
+ * re-fetching procfield functions) on every call.
+ * ------------------------------------------------------------------ */
+
+typedef struct {
+  char code;            /* format character */
+  int count;            /* multiplier, -1 if none */
+  int size;             /* bytes per field (0 for procfields) */
+  int num_bits;         /* bitfield: number of fields */
+  int * bits;           /* bitfield: field widths */
+  int * bit_shifts;     /* bitfield: bits to the right of each field */
+  unsigned PY_LONG_LONG * bit_masks;  /* bitfield: (1<<width)-1 */
+  int bit_bytes;        /* bitfield: total width in bytes */
+  PyObject * name;      /* procfield: function name */
+  PyObject * fun;       /* procfield: function, if bound at compile time */
+} field_op;
+
+typedef struct {
+  PyObject_HEAD
+  PyObject * format;
+  PyObject * functions;
+  char byte_order;
+  int num_ops;
+  field_op * ops;
+  int size;             /* total size of the fixed-length fields */
+  int native_size;      /* size of a record in native form */
+  int compact;          /* unpack repeated numbers into strings/arrays */
+  int variable;         /* has procfields or mpis, so no fixed record size */
+  int procfields;       /* has procfields, which are handed the data itself */
+  long tick;            /* last use, for the format cache */
+} Struct_object;
+
+static PyTypeObject Struct_Type;
+
+static void
+Struct_dealloc (Struct_object * self)
+{
+  int i;
+  for (i=0; i < self->num_ops; i++) {
+    field_op * op = &self->ops[i];
+    Py_XDECREF (op->name);
+    Py_XDECREF (op->fun);
+    if (op->bits) {
+      PyMem_Free (op->bits);
+    }
+    if (op->bit_shifts) {
+      PyMem_Free (op->bit_shifts);
+    }
+    if (op->bit_masks) {
+      PyMem_Free (op->bit_masks);
+    }
+  }
+  if (self->ops) {
+    PyMem_Free (self->ops);
+  }
+  Py_XDECREF (self->format);
+  Py_XDECREF (self->functions);
+  PyObject_Del (self);
+}
+
+/* parse '(1 3 1 3)' starting just past the open paren, and work out
+ * the shift and mask that cut each field out of the whole bitfield.
+ * returns the format position just past the close paren, or -1 */
+
 static int
-get_bit_length_list (PyObject * bit_lengths, char * format, int pos)
+parse_bit_lengths (field_op * op, char * format, int format_len, int pos)
 {
-  char ch;
   int num = 0;
-  int flag = 1;
+  int total_bits = 0;
+  int i;
 
-  while (flag) {
-    ch = format[pos++];
-    switch (ch) {
-    case '\000':
-      PyErr_SetString (PyExc_ValueError, "unterminated bitfield description");
+  /* one field per space, plus one */
+  op->num_bits = 1;
+  for (i=pos; (i < format_len) && (format[i] != ')'); i++) {
+    if (format[i] == ' ') {
+      op->num_bits++;
+    }
+  }
+  if (i == format_len) {
+    PyErr_SetString (PyExc_ValueError, "unterminated bitfield description");
+    return -1;
+  }
+  op->bits = (int *) PyMem_Malloc (op->num_bits * sizeof(int));
+  op->bit_shifts = (int *) PyMem_Malloc (op->num_bits * sizeof(int));
+  op->bit_masks = (unsigned PY_LONG_LONG *) PyMem_Malloc (op->num_bits * sizeof(unsigned PY_LONG_LONG));
+  if ((!op->bits) || (!op->bit_shifts) || (!op->bit_masks)) {
+    PyErr_NoMemory();
+    return -1;
+  }
+  i = 0;
+  while (1) {
+    char ch = format[pos++];
+    if (ch == ')') {
+      op->bits[i++] = num;
+      total_bits += num;
+      break;
+    } else if (ch == ' ') {
+      op->bits[i++] = num;
+      total_bits += num;
+      num = 0;
+    } else if ((ch >= '0') && (ch <= '9')) {
+      num = (num * 10) + (ch-'0');
+    } else {
+      PyErr_SetString (PyExc_ValueError, "bogus character in bitfield description");
       return -1;
+    }
+  }
+  if ((total_bits % 8) != 0) {
+    PyErr_SetString (PyExc_ValueError, "bitfields not octet-aligned");
+    return -1;
+  }
+  op->bit_bytes = total_bits / 8;
+  for (i=0; i < op->num_bits; i++) {
+    int num_bits = op->bits[i];
+    if (num_bits > 64) {
+      PyErr_SetString (PyExc_ValueError, "bitfield wider than 64 bits");
+      return -1;
+    }
+    total_bits -= num_bits;
+    op->bit_shifts[i] = total_bits;
+    op->bit_masks[i] = (num_bits == 64) ? ~((unsigned PY_LONG_LONG) 0) : ((((unsigned PY_LONG_LONG) 1) << num_bits) - 1);
+  }
+  return pos;
+}
+
+static int
+native_bit_size (int num_bits)
+{
+  if (num_bits <= 8) {
+    return 1;
+  } else if (num_bits <= 16) {
+    return 2;
+  } else if (num_bits <= 32) {
+    return 4;
+  } else {
+    return 8;
+  }
+}
+
+/* the size of one (unrepeated) field of <op> in native form
+ * (see 'native conversion', below) */
+
+static int
+native_op_size (field_op * op)
+{
+  int i, size = 0;
+
+  switch (op->code) {
+  case 'x': case '[': case 'm':
+    return 0;
+  case '(':
+    for (i=0; i < op->num_bits; i++) {
+      size += native_bit_size (op->bits[i]);
+    }
+    return size;
+  default:
+    return op->size;
+  }
+}
+
+static Struct_object *
+compile_format (char * format, int format_len, PyObject * functions, int compact)
+{
+  Struct_object * self;
+  char ch;
+  int num = -1;         /* the repeat count, or -1 for none */
+  int i;
+
+  if (format_len == 0) {
+    PyErr_SetString (PyExc_ValueError, "empty format");
+    return NULL;
+  }
+  self = PyObject_New (Struct_object, &Struct_Type);
+  if (!self) {
+    return NULL;
+  }
+  self->format = PyString_FromStringAndSize (format, format_len);
+  self->functions = functions;
+  Py_XINCREF (functions);
+  self->num_ops = 0;
+  self->size = 0;
+  self->native_size = 0;
+  self->compact = compact;
+  self->variable = 0;
+  self->procfields = 0;
+  self->tick = 0;
+  /* can't have more ops than format characters */
+  self->ops = (field_op *) PyMem_Malloc ((format_len + 1) * sizeof(field_op));
+  if ((!self->format) || (!self->ops)) {
+    if (!self->ops) {
+      PyErr_NoMemory();
+    }
+    Py_DECREF (self);
+    return NULL;
+  }
+  memset (self->ops, 0, (format_len + 1) * sizeof(field_op));
+
+  /* check for a specified byte order */
+  switch (format[0]) {
+  case 'L':
+  case 'B':
+    self->byte_order = format[0];
+    i = 1;
+    break;
+  case 'N':
+    /* Native byte order */
+    /* <endian> is computed when this module is initialized */
+    self->byte_order = endian ? 'B' : 'L';
+    i = 1;
+    break;
+  default:
+    /* default to native if not specified */
+    self->byte_order = endian ? 'B' : 'L';
+    i = 0;
+    break;
+  }
+
+  while (i < format_len) {
+    char * spec_start = format+i;
+    int spec_len = 1;
+    field_op * op;
+
+    ch = format[i];
+    if ((ch >= '0') && (ch <= '9')) {
+      num = ((num < 0) ? 0 : (num * 10)) + (ch - '0');
+      i++;
+      continue;
+    }
+
+    /* how much of the format does this field cover? */
+    if ((ch == '(') || (ch == '[')) {
+      char * eos = memchr (spec_start, (ch == '(') ? ')' : ']', format_len - i);
+      if (!eos) {
+        PyErr_SetString (
+          PyExc_ValueError,
+          (ch == '(') ? "unterminated bit field" : "unterminated user function name"
+          );
+        Py_DECREF (self);
+        return NULL;
+      }
+      spec_len = (eos-spec_start) + 1;
+    }
+
+    op = &self->ops[self->num_ops++];
+    op->code = ch;
+
+    switch (ch) {
+    case 'b': case 'c': case 'x':
+      op->size = 1;
       break;
-    case ')':
-      PyList_Append (bit_lengths, PyInt_FromLong (num));
-      flag = 0;
+    case 'h':
+      op->size = 2;
       break;
-    case ' ':
-      PyList_Append (bit_lengths, PyInt_FromLong (num));
-      num = 0;
+    case 'l': case 'f':
+      op->size = 4;
       break;
-    default: {
-        if ((ch >= '0') && (ch <= '9')) {
-          num = (num * 10) + (ch-'0');
-        } else {
-          PyErr_SetString (PyExc_ValueError, "bogus character in bitfield description");
-          Py_DECREF (bit_lengths);
-          return -1;
+    case 'd':
+      op->size = 8;
+      break;
+    case '(':
+      if (num >= 0) {
+        PyErr_SetString (PyExc_ValueError, "bitfields can't be repeated");
+        Py_DECREF (self);
+        return NULL;
+      }
+      if (parse_bit_lengths (op, format, format_len, i+1) == -1) {
+        Py_DECREF (self);
+        return NULL;
+      }
+      op->size = op->bit_bytes;
+      break;
+    case 'm':
+      /* variable-length: not counted in the size */
+      if (num >= 0) {
+        PyErr_SetString (PyExc_ValueError, "mpis can't be repeated");
+        Py_DECREF (self);
+        return NULL;
+      }
+      self->variable = 1;
+      break;
+    case '[':
+      /* variable-length: not counted in the size */
+      if (num >= 0) {
+        PyErr_SetString (PyExc_ValueError, "user functions can't be repeated");
+        Py_DECREF (self);
+        return NULL;
+      }
+      self->variable = 1;
+      self->procfields = 1;
+      op->name = PyString_FromStringAndSize (spec_start+1, spec_len-2);
+      if (!op->name) {
+        Py_DECREF (self);
+        return NULL;
+      }
+      if (functions) {
+        op->fun = PyDict_GetItem (functions, op->name);
+        Py_XINCREF (op->fun);
+      }
+      break;
+    default:
+      PyErr_SetString (PyExc_ValueError, "unknown format character");
+      Py_DECREF (self);
+      return NULL;
+    }
+    /* a multiplier ('8b', or even '0b') is kept as a count on the op */
+    op->count = num;
+    self->size += op->size * ((num < 0) ? 1 : num);
+    self->native_size += native_op_size (op) * ((num < 0) ? 1 : num);
+    num = -1;
+    i += spec_len;
+  }
+  if (num >= 0) {
+    PyErr_SetString (PyExc_ValueError, "repeat count without a field");
+    Py_DECREF (self);
+    return NULL;
+  }
+  return self;
+}
+
+/* find the procfield function for <op>, either bound at compile time
+ * or looked up in the <functions> dict passed to pack/unpack */
+
+static PyObject *
+get_function (field_op * op, PyObject * functions)
+{
+  PyObject * fun = op->fun;
+  if ((!fun) && functions) {
+    fun = PyDict_GetItem (functions, op->name);
+  }
+  if (!fun) {
+    PyErr_SetString (PyExc_ValueError, "unknown user function");
+    return NULL;
+  } else if (!PyCallable_Check (fun)) {
+    PyErr_SetString (PyExc_ValueError, "not a callable function");
+    return NULL;
+  } else {
+    return fun;
+  }
+}
+
+/* ------------------------------------------------------------------
+ * profiling
+ *
+ * While <profiling> is set (by set_profiling()), each procfield call
+ * made by unpack is counted in <profile_data>, a dict of
+ *   (kind, function) -> (calls, bytes consumed, seconds)
+ * Otherwise the only cost is the test of the flag.
+ * ------------------------------------------------------------------ */
+
+static int profiling = 0;
+static PyObject * profile_data = NULL;
+
+static double
+profile_clock (void)
+{
+  return (double) clock() / CLOCKS_PER_SEC;
+}
+
+static int
+profile_count (char * kind, PyObject * object, Py_ssize_t bytes, double seconds)
+{
+  PyObject * key = Py_BuildValue ("(sO)", kind, object);
+  PyObject * counts;
+  Py_ssize_t calls = 0;
+  PY_LONG_LONG total_bytes = 0;
+  double total_seconds = 0.0;
+  int status;
+
+  if (!key) {
+    return -1;
+  }
+  counts = PyDict_GetItem (profile_data, key);
+  if (counts && !PyArg_ParseTuple (counts, "nLd", &calls, &total_bytes, &total_seconds)) {
+    Py_DECREF (key);
+    return -1;
+  }
+  counts = Py_BuildValue ("nLd", calls + 1, total_bytes + bytes, total_seconds + seconds);
+  if (!counts) {
+    Py_DECREF (key);
+    return -1;
+  }
+  status = PyDict_SetItem (profile_data, key, counts);
+  Py_DECREF (key);
+  Py_DECREF (counts);
+  return status;
+}
+
+/* ------------------------------------------------------------------
+ * multi-precision integers ('m')
+ *
+ * A word holding the number of bits, then just enough bytes to hold
+ * them, most significant first (or least, with 'L'), as in PGP.  The
+ * digits are converted to and from a long in one go.
+ * ------------------------------------------------------------------ */
+
+static PyObject *
+decode_mpi (char byte_order, unsigned char * data, int data_len, int * data_pos_ptr)
+{
+  int pos = *data_pos_ptr;
+  unsigned int bits = 0;
+  int size;
+  PyObject * value;
+
+  if ((pos + 2) > data_len) {
+    PyErr_SetString (PyExc_ValueError, "not enough data");
+    return NULL;
+  }
+  switch (byte_order) {
+  case 'L':
+    LITTLE_DECODE_WORD (bits, data+pos);
+    break;
+  case 'B':
+    BIG_DECODE_WORD (bits, data+pos);
+    break;
+  }
+  size = (bits + 7) / 8;
+  if ((pos + 2 + size) > data_len) {
+    PyErr_SetString (PyExc_ValueError, "not enough data");
+    return NULL;
+  }
+  value = _PyLong_FromByteArray (data+pos+2, size, (byte_order == 'L'), 0);
+  if (value) {
+    *data_pos_ptr = pos + 2 + size;
+  }
+  return value;
+}
+
+/* the number of bytes <value> takes as an mpi, or -1 */
+
+static int
+mpi_size (PyObject * number, size_t * bits_ptr)
+{
+  size_t bits;
+
+  if (_PyLong_Sign (number) < 0) {
+    PyErr_SetString (PyExc_ValueError, "negative number in mpi");
+    return -1;
+  }
+  bits = _PyLong_NumBits (number);
+  if ((bits == (size_t) -1) && PyErr_Occurred()) {
+    return -1;
+  } else if (bits > 0xffff) {
+    PyErr_SetString (PyExc_ValueError, "number too big for an mpi");
+    return -1;
+  }
+  *bits_ptr = bits;
+  return 2 + (int) ((bits + 7) / 8);
+}
+
+/* ------------------------------------------------------------------
+ * packing
+ *
+ * Output goes straight into a string preallocated to the fixed size
+ * of the format (Struct.size); only procfield output can make it
+ * grow, and then it doubles, so packing is linear in the output.
+ * pack_into() writes into the caller's buffer instead, which can't
+ * grow.
+ * ------------------------------------------------------------------ */
+
+typedef struct {
+  PyObject * string;    /* the output string, NULL for pack_into */
+  unsigned char * data; /* its contents */
+  int pos;              /* write position */
+  int len;              /* allocated length */
+} pack_buffer;
+
+static int
+pack_buffer_init (pack_buffer * buf, int size)
+{
+  /* (a zero-length string would be the shared empty string) */
+  buf->string = PyString_FromStringAndSize (NULL, size ? size : 1);
+  if (!buf->string) {
+    return -1;
+  }
+  buf->data = (unsigned char *) PyString_AS_STRING (buf->string);
+  buf->pos = 0;
+  buf->len = size ? size : 1;
+  return 0;
+}
+
+/* make sure there's room for <n> more bytes */
+
+static int
+pack_buffer_room (pack_buffer * buf, int n)
+{
+  if ((buf->pos + n) > buf->len) {
+    int new_len = buf->len * 2;
+    if (!buf->string) {
+      PyErr_SetString (PyExc_ValueError, "not enough room in buffer for pack");
+      return -1;
+    }
+    if (new_len < (buf->pos + n)) {
+      new_len = buf->pos + n;
+    }
+    if (_PyString_Resize (&buf->string, new_len) == -1) {
+      return -1;
+    }
+    buf->data = (unsigned char *) PyString_AS_STRING (buf->string);
+    buf->len = new_len;
+  }
+  return 0;
+}
+
+static PyObject *
+pack_buffer_finish (pack_buffer * buf)
+{
+  if ((buf->pos != buf->len) && (_PyString_Resize (&buf->string, buf->pos) == -1)) {
+    return NULL;
+  }
+  return buf->string;
+}
+
+/* ------------------------------------------------------------------
+ * bitfields
+ *
+ * Bits are read MSB first.  A bitfield of up to 64 bits is loaded as
+ * a single integer, and each field is cut out of it with a shift and
+ * a mask.  Wider bitfields are handled a field at a time, each one
+ * (at most 64 bits) in two 32-bit pieces.
+ * ------------------------------------------------------------------ */
+
+/* <num_bits> (at most 32) starting <start> bits into <data> */
+
+static unsigned PY_LONG_LONG
+get_bits (unsigned char * data, Py_ssize_t start, int num_bits)
+{
+  unsigned PY_LONG_LONG x = 0;
+  Py_ssize_t end = start + num_bits;
+  Py_ssize_t i;
+
+  for (i = (start >> 3); i < ((end + 7) >> 3); i++) {
+    x = (x << 8) | data[i];
+  }
+  x >>= ((8 - (end & 7)) & 7);
+  return x & ((((unsigned PY_LONG_LONG) 1) << num_bits) - 1);
+}
+
+/* or <num_bits> (at most 32) of <x> into <data>, <start> bits in */
+
+static void
+put_bits (unsigned char * data, Py_ssize_t start, int num_bits, unsigned PY_LONG_LONG x)
+{
+  Py_ssize_t end = start + num_bits;
+  Py_ssize_t i;
+
+  x <<= ((8 - (end & 7)) & 7);
+  for (i = ((end + 7) >> 3) - 1; i >= (start >> 3); i--) {
+    data[i] |= (unsigned char) (x & 0xff);
+    x >>= 8;
+  }
+}
+
+static unsigned PY_LONG_LONG
+get_field_bits (field_op * op, unsigned char * data, int i)
+{
+  int num_bits = op->bits[i];
+  int start = (op->bit_bytes * 8) - op->bit_shifts[i] - num_bits;
+
+  if (num_bits > 32) {
+    return (get_bits (data, start, num_bits - 32) << 32) | get_bits (data, start + num_bits - 32, 32);
+  } else {
+    return get_bits (data, start, num_bits);
+  }
+}
+
+static void
+put_field_bits (field_op * op, unsigned char * data, int i, unsigned PY_LONG_LONG x)
+{
+  int num_bits = op->bits[i];
+  int start = (op->bit_bytes * 8) - op->bit_shifts[i] - num_bits;
+
+  if (num_bits > 32) {
+    put_bits (data, start, num_bits - 32, x >> 32);
+    put_bits (data, start + num_bits - 32, 32, x & 0xffffffffUL);
+  } else {
+    put_bits (data, start, num_bits, x);
+  }
+}
+
+static int
+pack_mpi (char byte_order, PyObject * value, pack_buffer * buf)
+{
+  PyObject * number;
+  size_t bits;
+  unsigned int x;
+  int size;
+  unsigned char * s;
+
+  if ((!PyInt_Check (value)) && (!PyLong_Check (value))) {
+    PyErr_SetString (PyExc_ValueError, "bad argument type to pack");
+    return -1;
+  }
+  number = PyNumber_Long (value);
+  if (!number) {
+    return -1;
+  }
+  size = mpi_size (number, &bits);
+  if ((size == -1) || (pack_buffer_room (buf, size) == -1)) {
+    Py_DECREF (number);
+    return -1;
+  }
+  s = buf->data + buf->pos;
+  x = (unsigned int) bits;
+  switch (byte_order) {
+  case 'L':
+    LITTLE_ENCODE_WORD (x, s);
+    break;
+  case 'B':
+    BIG_ENCODE_WORD (x, s);
+    break;
+  }
+  if ((size > 2) &&
+      (_PyLong_AsByteArray ((PyLongObject *) number, s+2, size-2, (byte_order == 'L'), 0) == -1)) {
+    Py_DECREF (number);
+    return -1;
+  }
+  buf->pos += size;
+  Py_DECREF (number);
+  return 0;
+}
+
+static int
+pack_bitfield (field_op * op, PyObject ** items, int num_items, int data_pos, unsigned char * out)
+{
+  unsigned PY_LONG_LONG word = 0;
+  int i;
+
+  if ((num_items - data_pos) < op->num_bits) {
+    PyErr_SetString (PyExc_ValueError, "not enough data for bitfields");
+    return -1;
+  }
+  if (op->bit_bytes > 8) {
+    memset (out, 0, op->bit_bytes);
+  }
+
+  for (i=0; i < op->num_bits; i++) {
+    PyObject * item = items[i+data_pos];
+    unsigned PY_LONG_LONG value;
+    if (PyInt_Check (item)) {
+      long v = PyInt_AS_LONG (item);
+      if (v < 0) {
+        PyErr_SetString (PyExc_ValueError, "negative number in bitfield");
+        return -1;
+      }
+      value = (unsigned PY_LONG_LONG) v;
+    } else {
+      value = PyLong_AsUnsignedLongLong (item);
+      if (PyErr_Occurred()) {
+        return -1;
+      }
+    }
+    if (value & ~op->bit_masks[i]) {
+      PyErr_SetString (PyExc_ValueError, "number too big for specified number of bits");
+      return -1;
+    } else if (op->bit_bytes > 8) {
+      put_field_bits (op, out, i, value);
+    } else if (value) {
+      /* (a zero-width field could have a shift of 64) */
+      word |= value << op->bit_shifts[i];
+    }
+  }
+  if (op->bit_bytes <= 8) {
+    for (i = op->bit_bytes - 1; i >= 0; i--) {
+      out[i] = (unsigned char) (word & 0xff);
+      word >>= 8;
+    }
+  }
+  return 0;
+}
+
+/* pack a single (unrepeated) field from items[*argnum_ptr] */
+
+static int
+pack_field (
+  char byte_order,
+  field_op * op,
+  PyObject ** items,
+  int num_items,
+  int * argnum_ptr,
+  pack_buffer * buf,
+  PyObject * functions
+  )
+{
+  PyObject * value = NULL;
+  unsigned char * s;
+  int argnum = *argnum_ptr;
+
+  if (op->code != 'x') {
+    /* a pad char takes no argument */
+    if (argnum >= num_items) {
+      PyErr_SetString (PyExc_ValueError, "not enough arguments for pack");
+      return -1;
+    }
+    value = items[argnum++];
+  }
+
+  if (pack_buffer_room (buf, op->size) == -1) {
+    return -1;
+  }
+  s = buf->data + buf->pos;
+
+  switch (op->code) {
+
+    /* integer types */
+
+  case 'b': case 'h': case 'l':
+    if ((!PyInt_Check (value)) && (!PyLong_Check (value))) {
+      PyErr_SetString (PyExc_ValueError, "bad argument type to pack");
+      return -1;
+    } else {
+      int x = PyInt_AsLong (value);
+
+      /* FIXME: should do range checks */
+      switch (op->code) {
+      case 'b':
+        s[0] = x;
+        break;
+      case 'h':
+        switch (byte_order) {
+        case 'L':
+          LITTLE_ENCODE_WORD (x,s);
+          break;
+        case 'B':
+          BIG_ENCODE_WORD (x,s);
+          break;
+        }
+        break;
+      case 'l':
+        switch (byte_order) {
+        case 'L':
+          LITTLE_ENCODE_LONG (x,s);
+          break;
+        case 'B':
+          BIG_ENCODE_LONG (x,s);
+          break;
         }
+        break;
+      }
+    }
+    break;
+
+    /* floating-point types */
+
+  case 'f':
+    if (!PyFloat_Check (value)) {
+      PyErr_SetString (PyExc_ValueError, "bad argument type to pack");
+      return -1;
+    } else {
+      float x = (float) PyFloat_AsDouble (value);
+      switch (byte_order) {
+      case 'L':
+        LITTLE_ENCODE_FLOAT (x,s);
+        break;
+      case 'B':
+        BIG_ENCODE_FLOAT (x,s);
+        break;
       }
     }
+    break;
+
+  case 'd':
+    if (!PyFloat_Check (value)) {
+      PyErr_SetString (PyExc_ValueError, "bad argument type to pack");
+      return -1;
+    } else {
+      double x = PyFloat_AsDouble (value);
+      switch (byte_order) {
+      case 'L':
+        LITTLE_ENCODE_DOUBLE (x,s);
+        break;
+      case 'B':
+        BIG_ENCODE_DOUBLE (x,s);
+        break;
+      }
+    }
+    break;
+
+    /* character type */
+
+  case 'c':
+    if ((!PyString_Check (value)) || (PyString_Size (value) != 1)) {
+      PyErr_SetString (PyExc_ValueError, "bad argument type to pack");
+      return -1;
+    } else {
+      s[0] = PyString_AS_STRING (value)[0];
+    }
+    break;
+
+    /* pad byte */
+
+  case 'x':
+    /* pad with a NULL byte */
+    s[0] = 0;
+    break;
+
+    /* multi-precision integer */
+
+  case 'm':
+    if (pack_mpi (byte_order, value, buf) == -1) {
+      return -1;
+    }
+    break;
+
+    /* bitfield */
+
+  case '(':
+    if (pack_bitfield (op, items, num_items, argnum-1, s) == -1) {
+      return -1;
+    }
+    argnum = argnum + op->num_bits - 1;
+    break;
+
+    /* user function */
+
+  case '[':
+    {
+      PyObject * fun = get_function (op, functions);
+      PyObject * sub;
+      PyObject * t;
+      int sub_len;
+      if (!fun) {
+        return -1;
+      }
+      t = Py_BuildValue ("(O)", value);
+      if (!t) {
+        return -1;
+      }
+      sub = PyEval_CallObject (fun, t);
+      Py_DECREF (t);
+      if ((!sub) || (!PyString_Check (sub))) {
+        PyErr_SetString (PyExc_ValueError, "user function did not return a string");
+        Py_XDECREF (sub);
+        return -1;
+      }
+      sub_len = PyString_GET_SIZE (sub);
+      if (pack_buffer_room (buf, sub_len) == -1) {
+        Py_DECREF (sub);
+        return -1;
+      }
+      memcpy (buf->data + buf->pos, PyString_AS_STRING (sub), sub_len);
+      buf->pos += sub_len;
+      Py_DECREF (sub);
+    }
+    break;
+  }
+  buf->pos += op->size;
+  *argnum_ptr = argnum;
+  return 0;
+}
+
+/* pack a multiplied field ('8b') from the sequence <value> */
+
+static int
+pack_repeat (
+  char byte_order,
+  field_op * op,
+  PyObject * value,
+  pack_buffer * buf,
+  PyObject * functions
+  )
+{
+  PyObject * seq;
+  int argnum = 0;
+  int j;
+
+  if (op->code == 'x') {
+    /* '4x': just padding */
+    if (pack_buffer_room (buf, op->count) == -1) {
+      return -1;
+    }
+    memset (buf->data + buf->pos, 0, op->count);
+    buf->pos += op->count;
+    return 0;
+  } else if (((op->code == 'c') || (op->code == 'b')) && PyString_Check (value)) {
+    /* a string stands in for repeated chars or bytes */
+    if (PyString_GET_SIZE (value) != op->count) {
+      PyErr_SetString (PyExc_ValueError, "wrong number of repeated values");
+      return -1;
+    }
+    if (pack_buffer_room (buf, op->count) == -1) {
+      return -1;
+    }
+    memcpy (buf->data + buf->pos, PyString_AS_STRING (value), op->count);
+    buf->pos += op->count;
+    return 0;
+  }
+
+  /* otherwise any sequence will do: a tuple, list or array */
+  seq = PySequence_Fast (value, "bad argument type to pack");
+  if (!seq) {
+    return -1;
+  } else if (PySequence_Fast_GET_SIZE (seq) != op->count) {
+    /* (each repeat takes one value: bitfields and procfields can't be repeated) */
+    PyErr_SetString (PyExc_ValueError, "wrong number of repeated values");
+    Py_DECREF (seq);
+    return -1;
+  }
+  for (j=0; j < op->count; j++) {
+    if (pack_field (byte_order, op,
+                    PySequence_Fast_ITEMS (seq), PySequence_Fast_GET_SIZE (seq),
+                    &argnum, buf, functions) == -1) {
+      Py_DECREF (seq);
+      return -1;
+    }
+  }
+  Py_DECREF (seq);
+  return 0;
+}
+
+static int
+pack_ops (
+  Struct_object * self,
+  PyObject * args,
+  pack_buffer * buf,
+  PyObject * functions
+  )
+{
+  PyObject ** items = PySequence_Fast_ITEMS (args);
+  int num_items = PyTuple_GET_SIZE (args);
+  int argnum = 0;
+  int i;
+
+  for (i=0; i < self->num_ops; i++) {
+    field_op * op = &self->ops[i];
+
+    if (op->count < 0) {
+      if (pack_field (self->byte_order, op, items, num_items,
+                      &argnum, buf, functions) == -1) {
+        return -1;
+      }
+    } else {
+      /* multiplier: the argument is itself a sequence */
+      PyObject * value = NULL;
+      if (op->code != 'x') {
+        if (argnum >= num_items) {
+          PyErr_SetString (PyExc_ValueError, "not enough arguments for pack");
+          return -1;
+        }
+        value = items[argnum++];
+      }
+      if (pack_repeat (self->byte_order, op, value, buf, functions) == -1) {
+        return -1;
+      }
+    }
+  }
+  return 0;
+}
+
+/* ------------------------------------------------------------------
+ * unpacking
+ * ------------------------------------------------------------------ */
+
+/* decode one 'b', 'c', 'h', 'l', 'f' or 'd' field at <data> */
+
+static PyObject *
+decode_value (char byte_order, char code, unsigned char * data)
+{
+  switch (code) {
+
+    /* char */
+  case 'c':
+    return PyString_FromStringAndSize ((const char *) data, 1);
+
+    /* byte */
+  case 'b':
+    return PyInt_FromLong (data[0]);
+
+    /* word/short */
+  case 'h':
+    {
+      unsigned int x = 0;
+      switch (byte_order) {
+      case 'L':
+        LITTLE_DECODE_WORD (x,data);
+        break;
+      case 'B':
+        BIG_DECODE_WORD (x,data);
+        break;
+      }
+      return PyInt_FromLong (x);
+    }
+
+    /* long */
+  case 'l':
+    {
+      unsigned int x = 0;
+      switch (byte_order) {
+      case 'L':
+        LITTLE_DECODE_LONG (x,data);
+        break;
+      case 'B':
+        BIG_DECODE_LONG (x,data);
+        break;
+      }
+      return PyInt_FromLong (x);
+    }
+
+    /* float */
+  case 'f':
+    {
+      float x = 0;
+      switch (byte_order) {
+      case 'L':
+        LITTLE_DECODE_FLOAT (x, data);
+        break;
+      case 'B':
+        BIG_DECODE_FLOAT (x, data);
+        break;
+      }
+      return PyFloat_FromDouble ((double) x);
+    }
+
+    /* double */
+  case 'd':
+    {
+      double x = 0;
+      switch (byte_order) {
+      case 'L':
+        LITTLE_DECODE_DOUBLE (x, data);
+        break;
+      case 'B':
+        BIG_DECODE_DOUBLE (x, data);
+        break;
+      }
+      return PyFloat_FromDouble (x);
+    }
+  }
+  PyErr_SetString (PyExc_ValueError, "unknown format character");
+  return NULL;
+}
+
+static
+int
+unpack_bitfield (
+  field_op * op,
+  PyObject * result_list,
+  unsigned char * data,
+  int data_pos,
+  int data_len
+  )
+{
+  if ((data_pos + op->bit_bytes) > data_len) {
+    PyErr_SetString (PyExc_ValueError, "not enough data for bitfields");
+    return -1;
+  } else {
+    unsigned PY_LONG_LONG word = 0;
+    int i;
+
+    if (op->bit_bytes <= 8) {
+      for (i=0; i < op->bit_bytes; i++) {
+        word = (word << 8) | data[data_pos + i];
+      }
+    }
+    for (i=0; i < op->num_bits; i++) {
+      unsigned PY_LONG_LONG x;
+      PyObject * value;
+
+      if (op->bit_bytes <= 8) {
+        /* shifting a 64-bit word by 64 is undefined */
+        x = (op->bit_shifts[i] < 64) ? ((word >> op->bit_shifts[i]) & op->bit_masks[i]) : 0;
+      } else {
+        x = get_field_bits (op, data + data_pos, i);
+      }
+      if (x <= LONG_MAX) {
+        value = PyInt_FromLong ((long) x);
+      } else {
+        value = PyLong_FromUnsignedLongLong (x);
+      }
+      if ((!value) || (PyList_Append (result_list, value) == -1)) {
+        Py_XDECREF (value);
+        return -1;
+      }
+      Py_DECREF (value);
+    }
+    return data_pos + op->bit_bytes;
+  }
+}
+
+/* unpack a single (unrepeated) field, appending to <result> */
+
+static int
+unpack_field (
+  char byte_order,
+  field_op * op,
+  PyObject * result,
+  PyObject * data_object,
+  unsigned char * data,
+  int data_len,
+  int * data_pos_ptr,
+  PyObject * functions
+  )
+{
+  int data_pos = *data_pos_ptr;
+
+  switch (op->code) {
+
+  case 'b': case 'c': case 'h': case 'l': case 'f': case 'd':
+    {
+      PyObject * value;
+      if ((data_pos + op->size) > data_len) {
+        PyErr_SetString (PyExc_ValueError, "not enough data");
+        return -1;
+      }
+      value = decode_value (byte_order, op->code, data+data_pos);
+      if ((!value) || (PyList_Append (result, value) == -1)) {
+        Py_XDECREF (value);
+        return -1;
+      }
+      Py_DECREF (value);
+      data_pos += op->size;
+    }
+    break;
+
+    /* bitfield */
+
+  case '(':
+    data_pos = unpack_bitfield (op, result, data, data_pos, data_len);
+    if (data_pos == -1) {
+      return -1;
+    }
+    /* unpack_bitfield appends to the result list itself */
+    break;
+
+    /* pad byte */
+
+  case 'x':
+    data_pos++;
+    break;
+
+    /* multi-precision integer */
+
+  case 'm':
+    {
+      PyObject * value = decode_mpi (byte_order, data, data_len, &data_pos);
+      if ((!value) || (PyList_Append (result, value) == -1)) {
+        Py_XDECREF (value);
+        return -1;
+      }
+      Py_DECREF (value);
+    }
+    break;
+
+    /* user function */
+
+  case '[':
+    {
+      PyObject * fun = get_function (op, functions);
+      PyObject * user_args;
+      PyObject * user_function_result;
+      PyObject * decoded_data;
+      int munched;
+      int j;
+      double start = 0.0;
+
+      if (!fun) {
+        return -1;
+      }
+      if (profiling) {
+        start = profile_clock();
+      }
+      user_args = Py_BuildValue ("OOi", result, data_object, data_pos);
+      if (!user_args) {
+        return -1;
+      }
+      user_function_result = PyEval_CallObject (fun, user_args);
+      Py_DECREF (user_args);
+      if (!user_function_result) {
+        return -1;
+      } else if (!PyArg_ParseTuple (user_function_result,
+                                    "O!i",
+                                    &PyTuple_Type,
+                                    &decoded_data,
+                                    &munched)) {
+        PyErr_SetString (PyExc_ValueError, "bad result from user function");
+        Py_DECREF (user_function_result);
+        return -1;
+      }
+      if (profiling &&
+          (profile_count ("procfield", fun, munched, profile_clock() - start) == -1)) {
+        Py_DECREF (user_function_result);
+        return -1;
+      }
+      /* append the user-parsed data to the current result list */
+      for (j = 0; j < PyTuple_GET_SIZE (decoded_data); j++) {
+        if (PyList_Append (result, PyTuple_GET_ITEM (decoded_data, j)) == -1) {
+          Py_DECREF (user_function_result);
+          return -1;
+        }
+      }
+      data_pos += munched;
+      Py_DECREF (user_function_result);
+    }
+    break;
+  }
+  *data_pos_ptr = data_pos;
+  return 0;
+}
+
+/* compact form of a multiplied field: a string for 'c' and 'b',
+ * an array.array for the wider numeric types */
+
+static PyObject * array_type = NULL;
+
+static PyObject *
+unpack_compact (char byte_order, field_op * op, unsigned char * data)
+{
+  int total = op->size * op->count;
+  char typecode;
+  PyObject * raw;
+  PyObject * result;
+
+  if ((op->code == 'c') || (op->code == 'b')) {
+    return PyString_FromStringAndSize ((const char *) data, total);
+  }
+  switch (op->code) {
+  case 'h':
+    typecode = 'H';
+    break;
+  case 'l':
+    typecode = (sizeof (unsigned int) == 4) ? 'I' : 'L';
+    break;
+  default:
+    typecode = op->code;
+    break;
+  }
+  if (!array_type) {
+    PyObject * array_module = PyImport_ImportModule ("array");
+    if (!array_module) {
+      return NULL;
+    }
+    array_type = PyObject_GetAttrString (array_module, "array");
+    Py_DECREF (array_module);
+    if (!array_type) {
+      return NULL;
+    }
+  }
+  /* the array wants native byte order */
+  raw = PyString_FromStringAndSize ((const char *) data, total);
+  if (!raw) {
+    return NULL;
+  }
+  if (byte_order != (endian ? 'B' : 'L')) {
+    unsigned char * p = (unsigned char *) PyString_AS_STRING (raw);
+    int j, k;
+    for (j=0; j < total; j += op->size) {
+      for (k=0; k < op->size/2; k++) {
+        SWAP (p, j+k, j+op->size-1-k);
+      }
+    }
+  }
+  result = PyObject_CallFunction (array_type, "cO", typecode, raw);
+  Py_DECREF (raw);
+  return result;
+}
+
+/* unpack a multiplied field ('8b'), returning a new tuple
+ * (or the compact form) */
+
+static PyObject *
+unpack_repeat (
+  Struct_object * self,
+  field_op * op,
+  PyObject * data_object,
+  unsigned char * data,
+  int data_len,
+  int * data_pos_ptr,
+  PyObject * functions
+  )
+{
+  int data_pos = *data_pos_ptr;
+  PyObject * result;
+  int j;
+
+  switch (op->code) {
+
+  case 'x':
+    *data_pos_ptr = data_pos + op->count;
+    return PyTuple_New (0);
+
+  case 'b': case 'c': case 'h': case 'l': case 'f': case 'd':
+    if ((data_pos + (op->size * op->count)) > data_len) {
+      PyErr_SetString (PyExc_ValueError, "not enough data");
+      return NULL;
+    }
+    if (self->compact) {
+      result = unpack_compact (self->byte_order, op, data+data_pos);
+    } else {
+      result = PyTuple_New (op->count);
+      for (j=0; result && (j < op->count); j++) {
+        PyObject * value = decode_value (self->byte_order, op->code, data+data_pos+(j*op->size));
+        if (!value) {
+          Py_DECREF (result);
+          return NULL;
+        }
+        PyTuple_SET_ITEM (result, j, value);
+      }
+    }
+    if (result) {
+      *data_pos_ptr = data_pos + (op->size * op->count);
+    }
+    return result;
+
+  default:
+    /* bitfields and procfields: collect them into a sub-tuple */
+    {
+      PyObject * sub_result = PyList_New (0);
+      if (!sub_result) {
+        return NULL;
+      }
+      for (j=0; j < op->count; j++) {
+        if (unpack_field (self->byte_order, op, sub_result,
+                          data_object, data, data_len, &data_pos, functions) == -1) {
+          Py_DECREF (sub_result);
+          return NULL;
+        }
+      }
+      result = PyList_AsTuple (sub_result);
+      Py_DECREF (sub_result);
+      *data_pos_ptr = data_pos;
+      return result;
+    }
+  }
+}
+
+static int
+unpack_ops (
+  Struct_object * self,
+  PyObject * result,
+  PyObject * data_object,
+  unsigned char * data,
+  int data_len,
+  int * data_pos_ptr,
+  PyObject * functions
+  )
+{
+  int i;
+
+  for (i=0; i < self->num_ops; i++) {
+    field_op * op = &self->ops[i];
+
+    if (*data_pos_ptr > data_len) {
+      PyErr_SetString (PyExc_ValueError, "not enough data");
+      return -1;
+    }
+
+    if (op->count < 0) {
+      if (unpack_field (self->byte_order, op, result,
+                        data_object, data, data_len, data_pos_ptr, functions) == -1) {
+        return -1;
+      }
+    } else {
+      PyObject * value = unpack_repeat (self, op, data_object, data, data_len,
+                                        data_pos_ptr, functions);
+      if ((!value) || (PyList_Append (result, value) == -1)) {
+        Py_XDECREF (value);
+        return -1;
+      }
+      Py_DECREF (value);
+    }
+  }
+  return 0;
+}
+
+static PyObject *
+Struct_pack_args (Struct_object * self, PyObject * args, PyObject * functions)
+{
+  pack_buffer buf;
+  if (pack_buffer_init (&buf, self->size) == -1) {
+    return NULL;
+  } else if (pack_ops (self, args, &buf, functions) == -1) {
+    Py_XDECREF (buf.string);
+    return NULL;
+  } else {
+    return pack_buffer_finish (&buf);
+  }
+}
+
+/* unpack one record at *data_pos_ptr, returning its tuple of values */
+
+static PyObject *
+unpack_record (
+  Struct_object * self,
+  PyObject * data_object,
+  unsigned char * data,
+  int data_len,
+  int * data_pos_ptr,
+  PyObject * functions
+  )
+{
+  PyObject * result = PyList_New (0);
+  PyObject * tuple_result;
+
+  if (!result) {
+    return NULL;
+  } else if (unpack_ops (self, result, data_object, data, data_len, data_pos_ptr, functions) == -1) {
+    Py_DECREF (result);
+    return NULL;
+  }
+  /* convert to a tuple */
+  tuple_result = PyList_AsTuple (result);
+  Py_DECREF (result);
+  return tuple_result;
+}
+
+/* procfields are handed the data as a string or a read-only buffer
+ * object, whatever it was unpacked from, as in the pure python engine:
+ * old-style buffers (bytearray, mmap, array) are wrapped without
+ * copying them, and anything else (a memoryview) is copied into a
+ * string.  returns a new reference */
+
+static PyObject *
+procfield_data (Struct_object * self, PyObject * object, unsigned char * data, int data_len)
+{
+  if ((!self->procfields) || PyString_CheckExact (object) || PyBuffer_Check (object)) {
+    Py_INCREF (object);
+    return object;
+  } else if (PyObject_CheckReadBuffer (object)) {
+    return PyBuffer_FromObject (object, 0, Py_END_OF_BUFFER);
+  } else {
+    return PyString_FromStringAndSize ((char *) data, data_len);
+  }
+}
+
+static PyObject *
+Struct_unpack_data (
+  Struct_object * self,
+  PyObject * data_object,
+  unsigned char * data,
+  int data_len,
+  int data_pos,
+  PyObject * functions
+  )
+{
+  PyObject * tuple_result;
+  PyObject * final_result;
+  int original_data_pos = data_pos;
+
+  data_object = procfield_data (self, data_object, data, data_len);
+  if (!data_object) {
+    return NULL;
+  }
+  tuple_result = unpack_record (self, data_object, data, data_len, &data_pos, functions);
+  Py_DECREF (data_object);
+  if (!tuple_result) {
+    return NULL;
+  }
+  /* combine with data position into a new tuple */
+  final_result = Py_BuildValue ("Oi", tuple_result, (int)(data_pos - original_data_pos));
+  Py_DECREF (tuple_result);
+  return (final_result);
+}
+
+/* get a writable pointer into <object>: anything with the new buffer
+ * interface (bytearray, memoryview) or the old one (mmap, array) */
+
+static int
+get_write_buffer (PyObject * object, Py_buffer * view, int * have_view,
+                  unsigned char ** data, int * data_len)
+{
+  if (PyObject_CheckBuffer (object)) {
+    if (PyObject_GetBuffer (object, view, PyBUF_WRITABLE) == -1) {
+      return -1;
+    }
+    *have_view = 1;
+    *data = (unsigned char *) view->buf;
+    *data_len = view->len;
+  } else {
+    void * p;
+    Py_ssize_t n;
+    if (PyObject_AsWriteBuffer (object, &p, &n) == -1) {
+      return -1;
+    }
+    *have_view = 0;
+    *data = (unsigned char *) p;
+    *data_len = n;
+  }
+  return 0;
+}
+
+static PyObject *
+Struct_pack_into_object (
+  Struct_object * self,
+  PyObject * object,
+  int offset,
+  PyObject * args,
+  PyObject * functions
+  )
+{
+  Py_buffer view;
+  int have_view;
+  unsigned char * data;
+  int data_len;
+  pack_buffer buf;
+  int r;
+
+  if (get_write_buffer (object, &view, &have_view, &data, &data_len) == -1) {
+    return NULL;
+  }
+  if ((offset < 0) || (offset > data_len)) {
+    PyErr_SetString (PyExc_ValueError, "offset out of range");
+    r = -1;
+  } else {
+    buf.string = NULL;
+    buf.data = data + offset;
+    buf.pos = 0;
+    buf.len = data_len - offset;
+    r = pack_ops (self, args, &buf, functions);
+  }
+  if (have_view) {
+    PyBuffer_Release (&view);
+  }
+  if (r == -1) {
+    return NULL;
+  } else {
+    /* the number of bytes written */
+    return PyInt_FromLong (buf.pos);
+  }
+}
+
+static PyObject *
+Struct_unpack_view (
+  Struct_object * self,
+  PyObject * object,
+  Py_buffer * view,
+  int offset,
+  PyObject * functions
+  )
+{
+  PyObject * result;
+  if ((offset < 0) || (offset > view->len)) {
+    PyErr_SetString (PyExc_ValueError, "offset out of range");
+    result = NULL;
+  } else {
+    result = Struct_unpack_data (
+      self, object, (unsigned char *) view->buf, view->len, offset, functions
+      );
+  }
+  PyBuffer_Release (view);
+  return result;
+}
+
+static PyObject *
+Struct_pack (Struct_object * self, PyObject * arg_list)
+{
+  PyObject * args;
+
+  if (!PyArg_ParseTuple (arg_list, "O!", &PyTuple_Type, &args)) {
+    return NULL;
+  } else {
+    return Struct_pack_args (self, args, self->functions);
+  }
+}
+
+static PyObject *
+Struct_unpack (Struct_object * self, PyObject * arg_list)
+{
+  unsigned char * data;
+  int data_len;
+  int data_pos = 0;
+
+  if (!PyArg_ParseTuple (arg_list, "s#|i", &data, &data_len, &data_pos)) {
+    return NULL;
+  } else {
+    return Struct_unpack_data (
+      self, PyTuple_GET_ITEM (arg_list, 0), data, data_len, data_pos, self->functions
+      );
+  }
+}
+
+static PyObject *
+Struct_pack_into (Struct_object * self, PyObject * arg_list)
+{
+  PyObject * object;
+  int offset;
+  PyObject * args;
+
+  if (!PyArg_ParseTuple (arg_list, "OiO!", &object, &offset, &PyTuple_Type, &args)) {
+    return NULL;
+  } else {
+    return Struct_pack_into_object (self, object, offset, args, self->functions);
+  }
+}
+
+static PyObject *
+Struct_unpack_from (Struct_object * self, PyObject * arg_list)
+{
+  Py_buffer view;
+  int offset = 0;
+
+  if (!PyArg_ParseTuple (arg_list, "s*|i", &view, &offset)) {
+    return NULL;
+  } else {
+    return Struct_unpack_view (
+      self, PyTuple_GET_ITEM (arg_list, 0), &view, offset, self->functions
+      );
+  }
+}
+
+/* does <object> hand out a real export, which keeps its memory in
+ * place until the view is released?  old-style buffers (mmap, array,
+ * and buffer objects over them) don't: another thread could close or
+ * resize them under us, so the GIL has to be kept while they're read
+ * or written. */
+
+static int
+has_export (PyObject * object)
+{
+  return PyObject_CheckBuffer (object) && !PyBuffer_Check (object);
+}
+
+/* a read-only view of <source>, whether it has a new-style buffer
+ * or an old-style one (mmap, array).  returns 0, or -1 */
+
+static int
+get_read_buffer (PyObject * source, Py_buffer * view)
+{
+  if (PyObject_CheckBuffer (source)) {
+    return PyObject_GetBuffer (source, view, PyBUF_SIMPLE);
+  } else if (PyObject_CheckReadBuffer (source)) {
+    const void * p;
+    Py_ssize_t n;
+    if (PyObject_AsReadBuffer (source, &p, &n) == -1) {
+      return -1;
+    }
+    return PyBuffer_FillInfo (view, source, (void *) p, n, 1, PyBUF_SIMPLE);
+  } else {
+    /* (a closed mmap has already said so) */
+    if (!PyErr_Occurred()) {
+      PyErr_SetString (PyExc_TypeError, "expected a buffer");
+    }
+    return -1;
+  }
+}
+
+/* ------------------------------------------------------------------
+ * native conversion
+ *
+ * unpack_native() decodes a run of fixed-size records into a buffer
+ * of plain machine values, and pack_native() does the reverse.  Each
+ * value is stored in native byte order, packed, at its own size: one
+ * byte for 'b' and 'c', two for 'h', four for 'l' and 'f', eight for
+ * 'd', and the smallest of 1, 2, 4 or 8 bytes that holds each field
+ * of a bitfield.  Repeated fields are stored that many times, and pad
+ * bytes not at all.  This is the layout of a packed numpy record
+ * array, so the output can be handed straight to numpy.
+ *
+ * No python objects are touched while converting, so it's done
+ * with the interpreter lock released; threads converting
+ * separate buffers run in parallel.
+ * ------------------------------------------------------------------ */
+
+/* copy <n> bytes, reversing them if <byte_order> isn't ours */
+
+static void
+copy_ordered (char byte_order, unsigned char * to, unsigned char * from, int n)
+{
+  if ((n == 1) || (byte_order == (endian ? 'B' : 'L'))) {
+    memcpy (to, from, n);
+  } else {
+    int i;
+    for (i=0; i < n; i++) {
+      to[i] = from[n-1-i];
+    }
+  }
+}
+
+static void
+store_native (unsigned char * out, int size, unsigned PY_LONG_LONG x)
+{
+  switch (size) {
+  case 1:
+    out[0] = (unsigned char) x;
+    break;
+  case 2:
+    {
+      unsigned short v = (unsigned short) x;
+      memcpy (out, &v, 2);
+    }
+    break;
+  case 4:
+    {
+      unsigned int v = (unsigned int) x;
+      memcpy (out, &v, 4);
+    }
+    break;
+  default:
+    memcpy (out, &x, 8);
+    break;
+  }
+}
+
+static unsigned PY_LONG_LONG
+load_native (unsigned char * in, int size)
+{
+  switch (size) {
+  case 1:
+    return in[0];
+  case 2:
+    {
+      unsigned short v;
+      memcpy (&v, in, 2);
+      return v;
+    }
+  case 4:
+    {
+      unsigned int v;
+      memcpy (&v, in, 4);
+      return v;
+    }
+  default:
+    {
+      unsigned PY_LONG_LONG v;
+      memcpy (&v, in, 8);
+      return v;
+    }
+  }
+}
+
+/* decode one record from <data> into <out> */
+
+static void
+unpack_native_record (Struct_object * self, unsigned char * data, unsigned char * out)
+{
+  int i, j, k;
+
+  for (i=0; i < self->num_ops; i++) {
+    field_op * op = &self->ops[i];
+    int n = (op->count < 0) ? 1 : op->count;
+
+    switch (op->code) {
+    case 'x':
+      data += n;
+      break;
+    case 'b': case 'c':
+      memcpy (out, data, n);
+      out += n;
+      data += n;
+      break;
+    case '(':
+      for (j=0; j < n; j++) {
+        unsigned PY_LONG_LONG word = 0;
+        if (op->bit_bytes <= 8) {
+          for (k=0; k < op->bit_bytes; k++) {
+            word = (word << 8) | data[k];
+          }
+        }
+        for (k=0; k < op->num_bits; k++) {
+          unsigned PY_LONG_LONG x;
+          int size = native_bit_size (op->bits[k]);
+          if (op->bit_bytes <= 8) {
+            x = (op->bit_shifts[k] < 64) ? ((word >> op->bit_shifts[k]) & op->bit_masks[k]) : 0;
+          } else {
+            x = get_field_bits (op, data, k);
+          }
+          store_native (out, size, x);
+          out += size;
+        }
+        data += op->bit_bytes;
+      }
+      break;
+    default:
+      /* 'h', 'l', 'f' and 'd' */
+      for (j=0; j < n; j++) {
+        copy_ordered (self->byte_order, out, data, op->size);
+        out += op->size;
+        data += op->size;
+      }
+      break;
+    }
+  }
+}
+
+/* encode one record from <in> into <data>.  returns 0, or -1 if a
+ * bitfield value doesn't fit */
+
+static int
+pack_native_record (Struct_object * self, unsigned char * in, unsigned char * data)
+{
+  int i, j, k;
+
+  for (i=0; i < self->num_ops; i++) {
+    field_op * op = &self->ops[i];
+    int n = (op->count < 0) ? 1 : op->count;
+
+    switch (op->code) {
+    case 'x':
+      memset (data, 0, n);
+      data += n;
+      break;
+    case 'b': case 'c':
+      memcpy (data, in, n);
+      in += n;
+      data += n;
+      break;
+    case '(':
+      for (j=0; j < n; j++) {
+        unsigned PY_LONG_LONG word = 0;
+        if (op->bit_bytes > 8) {
+          memset (data, 0, op->bit_bytes);
+        }
+        for (k=0; k < op->num_bits; k++) {
+          int size = native_bit_size (op->bits[k]);
+          unsigned PY_LONG_LONG x = load_native (in, size);
+          in += size;
+          if (x & ~op->bit_masks[k]) {
+            return -1;
+          } else if (op->bit_bytes > 8) {
+            put_field_bits (op, data, k, x);
+          } else if (x) {
+            word |= x << op->bit_shifts[k];
+          }
+        }
+        if (op->bit_bytes <= 8) {
+          for (k = op->bit_bytes - 1; k >= 0; k--) {
+            data[k] = (unsigned char) (word & 0xff);
+            word >>= 8;
+          }
+        }
+        data += op->bit_bytes;
+      }
+      break;
+    default:
+      for (j=0; j < n; j++) {
+        copy_ordered (self->byte_order, data, in, op->size);
+        in += op->size;
+        data += op->size;
+      }
+      break;
+    }
+  }
+  return 0;
+}
+
+/* encode <count> records.  returns 0, or -1 as above */
+
+static int
+pack_native_records (Struct_object * self, unsigned char * in, unsigned char * data, Py_ssize_t count)
+{
+  Py_ssize_t i;
+
+  for (i=0; i < count; i++) {
+    if (pack_native_record (self, in + (i * self->native_size), data + (i * self->size)) == -1) {
+      return -1;
+    }
+  }
+  return 0;
+}
+
+static int
+check_native (Struct_object * self)
+{
+  if (self->variable) {
+    PyErr_SetString (PyExc_ValueError, "native conversion needs a fixed-size format");
+    return -1;
+  } else if (!self->size) {
+    PyErr_SetString (PyExc_ValueError, "empty format");
+    return -1;
+  } else {
+    return 0;
+  }
+}
+
+/* unpack_native (data, out[, count[, offset]])
+ *   decode <count> records (by default, as many as there are) from
+ *   data[offset:] into the writable buffer <out>.  returns <count>. */
+
+static PyObject *
+Struct_unpack_native (Struct_object * self, PyObject * arg_list)
+{
+  PyObject * source;
+  PyObject * out_object;
+  Py_ssize_t count = -1;
+  Py_ssize_t offset = 0;
+  Py_buffer view;
+  Py_buffer out_view;
+  int have_out_view;
+  unsigned char * out;
+  int out_len;
+  unsigned char * data;
+  Py_ssize_t i;
+  int ok = 0;
+
+  if (!PyArg_ParseTuple (arg_list, "OO|nn", &source, &out_object, &count, &offset)) {
+    return NULL;
+  } else if (check_native (self) == -1) {
+    return NULL;
+  } else if (get_read_buffer (source, &view) == -1) {
+    return NULL;
+  } else if ((offset < 0) || (offset > view.len)) {
+    PyErr_SetString (PyExc_ValueError, "offset out of range");
+    PyBuffer_Release (&view);
+    return NULL;
+  }
+  if (count < 0) {
+    count = (view.len - offset) / self->size;
+  } else if ((view.len - offset) / self->size < count) {
+    PyErr_SetString (PyExc_ValueError, "not enough data");
+    PyBuffer_Release (&view);
+    return NULL;
+  }
+  if (get_write_buffer (out_object, &out_view, &have_out_view, &out, &out_len) == -1) {
+    PyBuffer_Release (&view);
+    return NULL;
+  } else if (out_len / (self->native_size ? self->native_size : 1) < count) {
+    PyErr_SetString (PyExc_ValueError, "output buffer too small");
+  } else {
+    data = (unsigned char *) view.buf + offset;
+    if (has_export (source) && has_export (out_object)) {
+      Py_BEGIN_ALLOW_THREADS
+      for (i=0; i < count; i++) {
+        unpack_native_record (self, data + (i * self->size), out + (i * self->native_size));
+      }
+      Py_END_ALLOW_THREADS
+    } else {
+      for (i=0; i < count; i++) {
+        unpack_native_record (self, data + (i * self->size), out + (i * self->native_size));
+      }
+    }
+    ok = 1;
+  }
+  PyBuffer_Release (&view);
+  if (have_out_view) {
+    PyBuffer_Release (&out_view);
+  }
+  if (ok) {
+    return PyInt_FromSsize_t (count);
+  } else {
+    return NULL;
+  }
+}
+
+/* pack_native (native[, count])
+ *   encode <count> records (by default, all of them) from the
+ *   native-form buffer <native>, returning a string */
+
+static PyObject *
+Struct_pack_native (Struct_object * self, PyObject * arg_list)
+{
+  PyObject * source;
+  Py_ssize_t count = -1;
+  Py_buffer view;
+  PyObject * result;
+  unsigned char * in;
+  unsigned char * data;
+  int r;
+
+  if (!PyArg_ParseTuple (arg_list, "O|n", &source, &count)) {
+    return NULL;
+  } else if (check_native (self) == -1) {
+    return NULL;
+  } else if (get_read_buffer (source, &view) == -1) {
+    return NULL;
+  }
+  if (count < 0) {
+    if (self->native_size && (view.len % self->native_size)) {
+      PyErr_SetString (PyExc_ValueError, "not a whole number of records");
+      PyBuffer_Release (&view);
+      return NULL;
+    }
+    count = self->native_size ? (view.len / self->native_size) : 0;
+  } else if (self->native_size && ((view.len / self->native_size) < count)) {
+    PyErr_SetString (PyExc_ValueError, "not enough data");
+    PyBuffer_Release (&view);
+    return NULL;
+  }
+  result = PyString_FromStringAndSize (NULL, count * self->size);
+  if (!result) {
+    PyBuffer_Release (&view);
+    return NULL;
+  }
+  in = (unsigned char *) view.buf;
+  data = (unsigned char *) PyString_AS_STRING (result);
+  if (has_export (source)) {
+    Py_BEGIN_ALLOW_THREADS
+    r = pack_native_records (self, in, data, count);
+    Py_END_ALLOW_THREADS
+  } else {
+    r = pack_native_records (self, in, data, count);
+  }
+  PyBuffer_Release (&view);
+  if (r == -1) {
+    PyErr_SetString (PyExc_ValueError, "number too big for specified number of bits");
+    Py_DECREF (result);
+    return NULL;
+  } else {
+    return result;
+  }
+}
+
+/* ------------------------------------------------------------------
+ * iter_unpack
+ *
+ * Yields the records packed back-to-back in a buffer (read in place),
+ * a file object, or an iterator of chunks.  Files and chunks are
+ * only supported for fixed-size formats (no procfields); just the
+ * unread tail of the last chunk is kept between reads.
+ * ------------------------------------------------------------------ */
+
+typedef struct {
+  PyObject_HEAD
+  Struct_object * s;
+  PyObject * functions;
+  PyObject * source;    /* the buffer, file or iterator */
+  Py_buffer view;       /* buffer source with a real export: held throughout */
+  int have_view;
+  int refetch;          /* old-style buffer source: fetched for each record */
+  PyObject * data;      /* buffer source, as procfields see it */
+  PyObject * read;      /* file source: its read method */
+  PyObject * chunks;    /* iterator source */
+  PyObject * pending;   /* file/iterator source: the current chunk */
+  int pos;
+} Iter_object;
+
+static void
+Iter_dealloc (Iter_object * self)
+{
+  if (self->have_view) {
+    PyBuffer_Release (&self->view);
+  }
+  Py_XDECREF (self->s);
+  Py_XDECREF (self->functions);
+  Py_XDECREF (self->source);
+  Py_XDECREF (self->data);
+  Py_XDECREF (self->read);
+  Py_XDECREF (self->chunks);
+  Py_XDECREF (self->pending);
+  PyObject_Del (self);
+}
+
+/* append another chunk to what's left of <pending>.
+ * returns 1, 0 at the end of the input, or -1 on error */
+
+static int
+Iter_refill (Iter_object * self)
+{
+  PyObject * chunk;
+  PyObject * pending;
+  const char * chunk_data;
+  Py_ssize_t chunk_len;
+  int pending_len = self->pending ? PyString_GET_SIZE (self->pending) : 0;
+
+  if (self->read) {
+    /* read a good number of whole records at a time */
+    chunk = PyObject_CallFunction (self->read, "i", self->s->size * ((65536 / self->s->size) + 1));
+    if (!chunk) {
+      return -1;
+    }
+  } else {
+    chunk = PyIter_Next (self->chunks);
+    if (!chunk) {
+      return PyErr_Occurred() ? -1 : 0;
+    }
+  }
+  if (PyObject_AsCharBuffer (chunk, &chunk_data, &chunk_len) == -1) {
+    Py_DECREF (chunk);
+    return -1;
+  } else if (chunk_len == 0) {
+    Py_DECREF (chunk);
+    /* end of file; an iterator might just have an empty chunk */
+    return self->read ? 0 : 1;
+  }
+
+  if (self->pos >= pending_len) {
+    /* nothing left over (or still skipping the initial offset) */
+    self->pos -= pending_len;
+    if (PyString_CheckExact (chunk)) {
+      Py_INCREF (chunk);
+      pending = chunk;
+    } else {
+      pending = PyString_FromStringAndSize (chunk_data, chunk_len);
+    }
+  } else {
+    int left = pending_len - self->pos;
+    pending = PyString_FromStringAndSize (NULL, left + chunk_len);
+    if (pending) {
+      memcpy (PyString_AS_STRING (pending), PyString_AS_STRING (self->pending) + self->pos, left);
+      memcpy (PyString_AS_STRING (pending) + left, chunk_data, chunk_len);
+      self->pos = 0;
+    }
+  }
+  Py_DECREF (chunk);
+  if (!pending) {
+    return -1;
+  }
+  Py_XDECREF (self->pending);
+  self->pending = pending;
+  return 1;
+}
+
+static PyObject *
+Iter_next (Iter_object * self)
+{
+  int start = self->pos;
+  PyObject * result;
+
+  if (self->have_view) {
+    if (self->pos >= self->view.len) {
+      return NULL;
+    }
+    result = unpack_record (
+      self->s, self->data, (unsigned char *) self->view.buf, self->view.len,
+      &self->pos, self->functions
+      );
+  } else if (self->refetch) {
+    /* nothing keeps an old-style buffer (mmap, array) in place between
+     * calls: it may have been resized or closed since the last one */
+    Py_buffer view;
+    if (get_read_buffer (self->source, &view) == -1) {
+      return NULL;
+    } else if (self->pos >= view.len) {
+      PyBuffer_Release (&view);
+      return NULL;
+    }
+    result = unpack_record (
+      self->s, self->data, (unsigned char *) view.buf, view.len,
+      &self->pos, self->functions
+      );
+    PyBuffer_Release (&view);
+  } else {
+    while ((!self->pending) || ((self->pos + self->s->size) > PyString_GET_SIZE (self->pending))) {
+      int r = Iter_refill (self);
+      if (r == -1) {
+        return NULL;
+      } else if (r == 0) {
+        if (self->pending && (self->pos < PyString_GET_SIZE (self->pending))) {
+          PyErr_SetString (PyExc_ValueError, "not enough data");
+        }
+        return NULL;
+      }
+    }
+    start = self->pos;
+    result = unpack_record (
+      self->s, self->pending,
+      (unsigned char *) PyString_AS_STRING (self->pending), PyString_GET_SIZE (self->pending),
+      &self->pos, self->functions
+      );
+  }
+  if (result && (self->pos == start)) {
+    /* we'd go around forever */
+    PyErr_SetString (PyExc_ValueError, "record has zero length");
+    Py_DECREF (result);
+    return NULL;
+  }
+  return result;
+}
+
+static PyTypeObject Iter_Type = {
+  PyObject_HEAD_INIT(NULL)
+  0,                                /* ob_size */
+  "npstruct.unpack_iterator",       /* tp_name */
+  sizeof(Iter_object),              /* tp_basicsize */
+  0,                                /* tp_itemsize */
+  (destructor) Iter_dealloc,        /* tp_dealloc */
+  0,                                /* tp_print */
+  0,                                /* tp_getattr */
+  0,                                /* tp_setattr */
+  0,                                /* tp_compare */
+  0,                                /* tp_repr */
+  0,                                /* tp_as_number */
+  0,                                /* tp_as_sequence */
+  0,                                /* tp_as_mapping */
+  0,                                /* tp_hash */
+  0,                                /* tp_call */
+  0,                                /* tp_str */
+  PyObject_GenericGetAttr,          /* tp_getattro */
+  0,                                /* tp_setattro */
+  0,                                /* tp_as_buffer */
+  Py_TPFLAGS_DEFAULT,               /* tp_flags */
+  "iterator over packed records",   /* tp_doc */
+  0,                                /* tp_traverse */
+  0,                                /* tp_clear */
+  0,                                /* tp_richcompare */
+  0,                                /* tp_weaklistoffset */
+  PyObject_SelfIter,                /* tp_iter */
+  (iternextfunc) Iter_next,         /* tp_iternext */
+};
+
+static PyObject *
+make_iterator (Struct_object * s, PyObject * source, int offset, PyObject * functions)
+{
+  Iter_object * self = PyObject_New (Iter_object, &Iter_Type);
+  if (!self) {
+    return NULL;
+  }
+  Py_INCREF (s);
+  self->s = s;
+  Py_XINCREF (functions);
+  self->functions = functions;
+  Py_INCREF (source);
+  self->source = source;
+  self->have_view = 0;
+  self->refetch = 0;
+  self->data = NULL;
+  self->read = NULL;
+  self->chunks = NULL;
+  self->pending = NULL;
+  self->pos = offset;
+
+  if (offset < 0) {
+    PyErr_SetString (PyExc_ValueError, "offset out of range");
+    Py_DECREF (self);
+    return NULL;
+  } else if (PyObject_CheckBuffer (source) || PyObject_CheckReadBuffer (source)) {
+    Py_buffer view;
+    if (get_read_buffer (source, &view) == -1) {
+      Py_DECREF (self);
+      return NULL;
+    }
+    self->data = procfield_data (s, source, (unsigned char *) view.buf, view.len);
+    if (has_export (source)) {
+      /* the export pins the memory until it's released */
+      self->view = view;
+      self->have_view = 1;
+    } else {
+      PyBuffer_Release (&view);
+      self->refetch = 1;
+    }
+    if (!self->data) {
+      Py_DECREF (self);
+      return NULL;
+    }
+  } else {
+    if (s->variable || (s->size == 0)) {
+      PyErr_SetString (PyExc_ValueError, "reading from a file or chunks needs a fixed-size format");
+      Py_DECREF (self);
+      return NULL;
+    }
+    if (PyObject_HasAttrString (source, "read")) {
+      self->read = PyObject_GetAttrString (source, "read");
+    } else {
+      self->chunks = PyObject_GetIter (source);
+    }
+    if ((!self->read) && (!self->chunks)) {
+      Py_DECREF (self);
+      return NULL;
+    }
+  }
+  return (PyObject *) self;
+}
+
+static PyObject *
+Struct_iter_unpack (Struct_object * self, PyObject * arg_list)
+{
+  PyObject * source;
+  int offset = 0;
+
+  if (!PyArg_ParseTuple (arg_list, "O|i", &source, &offset)) {
+    return NULL;
+  } else {
+    return make_iterator (self, source, offset, self->functions);
+  }
+}
+
+static PyObject *
+Struct_repr (Struct_object * self)
+{
+  return PyString_FromFormat ("<npstruct.Struct '%s'>", PyString_AS_STRING (self->format));
+}
+
+static struct PyMethodDef Struct_methods[] = {
+  {"pack",                  (PyCFunction) Struct_pack,          METH_VARARGS},
+  {"unpack",                (PyCFunction) Struct_unpack,        METH_VARARGS},
+  {"pack_into",             (PyCFunction) Struct_pack_into,     METH_VARARGS},
+  {"unpack_from",           (PyCFunction) Struct_unpack_from,   METH_VARARGS},
+  {"iter_unpack",           (PyCFunction) Struct_iter_unpack,   METH_VARARGS},
+  {"unpack_native",         (PyCFunction) Struct_unpack_native, METH_VARARGS},
+  {"pack_native",           (PyCFunction) Struct_pack_native,   METH_VARARGS},
+  {NULL, NULL}              /* sentinel */
+};
+
+static struct PyMemberDef Struct_members[] = {
+  {"format",    T_OBJECT,   offsetof (Struct_object, format),    READONLY},
+  {"functions", T_OBJECT,   offsetof (Struct_object, functions), READONLY},
+  {"size",      T_INT,      offsetof (Struct_object, size),      READONLY},
+  {"native_size", T_INT,    offsetof (Struct_object, native_size), READONLY},
+  {"variable",  T_INT,      offsetof (Struct_object, variable),  READONLY},
+  {NULL}                    /* sentinel */
+};
+
+static PyTypeObject Struct_Type = {
+  PyObject_HEAD_INIT(NULL)
+  0,                                /* ob_size */
+  "npstruct.Struct",                /* tp_name */
+  sizeof(Struct_object),            /* tp_basicsize */
+  0,                                /* tp_itemsize */
+  (destructor) Struct_dealloc,      /* tp_dealloc */
+  0,                                /* tp_print */
+  0,                                /* tp_getattr */
+  0,                                /* tp_setattr */
+  0,                                /* tp_compare */
+  (reprfunc) Struct_repr,           /* tp_repr */
+  0,                                /* tp_as_number */
+  0,                                /* tp_as_sequence */
+  0,                                /* tp_as_mapping */
+  0,                                /* tp_hash */
+  0,                                /* tp_call */
+  0,                                /* tp_str */
+  PyObject_GenericGetAttr,          /* tp_getattro */
+  0,                                /* tp_setattro */
+  0,                                /* tp_as_buffer */
+  Py_TPFLAGS_DEFAULT,               /* tp_flags */
+  "compiled npstruct format",       /* tp_doc */
+  0,                                /* tp_traverse */
+  0,                                /* tp_clear */
+  0,                                /* tp_richcompare */
+  0,                                /* tp_weaklistoffset */
+  0,                                /* tp_iter */
+  0,                                /* tp_iternext */
+  Struct_methods,                   /* tp_methods */
+  Struct_members,                   /* tp_members */
+};
+
+/* ------------------------------------------------------------------
+ * bit streams
+ *
+ * bit_stream_reader reads fields of any width from any buffer,
+ * without copying it, at any bit position.  bit_stream_writer
+ * builds a string from fields of any width.  Bits go MSB first
+ * unless <lsb_first> is set, in which case each byte is used from its
+ * least significant bit up, and the first bit read is the least
+ * significant bit of the result (as in GIF's LZW codes).  Fields of
+ * up to 32 bits at a time are handled by get_bits/put_bits (or their
+ * LSB-first versions); wider ones are put together from 32-bit pieces.
+ * ------------------------------------------------------------------ */
+
+static unsigned PY_LONG_LONG
+get_bits_lsb (unsigned char * data, Py_ssize_t start, int num_bits)
+{
+  unsigned PY_LONG_LONG x = 0;
+  Py_ssize_t end = start + num_bits;
+  Py_ssize_t i;
+  int shift = 0;
+
+  for (i = (start >> 3); i < ((end + 7) >> 3); i++) {
+    x |= ((unsigned PY_LONG_LONG) data[i]) << shift;
+    shift += 8;
+  }
+  x >>= (start & 7);
+  return x & ((((unsigned PY_LONG_LONG) 1) << num_bits) - 1);
+}
+
+static void
+put_bits_lsb (unsigned char * data, Py_ssize_t start, int num_bits, unsigned PY_LONG_LONG x)
+{
+  Py_ssize_t end = start + num_bits;
+  Py_ssize_t i;
+
+  x <<= (start & 7);
+  for (i = (start >> 3); i < ((end + 7) >> 3); i++) {
+    data[i] |= (unsigned char) (x & 0xff);
+    x >>= 8;
+  }
+}
+
+/* read <num_bits> starting <start> bits into <data>, as a python number */
+
+static PyObject *
+read_stream_bits (unsigned char * data, Py_ssize_t start, int num_bits, int lsb_first)
+{
+  if (num_bits <= 32) {
+    unsigned PY_LONG_LONG x;
+    if (num_bits == 0) {
+      x = 0;
+    } else if (lsb_first) {
+      x = get_bits_lsb (data, start, num_bits);
+    } else {
+      x = get_bits (data, start, num_bits);
+    }
+    if (x <= LONG_MAX) {
+      return PyInt_FromLong ((long) x);
+    } else {
+      return PyLong_FromUnsignedLongLong (x);
+    }
+  } else {
+    /* a 32-bit piece at a time */
+    PyObject * result = PyLong_FromLong (0);
+    int done = 0;
+    while (result && (done < num_bits)) {
+      int n = ((num_bits - done) > 32) ? 32 : (num_bits - done);
+      PyObject * piece;
+      PyObject * shift;
+      PyObject * tmp;
+      if (lsb_first) {
+        piece = PyLong_FromUnsignedLongLong (get_bits_lsb (data, start + done, n));
+        shift = PyInt_FromLong (done);
+        tmp = (piece && shift) ? PyNumber_Lshift (piece, shift) : NULL;
+        Py_XDECREF (piece);
+        piece = tmp;
+        tmp = piece ? PyNumber_Or (result, piece) : NULL;
+      } else {
+        piece = PyLong_FromUnsignedLongLong (get_bits (data, start + done, n));
+        shift = PyInt_FromLong (n);
+        tmp = (piece && shift) ? PyNumber_Lshift (result, shift) : NULL;
+        Py_DECREF (result);
+        result = tmp;
+        tmp = (result && piece) ? PyNumber_Or (result, piece) : NULL;
+      }
+      Py_XDECREF (piece);
+      Py_XDECREF (shift);
+      Py_XDECREF (result);
+      result = tmp;
+      done += n;
+    }
+    return result;
+  }
+}
+
+typedef struct {
+  PyObject_HEAD
+  Py_buffer view;
+  PyObject * source;    /* an old-style buffer, fetched again for each call */
+  Py_ssize_t pos;       /* in bits */
+  int lsb_first;
+} Reader_object;
+
+static void
+Reader_dealloc (Reader_object * self)
+{
+  PyBuffer_Release (&self->view);
+  Py_XDECREF (self->source);
+  PyObject_Del (self);
+}
+
+/* nothing keeps an old-style buffer (mmap, array) in place between
+ * calls, so its view is fetched again before it's read.  a view with
+ * a real export pins the memory, and is kept. */
+
+static int
+reader_fetch (Reader_object * self)
+{
+  if (self->source) {
+    Py_buffer view;
+    if (get_read_buffer (self->source, &view) == -1) {
+      return -1;
+    }
+    PyBuffer_Release (&self->view);
+    self->view = view;
+  }
+  return 0;
+}
+
+static int
+reader_check (Reader_object * self, Py_ssize_t num_bits)
+{
+  if (num_bits < 0) {
+    PyErr_SetString (PyExc_ValueError, "negative number of bits");
+    return -1;
+  } else if ((self->pos + num_bits) > (self->view.len * 8)) {
+    PyErr_SetString (PyExc_ValueError, "not enough data");
+    return -1;
+  } else {
+    return 0;
+  }
+}
+
+static PyObject *
+Reader_peek_bits (Reader_object * self, PyObject * arg_list)
+{
+  int num_bits;
+  if (!PyArg_ParseTuple (arg_list, "i", &num_bits)
+      || (reader_fetch (self) == -1)
+      || (reader_check (self, num_bits) == -1)) {
+    return NULL;
+  } else {
+    return read_stream_bits ((unsigned char *) self->view.buf, self->pos, num_bits, self->lsb_first);
+  }
+}
+
+static PyObject *
+Reader_read_bits (Reader_object * self, PyObject * arg_list)
+{
+  int num_bits;
+  PyObject * result;
+  if (!PyArg_ParseTuple (arg_list, "i", &num_bits)
+      || (reader_fetch (self) == -1)
+      || (reader_check (self, num_bits) == -1)) {
+    return NULL;
+  }
+  result = read_stream_bits ((unsigned char *) self->view.buf, self->pos, num_bits, self->lsb_first);
+  if (result) {
+    self->pos += num_bits;
+  }
+  return result;
+}
+
+/* read_many (num_bits, count): a list of <count> fields */
+
+static PyObject *
+Reader_read_many (Reader_object * self, PyObject * arg_list)
+{
+  int num_bits;
+  Py_ssize_t count;
+  Py_ssize_t i;
+  PyObject * result;
+
+  if (!PyArg_ParseTuple (arg_list, "in", &num_bits, &count) || (reader_fetch (self) == -1)) {
+    return NULL;
+  } else if ((count < 0) || ((num_bits > 0) && (count > (((self->view.len * 8) - self->pos) / num_bits)))) {
+    PyErr_SetString (PyExc_ValueError, "not enough data");
+    return NULL;
+  } else if (reader_check (self, num_bits) == -1) {
+    return NULL;
+  }
+  result = PyList_New (count);
+  for (i=0; result && (i < count); i++) {
+    PyObject * value = read_stream_bits ((unsigned char *) self->view.buf, self->pos, num_bits, self->lsb_first);
+    if (!value) {
+      Py_DECREF (result);
+      return NULL;
+    }
+    PyList_SET_ITEM (result, i, value);
+    self->pos += num_bits;
+  }
+  return result;
+}
+
+static PyObject *
+Reader_next_bit (Reader_object * self, PyObject * arg_list)
+{
+  if ((reader_fetch (self) == -1) || (reader_check (self, 1) == -1)) {
+    return NULL;
+  } else {
+    unsigned char byte = ((unsigned char *) self->view.buf)[self->pos >> 3];
+    int shift = self->lsb_first ? (self->pos & 7) : (7 - (self->pos & 7));
+    self->pos++;
+    return PyInt_FromLong ((byte >> shift) & 1);
+  }
+}
+
+static PyObject *
+Reader_skip_bits (Reader_object * self, PyObject * arg_list)
+{
+  Py_ssize_t num_bits;
+  if (!PyArg_ParseTuple (arg_list, "n", &num_bits) || (reader_fetch (self) == -1)) {
+    return NULL;
+  } else if (((self->pos + num_bits) < 0) || ((self->pos + num_bits) > (self->view.len * 8))) {
+    PyErr_SetString (PyExc_ValueError, "skip out of range");
+    return NULL;
+  } else {
+    self->pos += num_bits;
+    Py_INCREF (Py_None);
+    return Py_None;
+  }
+}
+
+/* skip to the next byte boundary */
+
+static PyObject *
+Reader_align (Reader_object * self, PyObject * arg_list)
+{
+  if (reader_fetch (self) == -1) {
+    return NULL;
+  }
+  self->pos = (self->pos + 7) & ~((Py_ssize_t) 7);
+  if (self->pos > (self->view.len * 8)) {
+    self->pos = self->view.len * 8;
+  }
+  Py_INCREF (Py_None);
+  return Py_None;
+}
+
+static PyObject *
+Reader_tell (Reader_object * self, PyObject * arg_list)
+{
+  return PyInt_FromSsize_t (self->pos);
+}
+
+static PyObject *
+Reader_bits_left (Reader_object * self, PyObject * arg_list)
+{
+  if (reader_fetch (self) == -1) {
+    return NULL;
+  }
+  return PyInt_FromSsize_t ((self->view.len * 8) - self->pos);
+}
+
+static struct PyMethodDef Reader_methods[] = {
+  {"read_bits",             (PyCFunction) Reader_read_bits,     METH_VARARGS},
+  {"peek_bits",             (PyCFunction) Reader_peek_bits,     METH_VARARGS},
+  {"read_many",             (PyCFunction) Reader_read_many,     METH_VARARGS},
+  {"skip_bits",             (PyCFunction) Reader_skip_bits,     METH_VARARGS},
+  {"next_bit",              (PyCFunction) Reader_next_bit,      METH_NOARGS},
+  {"align",                 (PyCFunction) Reader_align,         METH_NOARGS},
+  {"tell",                  (PyCFunction) Reader_tell,          METH_NOARGS},
+  {"bits_left",             (PyCFunction) Reader_bits_left,     METH_NOARGS},
+  {NULL, NULL}              /* sentinel */
+};
+
+static PyObject *
+Reader_get_byte_pos (Reader_object * self, void * closure)
+{
+  return PyInt_FromSsize_t (self->pos >> 3);
+}
+
+static PyObject *
+Reader_get_bit_pos (Reader_object * self, void * closure)
+{
+  return PyInt_FromLong ((long) (self->pos & 7));
+}
+
+static PyGetSetDef Reader_getset[] = {
+  {"byte_pos", (getter) Reader_get_byte_pos, NULL, "current byte"},
+  {"bit_pos",  (getter) Reader_get_bit_pos,  NULL, "bits used of the current byte"},
+  {NULL}
+};
+
+static PyTypeObject Reader_Type = {
+  PyObject_HEAD_INIT(NULL)
+  0,                                /* ob_size */
+  "npstruct.bit_stream_reader",     /* tp_name */
+  sizeof(Reader_object),            /* tp_basicsize */
+  0,                                /* tp_itemsize */
+  (destructor) Reader_dealloc,      /* tp_dealloc */
+  0,                                /* tp_print */
+  0,                                /* tp_getattr */
+  0,                                /* tp_setattr */
+  0,                                /* tp_compare */
+  0,                                /* tp_repr */
+  0,                                /* tp_as_number */
+  0,                                /* tp_as_sequence */
+  0,                                /* tp_as_mapping */
+  0,                                /* tp_hash */
+  0,                                /* tp_call */
+  0,                                /* tp_str */
+  PyObject_GenericGetAttr,          /* tp_getattro */
+  0,                                /* tp_setattro */
+  0,                                /* tp_as_buffer */
+  Py_TPFLAGS_DEFAULT,               /* tp_flags */
+  "bit stream reader",              /* tp_doc */
+  0,                                /* tp_traverse */
+  0,                                /* tp_clear */
+  0,                                /* tp_richcompare */
+  0,                                /* tp_weaklistoffset */
+  0,                                /* tp_iter */
+  0,                                /* tp_iternext */
+  Reader_methods,                   /* tp_methods */
+  0,                                /* tp_members */
+  Reader_getset,                    /* tp_getset */
+};
+
+typedef struct {
+  PyObject_HEAD
+  unsigned char * data;
+  Py_ssize_t len;       /* allocated, in bytes */
+  Py_ssize_t pos;       /* in bits */
+  int lsb_first;
+} Writer_object;
+
+static void
+Writer_dealloc (Writer_object * self)
+{
+  if (self->data) {
+    PyMem_Free (self->data);
+  }
+  PyObject_Del (self);
+}
+
+/* make room for another <num_bits>, zero-filled */
+
+static int
+writer_room (Writer_object * self, Py_ssize_t num_bits)
+{
+  Py_ssize_t needed = (self->pos + num_bits + 7) >> 3;
+  if (needed > self->len) {
+    Py_ssize_t new_len = self->len ? self->len : 64;
+    unsigned char * data;
+    while (new_len < needed) {
+      new_len *= 2;
+    }
+    data = (unsigned char *) PyMem_Realloc (self->data, new_len);
+    if (!data) {
+      PyErr_NoMemory();
+      return -1;
+    }
+    memset (data + self->len, 0, new_len - self->len);
+    self->data = data;
+    self->len = new_len;
+  }
+  return 0;
+}
+
+static void
+write_piece (Writer_object * self, int num_bits, unsigned PY_LONG_LONG x)
+{
+  if (num_bits) {
+    if (self->lsb_first) {
+      put_bits_lsb (self->data, self->pos, num_bits, x);
+    } else {
+      put_bits (self->data, self->pos, num_bits, x);
+    }
+    self->pos += num_bits;
+  }
+}
+
+static PyObject *
+Writer_write_bits (Writer_object * self, PyObject * arg_list)
+{
+  PyObject * number;
+  int num_bits;
+  PyObject * limit;
+  int too_big;
+
+  if (!PyArg_ParseTuple (arg_list, "Oi", &number, &num_bits)) {
+    return NULL;
+  } else if (num_bits < 0) {
+    PyErr_SetString (PyExc_ValueError, "negative number of bits");
+    return NULL;
+  }
+  if (PyInt_Check (number) && (num_bits <= 32)) {
+    long x = PyInt_AS_LONG (number);
+    if ((x < 0) || ((unsigned PY_LONG_LONG) x >= (((unsigned PY_LONG_LONG) 1) << num_bits))) {
+      PyErr_SetString (PyExc_ValueError, "number too big for specified number of bits");
+      return NULL;
+    } else if (writer_room (self, num_bits) == -1) {
+      return NULL;
+    }
+    write_piece (self, num_bits, (unsigned PY_LONG_LONG) x);
+    Py_INCREF (Py_None);
+    return Py_None;
+  }
+  /* the general case: check against 1<<num_bits, then write 32-bit pieces */
+  limit = PyLong_FromLong (1);
+  if (limit) {
+    PyObject * shift = PyInt_FromLong (num_bits);
+    PyObject * tmp = shift ? PyNumber_Lshift (limit, shift) : NULL;
+    Py_XDECREF (shift);
+    Py_DECREF (limit);
+    limit = tmp;
+  }
+  if (!limit) {
+    return NULL;
+  }
+  too_big = PyObject_RichCompareBool (number, limit, Py_GE);
+  Py_DECREF (limit);
+  if (too_big == 0) {
+    PyObject * zero = PyInt_FromLong (0);
+    too_big = zero ? PyObject_RichCompareBool (number, zero, Py_LT) : -1;
+    Py_XDECREF (zero);
+  }
+  if (too_big == -1) {
+    return NULL;
+  } else if (too_big) {
+    PyErr_SetString (PyExc_ValueError, "number too big for specified number of bits");
+    return NULL;
+  } else if (writer_room (self, num_bits) == -1) {
+    return NULL;
+  } else {
+    int done = 0;
+    while (done < num_bits) {
+      int n = ((num_bits - done) > 32) ? 32 : (num_bits - done);
+      /* the piece is the top <n> bits left, or the bottom ones */
+      int shift_by = self->lsb_first ? done : (num_bits - done - n);
+      PyObject * shift = PyInt_FromLong (shift_by);
+      PyObject * piece = shift ? PyNumber_Rshift (number, shift) : NULL;
+      unsigned PY_LONG_LONG x;
+      Py_XDECREF (shift);
+      if (!piece) {
+        return NULL;
+      }
+      x = PyLong_Check (piece) ? PyLong_AsUnsignedLongLongMask (piece) : (unsigned PY_LONG_LONG) PyInt_AsLong (piece);
+      Py_DECREF (piece);
+      write_piece (self, n, x & ((((unsigned PY_LONG_LONG) 1) << n) - 1));
+      done += n;
+    }
+    Py_INCREF (Py_None);
+    return Py_None;
+  }
+}
+
+/* done ([pad]): the string written so far.  unless <pad> is true,
+ * it has to have ended on a byte boundary */
+
+static PyObject *
+Writer_done (Writer_object * self, PyObject * arg_list)
+{
+  int pad = 0;
+  if (!PyArg_ParseTuple (arg_list, "|i", &pad)) {
+    return NULL;
+  } else if ((self->pos & 7) && !pad) {
+    PyErr_SetString (PyExc_ValueError, "didn't finish on a byte boundary!");
+    return NULL;
+  } else {
+    return PyString_FromStringAndSize ((char *) self->data, (self->pos + 7) >> 3);
+  }
+}
+
+static PyObject *
+Writer_tell (Writer_object * self, PyObject * arg_list)
+{
+  return PyInt_FromSsize_t (self->pos);
+}
+
+static struct PyMethodDef Writer_methods[] = {
+  {"write_bits",            (PyCFunction) Writer_write_bits,    METH_VARARGS},
+  {"done",                  (PyCFunction) Writer_done,          METH_VARARGS},
+  {"tell",                  (PyCFunction) Writer_tell,          METH_NOARGS},
+  {NULL, NULL}              /* sentinel */
+};
+
+static PyTypeObject Writer_Type = {
+  PyObject_HEAD_INIT(NULL)
+  0,                                /* ob_size */
+  "npstruct.bit_stream_writer",     /* tp_name */
+  sizeof(Writer_object),            /* tp_basicsize */
+  0,                                /* tp_itemsize */
+  (destructor) Writer_dealloc,      /* tp_dealloc */
+  0,                                /* tp_print */
+  0,                                /* tp_getattr */
+  0,                                /* tp_setattr */
+  0,                                /* tp_compare */
+  0,                                /* tp_repr */
+  0,                                /* tp_as_number */
+  0,                                /* tp_as_sequence */
+  0,                                /* tp_as_mapping */
+  0,                                /* tp_hash */
+  0,                                /* tp_call */
+  0,                                /* tp_str */
+  PyObject_GenericGetAttr,          /* tp_getattro */
+  0,                                /* tp_setattro */
+  0,                                /* tp_as_buffer */
+  Py_TPFLAGS_DEFAULT,               /* tp_flags */
+  "bit stream writer",              /* tp_doc */
+  0,                                /* tp_traverse */
+  0,                                /* tp_clear */
+  0,                                /* tp_richcompare */
+  0,                                /* tp_weaklistoffset */
+  0,                                /* tp_iter */
+  0,                                /* tp_iternext */
+  Writer_methods,                   /* tp_methods */
+};
+
+/* ------------------------------------------------------------------
+ * GIF LZW
+ *
+ * lzw_decode reads the image data sub-blocks straight out of the
+ * source buffer (no joining them into a string first) and writes
+ * palette indices into a buffer the caller supplies - a bytearray, a
+ * numpy array of uint8...  With <interlace>, rows of <width> pixels
+ * are put back in their proper order.  lzw_encode does the reverse,
+ * and returns the sub-blocks (and terminator) ready to be written.
+ * ------------------------------------------------------------------ */
+
+#define LZW_MAX_CODES 4096
+
+/* the destination row of each row of an image, in the order they're stored */
+
+static int *
+interlace_rows (int height, int interlace)
+{
+  static int starts[] = {0, 4, 2, 1};
+  static int steps[] = {8, 8, 4, 2};
+  int * rows = (int *) PyMem_Malloc ((height ? height : 1) * sizeof(int));
+  int i, k = 0;
+
+  if (!rows) {
+    PyErr_NoMemory();
+    return NULL;
+  }
+  if (interlace) {
+    int pass;
+    for (pass=0; pass < 4; pass++) {
+      for (i = starts[pass]; i < height; i += steps[pass]) {
+        rows[k++] = i;
+      }
+    }
+  } else {
+    for (i=0; i < height; i++) {
+      rows[i] = i;
+    }
+  }
+  return rows;
+}
+
+typedef struct {
+  unsigned char * data;
+  int len;
+  int pos;              /* next byte in the source */
+  int block_left;       /* bytes left in the current sub-block */
+  int done;             /* seen the terminator */
+  unsigned long bits;
+  int num_bits;
+  const char * error;   /* set instead of raising: see lzw_decode */
+} lzw_input;
+
+/* the next <code_size> bits, LSB first, or -1 at the end of the data */
+
+static int
+lzw_read_code (lzw_input * in, int code_size)
+{
+  int code;
+  while (in->num_bits < code_size) {
+    if (!in->block_left) {
+      if (in->done) {
+        return -1;
+      } else if (in->pos >= in->len) {
+        in->error = "truncated image data";
+        return -2;
+      }
+      in->block_left = in->data[in->pos++];
+      if (!in->block_left) {
+        in->done = 1;
+        return -1;
+      }
+    }
+    if (in->pos >= in->len) {
+      in->error = "truncated image data";
+      return -2;
+    }
+    in->bits |= ((unsigned long) in->data[in->pos++]) << in->num_bits;
+    in->num_bits += 8;
+    in->block_left--;
+  }
+  code = (int) (in->bits & ((1UL << code_size) - 1));
+  in->bits >>= code_size;
+  in->num_bits -= code_size;
+  return code;
+}
+
+/* skip whatever follows the end-of-information code, up to and including
+ * the terminator */
+
+static int
+lzw_skip_blocks (lzw_input * in)
+{
+  in->pos += in->block_left;
+  in->block_left = 0;
+  while (!in->done) {
+    if (in->pos >= in->len) {
+      in->error = "truncated image data";
+      return -1;
+    } else if (!in->data[in->pos]) {
+      in->pos++;
+      in->done = 1;
+    } else {
+      in->pos += 1 + in->data[in->pos];
+    }
+  }
+  return 0;
+}
+
+/* decode into <out>, <height> rows of <width> pixels, stored in the
+ * order given by <rows>.  this doesn't touch any python objects, so it
+ * can run without the interpreter lock.  returns the number of pixels
+ * written, or -1 with in->error set */
+
+static int
+lzw_decode_data (lzw_input * in, int min_code_size, unsigned char * out, int width, int height, int * rows)
+{
+  unsigned short prefix[LZW_MAX_CODES];
+  unsigned char suffix[LZW_MAX_CODES];
+  unsigned char first[LZW_MAX_CODES];
+  unsigned short length[LZW_MAX_CODES];
+  unsigned char stack[LZW_MAX_CODES];
+  int clear = 1 << min_code_size;
+  int eoi = clear + 1;
+  int code_size = min_code_size + 1;
+  int next = eoi + 1;
+  int prev = -1;
+  int row = 0, col = 0;
+  int written = 0;
+  int i;
+
+  for (i=0; i < clear; i++) {
+    prefix[i] = 0;
+    suffix[i] = first[i] = (unsigned char) i;
+    length[i] = 1;
+  }
+  while (1) {
+    int code = lzw_read_code (in, code_size);
+    int n;
+    if (code == -2) {
+      return -1;
+    } else if ((code == -1) || (code == eoi)) {
+      break;
+    } else if (code == clear) {
+      code_size = min_code_size + 1;
+      next = eoi + 1;
+      prev = -1;
+      continue;
+    } else if (prev == -1) {
+      if (code > clear) {
+        in->error = "bad lzw code";
+        return -1;
+      }
+      n = 1;
+      stack[0] = suffix[code];
+    } else {
+      int c;
+      if (code > next) {
+        in->error = "bad lzw code";
+        return -1;
+      } else if (next < LZW_MAX_CODES) {
+        /* the new entry is <prev> plus the first character of <code>,
+           which, if <code> is the new entry itself, is <prev>'s */
+        prefix[next] = prev;
+        suffix[next] = (code == next) ? first[prev] : first[code];
+        first[next] = first[prev];
+        length[next] = length[prev] + 1;
+        next++;
+        if ((next == (1 << code_size)) && (code_size < 12)) {
+          code_size++;
+        }
+      } else if (code == next) {
+        in->error = "bad lzw code";
+        return -1;
+      }
+      /* the string for <code>, back to front */
+      n = length[code];
+      for (i = n - 1, c = code; i >= 0; i--) {
+        stack[i] = suffix[c];
+        c = prefix[c];
+      }
+    }
+    prev = code;
+    for (i=0; (i < n) && (row < height); i++) {
+      out[(rows[row] * width) + col] = stack[i];
+      written++;
+      if (++col == width) {
+        col = 0;
+        row++;
+      }
+    }
+  }
+  if (lzw_skip_blocks (in) == -1) {
+    return -1;
+  } else {
+    return written;
+  }
+}
+
+typedef struct {
+  PyObject * string;
+  int pos;              /* in the string */
+  int block_start;      /* size byte of the current sub-block */
+  unsigned long bits;
+  int num_bits;
+} lzw_output;
+
+static int
+lzw_write_byte (lzw_output * out, unsigned char byte)
+{
+  /* room for this byte, and the size byte of another block */
+  if ((out->pos + 2) > PyString_GET_SIZE (out->string)) {
+    if (_PyString_Resize (&out->string, PyString_GET_SIZE (out->string) * 2) == -1) {
+      return -1;
+    }
+  }
+  if ((out->pos - out->block_start) == 256) {
+    /* the current sub-block is full */
+    PyString_AS_STRING (out->string)[out->block_start] = (char) 255;
+    out->block_start = out->pos++;
+  }
+  PyString_AS_STRING (out->string)[out->pos++] = byte;
+  return 0;
+}
+
+static int
+lzw_write_code (lzw_output * out, int code, int code_size)
+{
+  out->bits |= ((unsigned long) code) << out->num_bits;
+  out->num_bits += code_size;
+  while (out->num_bits >= 8) {
+    if (lzw_write_byte (out, (unsigned char) (out->bits & 0xff)) == -1) {
+      return -1;
+    }
+    out->bits >>= 8;
+    out->num_bits -= 8;
+  }
+  return 0;
+}
+
+static PyObject *
+lzw_encode_data (unsigned char * data, int data_len, int min_code_size, int width, int interlace)
+{
+  /* open hash table of (prefix << 8 | character) -> code */
+#define LZW_HASH_SIZE 5003
+  long keys[LZW_HASH_SIZE];
+  unsigned short codes[LZW_HASH_SIZE];
+  int clear = 1 << min_code_size;
+  int eoi = clear + 1;
+  int code_size = min_code_size + 1;
+  int next = eoi + 1;
+  int height = width ? (data_len / width) : 1;
+  int * rows;
+  int cur = -1;
+  int i, j;
+  lzw_output out;
+
+  if (!width) {
+    width = data_len;
+  } else if (data_len != width * height) {
+    PyErr_SetString (PyExc_ValueError, "image data isn't a whole number of rows");
+    return NULL;
+  }
+  rows = interlace_rows (height, interlace);
+  out.string = PyString_FromStringAndSize (NULL, 256 + (data_len / 2));
+  if ((!rows) || (!out.string)) {
+    PyMem_Free (rows);
+    Py_XDECREF (out.string);
+    return NULL;
+  }
+  out.block_start = 0;
+  out.pos = 1;
+  out.bits = 0;
+  out.num_bits = 0;
+  for (i=0; i < LZW_HASH_SIZE; i++) {
+    keys[i] = -1;
+  }
+  if (lzw_write_code (&out, clear, code_size) == -1) {
+    goto error;
+  }
+  for (j=0; j < height; j++) {
+    unsigned char * p = data + (rows[j] * width);
+    for (i=0; i < width; i++) {
+      int c = p[i];
+      long key;
+      int h;
+      if (c >= clear) {
+        PyErr_SetString (PyExc_ValueError, "pixel value too big for the code size");
+        goto error;
+      } else if (cur == -1) {
+        cur = c;
+        continue;
+      }
+      key = ((long) cur << 8) | c;
+      h = (int) (((c << 4) ^ cur) % LZW_HASH_SIZE);
+      while ((keys[h] != -1) && (keys[h] != key)) {
+        h = (h + 1) % LZW_HASH_SIZE;
+      }
+      if (keys[h] == key) {
+        cur = codes[h];
+        continue;
+      }
+      if (lzw_write_code (&out, cur, code_size) == -1) {
+        goto error;
+      }
+      if (next < LZW_MAX_CODES) {
+        keys[h] = key;
+        codes[h] = (unsigned short) next++;
+        if ((next > (1 << code_size)) && (code_size < 12)) {
+          code_size++;
+        }
+      } else {
+        /* table full: start over */
+        if (lzw_write_code (&out, clear, code_size) == -1) {
+          goto error;
+        }
+        for (h=0; h < LZW_HASH_SIZE; h++) {
+          keys[h] = -1;
+        }
+        code_size = min_code_size + 1;
+        next = eoi + 1;
+      }
+      cur = c;
+    }
+  }
+  if (cur != -1) {
+    if (lzw_write_code (&out, cur, code_size) == -1) {
+      goto error;
+    }
+    /* the decoder adds an entry on the last code, and may widen */
+    if ((next < LZW_MAX_CODES) && (++next > (1 << code_size)) && (code_size < 12)) {
+      code_size++;
+    }
+  }
+  if ((lzw_write_code (&out, eoi, code_size) == -1) ||
+      (out.num_bits && (lzw_write_byte (&out, (unsigned char) (out.bits & 0xff)) == -1))) {
+    goto error;
+  }
+  /* close the last sub-block (if it's empty, its size byte is the terminator) */
+  if (out.pos - out.block_start > 1) {
+    PyString_AS_STRING (out.string)[out.block_start] = (char) (out.pos - out.block_start - 1);
+    PyString_AS_STRING (out.string)[out.pos++] = 0;
+  } else {
+    PyString_AS_STRING (out.string)[out.block_start] = 0;
+    out.pos = out.block_start + 1;
+  }
+  PyMem_Free (rows);
+  if (_PyString_Resize (&out.string, out.pos) == -1) {
+    return NULL;
+  }
+  return out.string;
+
+ error:
+  PyMem_Free (rows);
+  Py_DECREF (out.string);
+  return NULL;
+#undef LZW_HASH_SIZE
+}
+
+/* ------------------------------------------------------------------
+ * format cache
+ *
+ * The module-level pack() and unpack() keep the compiled form of
+ * the last MAXCACHE formats they were handed, evicting the least
+ * recently used one when the cache is full.
+ * ------------------------------------------------------------------ */
+
+#define MAXCACHE 100
+
+static PyObject * format_cache = NULL;
+static long cache_tick = 0;
+
+static void
+evict_format (void)
+{
+  Py_ssize_t pos = 0;
+  PyObject * key;
+  PyObject * value;
+  PyObject * oldest_key = NULL;
+  long oldest_tick = 0;
+
+  while (PyDict_Next (format_cache, &pos, &key, &value)) {
+    long tick = ((Struct_object *) value)->tick;
+    if ((!oldest_key) || (tick < oldest_tick)) {
+      oldest_key = key;
+      oldest_tick = tick;
+    }
+  }
+  if (oldest_key) {
+    PyDict_DelItem (format_cache, oldest_key);
   }
-  return pos;
 }
 
+/* returns a new reference: a procfield function may run
+ * pack/unpack on other formats and evict this one */
 
-static PyObject *
-pack_bitfield (PyObject * bit_lengths, PyObject * data, int data_pos)
+static Struct_object *
+get_struct (PyObject * format)
 {
-  int i;
-  int bit_pos = 0;
-  unsigned char byte = 0;
+  Struct_object * s = (Struct_object *) PyDict_GetItem (format_cache, format);
+  if (s) {
+    Py_INCREF (s);
+  } else {
+    s = compile_format (PyString_AS_STRING (format), PyString_GET_SIZE (format), NULL, 0);
+    if (!s) {
+      return NULL;
+    }
+    if (PyDict_Size (format_cache) >= MAXCACHE) {
+      evict_format();
+    }
+    if (PyDict_SetItem (format_cache, format, (PyObject *) s) == -1) {
+      Py_DECREF (s);
+      return NULL;
+    }
+  }
+  s->tick = ++cache_tick;
+  return s;
+}
 
-  /* how many bytes? */
-  int num = PyList_Size (bit_lengths);
-  int total_bits = 0;
+static
+PyObject  *
+compile (PyObject * self, PyObject * arg_list)
+{
+  char * format;
+  int format_len;
+  PyObject * functions = NULL;
+  int compact = 0;
 
-  if ((PyTuple_Size (data) + data_pos) < num) {
-    PyErr_SetString (PyExc_ValueError, "not enough data for bitfields");
+  if (!PyArg_ParseTuple (arg_list,
+                         "s#|O!i",
+                         &format,
+                         &format_len,
+                         &PyDict_Type,
+                         &functions,
+                         &compact
+                         )) {
     return NULL;
+  } else {
+    return (PyObject *) compile_format (format, format_len, functions, compact);
   }
+}
 
-  for (i=0; i < num; i++) {
-    total_bits += PyInt_AsLong (PyList_GetItem (bit_lengths, i));
-  }
+static
+PyObject  *
+pack (PyObject * self, PyObject * arg_list)
+{
+  PyObject * format;
+  PyObject * args;
+  PyObject * functions = NULL;
 
-  if ((total_bits % 8) != 0) {
-    PyErr_SetString (PyExc_ValueError, "bitfields not octet-aligned");
+  if (!PyArg_ParseTuple (arg_list,
+                         "SO!|O!",
+                         &format,
+                         &PyTuple_Type,
+                         &args,
+                         &PyDict_Type,
+                         &functions
+                         )) {
     return NULL;
   } else {
-    PyObject * result = PyString_FromString ("");
-    for (i=0; i < num; i++) {
-      int num_bits = PyInt_AsLong (PyList_GetItem  (bit_lengths, i));
-      int value    = PyInt_AsLong (PyTuple_GetItem (data, i+data_pos));
-      if (value >= (1 << num_bits)) {
-        PyErr_SetString (PyExc_ValueError, "number too big for specified number of bits");
-        return NULL;
-      } else {
-        while (num_bits) {
-          if (bit_pos == 8) {
-            /* start a new output byte */
-            PyString_ConcatAndDel (&result, PyString_FromStringAndSize ((char*)&byte, 1));
-            byte = 0;
-            bit_pos = 0;
-          }
-          num_bits = num_bits - 1;
-          byte <<= 1;
-          if (value & (1<<num_bits)) {
-            byte |= 1;
-          }
-          bit_pos += 1;
-        }
-      }
+    Struct_object * s = get_struct (format);
+    PyObject * result;
+    if (!s) {
+      return NULL;
     }
-    PyString_ConcatAndDel (&result, PyString_FromStringAndSize ((char*)&byte, 1));
+    result = Struct_pack_args (s, args, functions);
+    Py_DECREF (s);
     return result;
   }
 }
 
 static
-int
-unpack_bitfield (
-  PyObject * bit_length_list,
-  PyObject * result_list,
-  unsigned char * data,
-  int data_pos,
-  int data_len
-  )
+PyObject  *
+unpack (PyObject * self, PyObject * arg_list)
 {
-  int i;
-  /* how many bytes? */
-  int num = PyList_Size (bit_length_list);
-  int total_bits = 0;
-  
-  for (i=0; i < num; i++) {
-    total_bits += PyInt_AsLong (PyList_GetItem (bit_length_list, i));
-  }
+  PyObject * format;
+  unsigned char * data;
+  int data_len;
+  int data_pos=0;
+  PyObject * functions = NULL;
 
-  if ((total_bits % 8) != 0) {
-    PyErr_SetString (PyExc_ValueError, "bitfields not octet-aligned");
-    return -1;
+  if (!PyArg_ParseTuple (arg_list,
+                         "Ss#|iO!",
+                         &format,
+                         &data,
+                         &data_len,
+                         &data_pos,
+                         &PyDict_Type,
+                         &functions
+                         )) {
+    return NULL;
   } else {
-    if ((data_pos + (total_bits/8)) > data_len) {
-      PyErr_SetString (PyExc_ValueError, "not enough data for bitfields");
-      return -1;
-    } else {
-      int bit_pos = 0;
-      int i;
-
-      for (i=0; i < num; i++) {
-        int num_bits = PyInt_AsLong (PyList_GetItem (bit_length_list, i));
-        int j;
-        int x=0;
-
-        for (j=0; j < num_bits; j++) {
-          x = (x<<1) | ((data[data_pos] & (1<<(7-bit_pos))) ? 1 : 0);
-          bit_pos++;
-          if (bit_pos == 8) {
-            bit_pos = 0;
-            data_pos++;
-          }
-        }
-        PyList_Append (result_list, PyInt_FromLong (x));
-      }
-      return (data_pos);
+    Struct_object * s = get_struct (format);
+    PyObject * result;
+    if (!s) {
+      return NULL;
     }
+    result = Struct_unpack_data (
+      s, PyTuple_GET_ITEM (arg_list, 1), data, data_len, data_pos, functions
+      );
+    Py_DECREF (s);
+    return result;
   }
 }
 
+/* pack_into (format, buffer, offset, args[, functions])
+ *   pack directly into any writable buffer, returning the number
+ *   of bytes written. */
+
 static
 PyObject  *
-pack (PyObject * self, PyObject * arg_list)
+pack_into (PyObject * self, PyObject * arg_list)
 {
-  char * format;
-  int format_len;
+  PyObject * format;
+  PyObject * object;
+  int offset;
   PyObject * args;
   PyObject * functions = NULL;
 
   if (!PyArg_ParseTuple (arg_list,
-                         "s#O!|O!",
+                         "SOiO!|O!",
                          &format,
-                         &format_len,
+                         &object,
+                         &offset,
                          &PyTuple_Type,
                          &args,
                          &PyDict_Type,
@@ -359,672 +3568,353 @@ pack (PyObject * self, PyObject * arg_list)
                          )) {
     return NULL;
   } else {
-    PyObject * result = PyString_FromString ("");
-    PyObject * value;
-    int argnum = 0;
-    char ch;
-    int num = 0;
-    int i;
-    char byte_order = format[0];
-
-    /* check for a specified byte order */
-    switch (byte_order) {
-    case 'L':
-    case 'B':
-      i = 1;
-      break;
-    case 'N':
-      /* Native byte order */
-      /* <endian> is computed when this module is initialized */
-      byte_order = endian ? 'B' : 'L';
-      i = 1;
-      break;
-    default:
-      /* default to native if not specified */
-      byte_order = endian ? 'B' : 'L';
-      i = 0;
-      break;
+    Struct_object * s = get_struct (format);
+    PyObject * result;
+    if (!s) {
+      return NULL;
     }
-    
-    while (ch = format[i]) {
-      char * spec_start = format+i;
-      i++;
+    result = Struct_pack_into_object (s, object, offset, args, functions);
+    Py_DECREF (s);
+    return result;
+  }
+}
 
-      if ((ch >= '0') && (ch <= '9')) {
-        num = (num * 10) + (ch - '0');
-      } else {
-        unsigned char s[8] = {0,0,0,0,0,0,0,0};
-
-        if (ch != 'x') {
-          value = PyTuple_GetItem (args, argnum++);
-          if ((!value)) {
-            PyErr_SetString (PyExc_ValueError, "not enough arguments for pack");
-            Py_DECREF (result);
-            return NULL;
-          }         
-        } else {
-          /* kludge: when passing an argument tuple for a multiplied pad char ('4x'),
-           * there really _isn't_ one.  Instead of creating an empty bogus tuple,
-           * we will just pass in <args>... it won't used, but will keep BuildValue
-           * from hurling
-           */
-          value = args;
-        }
+/* unpack_from (format, buffer[, offset[, functions]])
+ *   unpack from any readable buffer (string, bytearray, memoryview,
+ *   mmap, array) without copying it. */
 
-        /* handle multipliers by recursing */
-        if (num > 0) {
-          PyObject * spec;
-          PyObject * full_spec;
-          char * eos;
-          int spec_len;
-          /* build a new format string */
-          /* <BYTE_ORDER> + <n>*<format> */
-          switch (ch) {
-          case 'b': case 'h': case 'l':
-          case 'c': case 'd': case 'f':
-          case 'x':
-            spec = PyString_FromStringAndSize (&ch, 1);
-            spec_len = 1;
-            break;
-          case '(':
-            eos = strchr (spec_start, ')');
-            if ((!eos) || (eos-format > format_len)) {
-              PyErr_SetString (PyExc_ValueError, "unterminated bit field");
-              Py_DECREF (result);
-              return NULL;
-            } else {
-              spec_len = (eos-spec_start) + 1;
-              spec = PyString_FromStringAndSize (spec_start, spec_len);
-            }
-            break;
-          case '[':
-            eos = strchr (spec_start, ']');
-            if ((!eos) || (eos-format > format_len)) {
-              PyErr_SetString (PyExc_ValueError, "unterminated bit field");
-              Py_DECREF (result);
-              return NULL;
-            } else {
-              spec_len = (eos-spec_start) + 1;
-              spec = PyString_FromStringAndSize (spec_start, spec_len);
-            }
-            break;
-          }
-          /* make a one-character byte order spec */
-          full_spec = PyString_FromStringAndSize (&byte_order, 1);
-          /* now repeat the spec string */
-          PyString_ConcatAndDel (&full_spec, PySequence_Repeat (spec, num));
-          Py_DECREF (spec);
-          /* recurse */
-          {
-            PyObject * packed;
-            PyObject * args;
-            if (functions) {
-              args = Py_BuildValue ("OOO", full_spec, value, functions);
-            } else {
-              args = Py_BuildValue ("OO", full_spec, value);
-            }
-            packed = pack (NULL, args);
-            Py_DECREF (args);
-            if (!packed) {
-              return NULL;
-            } else {
-              PyString_ConcatAndDel (&result, packed);
-              Py_DECREF (full_spec);
-              i += spec_len - 1;
-              num = 0;
-            }
-          }
-        } else {
-          switch (ch) {
-            
-            /* integer types */
-            
-          case 'b': case 'h': case 'l':
-            if (!PyInt_Check (value)) {
-              PyErr_SetString (PyExc_ValueError, "bad argument type to pack");
-              Py_DECREF (result);
-              return NULL;
-            } else {
-              int x = PyInt_AsLong (value);
-              int size=0;
-
-              /* FIXME: should do range checks */
-              switch (ch) {
-              case 'b':
-                size = 1;
-                s[0] = x;
-                break;
-              case 'h':
-                size = 2;
-                switch (byte_order) {
-                case 'L':
-                  LITTLE_ENCODE_WORD (x,s);
-                  break;
-                case 'B':
-                  BIG_ENCODE_WORD (x,s);
-                  break;
-                }
-                break;
-              case 'l':
-                size = 4;
-                switch (byte_order) {
-                case 'L':
-                  LITTLE_ENCODE_LONG (x,s);
-                  break;
-                case 'B':
-                  BIG_ENCODE_LONG (x,s);
-                  break;
-                }
-                break;
-              }
-              PyString_ConcatAndDel (&result, PyString_FromStringAndSize ((char *)s,size));
-            }
-            break;
-
-            /* floating-point types */
-
-          case 'f':
-            if (!PyFloat_Check (value)) {
-              PyErr_SetString (PyExc_ValueError, "bad argument type to pack");
-              Py_DECREF (result);
-              return NULL;
-            } else {
-              float x = (float) PyFloat_AsDouble (value);
-              switch (byte_order) {
-              case 'L':
-                LITTLE_ENCODE_FLOAT (x,s);
-                break;
-              case 'B':
-                BIG_ENCODE_FLOAT (x,s);
-                break;
-              }
-              PyString_ConcatAndDel (&result, PyString_FromStringAndSize ((char *)s,4));
-            }
-            break;
-              
-          case 'd':
-            if (!PyFloat_Check (value)) {
-              PyErr_SetString (PyExc_ValueError, "bad argument type to pack");
-              Py_DECREF (result);
-              return NULL;
-            } else {
-              double x = PyFloat_AsDouble (value);
-              switch (byte_order) {
-              case 'L':
-                LITTLE_ENCODE_DOUBLE (x,s);
-                break;
-              case 'B':
-                BIG_ENCODE_DOUBLE (x,s);
-                break;
-              }
-              PyString_ConcatAndDel (&result, PyString_FromStringAndSize ((const char *)s, 8));
-            }
-            break;
-
-            /* character type */
-
-          case 'c':
-            if ((!PyString_Check (value)) || (PyString_Size (value) != 1)) {
-              PyErr_SetString (PyExc_ValueError, "bad argument type to pack");
-              Py_DECREF (result);
-              return NULL;
-            } else {
-              /* careful... don't want to DECREF <value> */
-              PyString_Concat (&result, value);
-            }
-            break;
-              
-            /* pad byte */
-
-          case 'x':
-            /* pad with a NULL byte */
-            PyString_ConcatAndDel (&result, PyString_FromStringAndSize ("\000", 1));
-            break;
-
-          case '(':
-
-            /* bitfield */
-
-            {
-              PyObject * bit_length_list = PyList_New (0);
-              int new_pos = get_bit_length_list (bit_length_list, format, i);
-              if (new_pos == -1) {
-                /* get_bit_length_list will set the error */
-                Py_DECREF (bit_length_list);
-                Py_DECREF (result);
-                return NULL;
-              } else {
-                PyObject * bits = pack_bitfield (bit_length_list, args, argnum-1);
-                if (!bits) {
-                  return NULL;
-                } else {
-                  PyString_ConcatAndDel (&result, bits);
-                  i = new_pos;
-                  argnum = argnum + PyList_Size (bit_length_list) - 1;
-                }
-                Py_DECREF (bit_length_list);
-              }
-            }
-          break;
-          
-          case '[':
-            {
-              /* user function */
-            
-              char * eos = strchr (format+i, ']');
-              if (!eos) {
-                Py_DECREF (result);
-                PyErr_SetString (PyExc_ValueError, "unterminated user function name");
-                return NULL;
-              } else {
-                PyObject * key = PyString_FromStringAndSize (format+i, eos-(format+i));
-                PyObject * fun;
-                if ((!functions) || (!(fun = PyDict_GetItem (functions, key)))) {
-                  PyErr_SetString (PyExc_ValueError, "unknown user function");
-                  Py_DECREF (key);
-                  Py_DECREF (result);
-                  return NULL;
-                } else {
-                  Py_DECREF (key);
-                  if (!PyCallable_Check (fun)) {
-                    PyErr_SetString (PyExc_ValueError, "not a callable function");
-                    Py_DECREF (result);
-                    return NULL;
-                  } else {
-                    PyObject * sub;
-                    PyObject * t = Py_BuildValue ("(O)", value);
-                    sub = PyEval_CallObject (fun, t);
-                    Py_DECREF (t);
-                    if ((!sub) || (!PyString_Check (sub))) {
-                      PyErr_SetString (PyExc_ValueError, "user function did not return a string");
-                      Py_XDECREF (sub);
-                      Py_DECREF (result);
-                      return NULL;
-                    } else {
-                      i = (eos-format)+1;
-                      PyString_ConcatAndDel (&result, sub);
-                    }
-                  }
-                }
-              }
-            }
-          break;
+static
+PyObject  *
+unpack_from (PyObject * self, PyObject * arg_list)
+{
+  PyObject * format;
+  Py_buffer view;
+  int offset = 0;
+  PyObject * functions = NULL;
 
-          default:
-            PyErr_SetString (PyExc_ValueError, "unknown format character");
-            Py_DECREF (result);
-            return NULL;
-            break;
-          }
-        }
-      }
+  if (!PyArg_ParseTuple (arg_list,
+                         "Ss*|iO!",
+                         &format,
+                         &view,
+                         &offset,
+                         &PyDict_Type,
+                         &functions
+                         )) {
+    return NULL;
+  } else {
+    Struct_object * s = get_struct (format);
+    PyObject * result;
+    if (!s) {
+      PyBuffer_Release (&view);
+      return NULL;
     }
+    result = Struct_unpack_view (s, PyTuple_GET_ITEM (arg_list, 1), &view, offset, functions);
+    Py_DECREF (s);
     return result;
   }
 }
 
+/* iter_unpack (format, source[, offset[, functions]])
+ *   iterate over the records in a buffer, file or iterator of chunks */
+
 static
 PyObject  *
-unpack (PyObject * self, PyObject * arg_list)
+iter_unpack (PyObject * self, PyObject * arg_list)
 {
-  char * format;
-  int format_len;
-  unsigned char * data;
-  int data_len;
-  int data_pos=0;
-
+  PyObject * format;
+  PyObject * source;
+  int offset = 0;
   PyObject * functions = NULL;
 
   if (!PyArg_ParseTuple (arg_list,
-                         "s#s#|iO!",
+                         "SO|iO!",
                          &format,
-                         &format_len,
-                         &data,
-                         &data_len,
-                         &data_pos,
+                         &source,
+                         &offset,
                          &PyDict_Type,
                          &functions
                          )) {
     return NULL;
   } else {
-    PyObject * original_data_string = PyTuple_GetItem (arg_list, 1);
-    PyObject * result = PyList_New (0);
-    char ch;
-    int num = 0;
-    int i;
-    char byte_order = format[0];
-    int original_data_pos = data_pos;
-
-    /* check for a specified byte order */
-    switch (byte_order) {
-    case 'L':
-    case 'B':
-      i = 1;
-      break;
-    case 'N':
-      /* Native byte order */
-      /* <endian> is computed when this module is initialized */
-      byte_order = endian ? 'B' : 'L';
-      i = 1;
-      break;
-    default:
-      /* default to native if not specified */
-      byte_order = endian ? 'B' : 'L';
-      i = 0;
-      break;
+    Struct_object * s = get_struct (format);
+    PyObject * result;
+    if (!s) {
+      return NULL;
     }
-    
-#define ENOUGH_DATA(n)                                          \
-    do {                                                        \
-      if ((data_pos + n) > data_len) {                          \
-        Py_DECREF (result);                                     \
-        PyErr_SetString (PyExc_ValueError, "not enough data");  \
-        return NULL;                                            \
-      }                                                         \
-    } while (0)
-
-    while (ch = format[i]) {
-      char * spec_start = format+i;
-      i++;
-      
-      if ((ch >= '0') && (ch <= '9')) {
-        num = (num * 10) + (ch - '0');
-      } else {
-        
-        if (data_pos > data_len) {
-          Py_DECREF (result);
-          PyErr_SetString (PyExc_ValueError, "not enough data");
-          return NULL;
-        }
-        
-        /* handle multipliers by recursing */
-        if (num > 0) {
-          PyObject * spec;
-          PyObject * full_spec;
-          char * eos;
-          int spec_len;
-          /* build a new format string */
-          /* <BYTE_ORDER> + <n>*<format> */
-          switch (ch) {
-          case 'b': case 'h': case 'l':
-          case 'c': case 'd': case 'f':
-          case 'x':
-            spec = PyString_FromStringAndSize (&ch, 1);
-            spec_len = 1;
-            break;
-          case '(':
-            eos = strchr (spec_start, ')');
-            if ((!eos) || (eos-format > format_len)) {
-              PyErr_SetString (PyExc_ValueError, "unterminated bit field");
-              Py_DECREF (result);
-              return NULL;
-            } else {
-              spec_len = (eos-spec_start) + 1;
-              spec = PyString_FromStringAndSize (spec_start, spec_len);
-            }
-            break;
-          case '[':
-            eos = strchr (spec_start, ']');
-            if ((!eos) || (eos-format > format_len)) {
-              PyErr_SetString (PyExc_ValueError, "unterminated bit field");
-              Py_DECREF (result);
-              return NULL;
-            } else {
-              spec_len = (eos-spec_start) + 1;
-              spec = PyString_FromStringAndSize (spec_start, spec_len);
-            }
-            break;
-          }
-          /* make a one-character byte order spec */
-          full_spec = PyString_FromStringAndSize (&byte_order, 1);
-          /* now repeat the spec string */
-          PyString_ConcatAndDel (&full_spec, PySequence_Repeat (spec, num));
-          Py_DECREF (spec);
-          /* recurse */
-          {
-            PyObject * unpacked;
-            PyObject * args;
-            PyObject * values;
-            /* we can't just use the 's' character for Py_BuildValue because
-             * our data string will (very likely) have embedded NULL characters */
-            int munched;
-            if (functions) {
-              args = Py_BuildValue ("OOiO", full_spec, original_data_string, data_pos, functions);
-            } else {
-              args = Py_BuildValue ("OOi", full_spec, original_data_string, data_pos);
-            }
-            unpacked = unpack (NULL, args);
-            Py_DECREF (args);
-            if (!unpacked) {
-              return NULL;
-            } else if (!PyArg_ParseTuple (unpacked, "Oi", &values, &munched)) {
-              return NULL;
-            } else {
-              PyList_Append (result, values);
-              data_pos += munched;
-              Py_DECREF (full_spec);
-              i += spec_len - 1;
-              num = 0;
-            }
-          }
-        } else {
-          switch (ch) {
-            
-            /* char */
-          case 'c':
-            ENOUGH_DATA (1);
-            PyList_Append (result, PyString_FromStringAndSize ((const char *) data+data_pos, 1));
-            data_pos++;
-            break;
-
-            /* byte */
-            
-          case 'b':
-            ENOUGH_DATA (1);
-            PyList_Append (result, PyInt_FromLong (((unsigned char *)data)[data_pos]));
-            data_pos++;
-            break;
-
-            /* word/short */
-
-          case 'h':
-            {
-              unsigned int x;
-              ENOUGH_DATA (2);
-
-              switch (byte_order) {
-              case 'L':
-                LITTLE_DECODE_WORD (x,data+data_pos);
-                break;
-              case 'B':
-                BIG_DECODE_WORD (x,data+data_pos);
-                break;
-              }
-              PyList_Append (result, PyInt_FromLong (x));
-              data_pos += 2;
-            }
-          break;
+    result = make_iterator (s, source, offset, functions);
+    Py_DECREF (s);
+    return result;
+  }
+}
 
-          /* long */
-
-          case 'l':
-            {
-              unsigned int x;
-              ENOUGH_DATA (4);
-
-              switch (byte_order) {
-              case 'L':
-                LITTLE_DECODE_LONG (x,data+data_pos);
-                break;
-              case 'B':
-                BIG_DECODE_LONG (x,data+data_pos);
-                break;
-              }
-              PyList_Append (result, PyInt_FromLong (x));
-              data_pos += 4;
-            }
-          break;
+/* bit_stream_reader (data[, byte_pos[, bit_pos[, lsb_first]]]) */
 
-          /* float */
-
-          case 'f':
-            {
-              float x;
-              ENOUGH_DATA (4);
-              switch (byte_order) {
-              case 'L':
-                LITTLE_DECODE_FLOAT (x, data+data_pos);
-                break;
-              case 'B':
-                BIG_DECODE_FLOAT (x, data+data_pos);
-                break;
-              }
-              PyList_Append (result, PyFloat_FromDouble ((double) x));
-              data_pos += 4;
-            }
-          break;
+static
+PyObject  *
+bit_stream_reader (PyObject * self, PyObject * arg_list)
+{
+  PyObject * data;
+  Py_ssize_t byte_pos = 0;
+  int bit_pos = 0;
+  int lsb_first = 0;
+  Reader_object * reader;
 
-          /* double */
-
-          case 'd':
-            {
-              double x;
-              ENOUGH_DATA (8);
-              switch (byte_order) {
-              case 'L':
-                LITTLE_DECODE_DOUBLE (x, data+data_pos);
-                break;
-              case 'B':
-                BIG_DECODE_DOUBLE (x, data+data_pos);
-                break;
-              }
-              PyList_Append (result, PyFloat_FromDouble (x));
-              data_pos += 8;
-            }
-          break;
-            
-          /* bitfield */
-
-          case '(':
-            {
-              PyObject * bit_length_list = PyList_New (0);
-              int new_format_pos = get_bit_length_list (bit_length_list, format, i);
-              if (new_format_pos == -1) {
-                /* get_bit_length_list will set the error */
-                Py_DECREF (bit_length_list);
-                Py_DECREF (result);
-                return NULL;
-              } else {
-                int new_data_pos = unpack_bitfield (bit_length_list, result, data, data_pos, data_len);
-                if (new_data_pos == -1) {
-                  return NULL;
-                } else {
-                  /* unpack_bitfield appends to the result list itself */
-                  Py_DECREF (bit_length_list);
-                  data_pos = new_data_pos;
-                  i = new_format_pos;
-                }
-              }
-            }
-          break;
+  if (!PyArg_ParseTuple (arg_list, "O|nii", &data, &byte_pos, &bit_pos, &lsb_first)) {
+    return NULL;
+  }
+  reader = PyObject_New (Reader_object, &Reader_Type);
+  if (!reader) {
+    return NULL;
+  } else if (get_read_buffer (data, &reader->view) == -1) {
+    PyObject_Del (reader);
+    return NULL;
+  }
+  if (has_export (data)) {
+    reader->source = NULL;
+  } else {
+    Py_INCREF (data);
+    reader->source = data;
+  }
+  reader->pos = (byte_pos * 8) + bit_pos;
+  reader->lsb_first = lsb_first;
+  if ((reader->pos < 0) || (reader->pos > (reader->view.len * 8))) {
+    PyErr_SetString (PyExc_ValueError, "position out of range");
+    Py_DECREF (reader);
+    return NULL;
+  }
+  return (PyObject *) reader;
+}
 
-          /* pad byte */
-            
-          case 'x':
-            data_pos++;
-            break;
-
-
-            /* user function */
-
-          case '[':
-            {
-              char * eos = strchr (format+i, ']');
-              if (!eos) {
-                Py_DECREF (result);
-                PyErr_SetString (PyExc_ValueError, "unterminated user function name");
-                return NULL;
-              } else {
-                PyObject * key = PyString_FromStringAndSize (format+i, eos-(format+i));
-                PyObject * fun;
-                if ((!functions) || (!(fun = PyDict_GetItem (functions, key)))) {
-                  PyErr_SetString (PyExc_ValueError, "unknown user function");
-                  Py_DECREF (key);
-                  Py_DECREF (result);
-                  return NULL;
-                } else {
-                  Py_DECREF (key);
-                  if (!PyCallable_Check (fun)) {
-                    PyErr_SetString (PyExc_ValueError, "not a callable function");
-                    Py_DECREF (result);
-                    return NULL;
-                  } else {
-                    int munched;
-                    PyObject * decoded_data;
-                    PyObject * user_function_result;
-                    Py_INCREF (original_data_string);
-                    user_function_result = PyEval_CallObject (
-                      fun,
-                      Py_BuildValue ("OOi", result, original_data_string, data_pos)
-                      );
-                    Py_DECREF (original_data_string);
-                    if (!user_function_result) {
-                      Py_DECREF (result);
-                      return NULL;
-                    } else if (!PyArg_ParseTuple (user_function_result,
-                                                  "O!i",
-                                                  &PyTuple_Type,
-                                                  &decoded_data,
-                                                  &munched)) {
-                      PyErr_SetString (PyExc_ValueError, "bad result from user function");
-                      Py_DECREF (user_function_result);
-                      Py_DECREF (result);
-                      return NULL;
-                    } else {
-                      /* append the user-parsed data to the current result list */
-                      int num_items = PyTuple_Size (decoded_data);
-                      int j;
-                      for (j = 0; j < num_items; j++) {
-                        PyObject * elem = PyTuple_GetItem (decoded_data, j);
-                        Py_INCREF (elem);
-                        PyList_Append (result, elem);
-                      }
-                      data_pos += munched;
-                      Py_DECREF (user_function_result);
-                      i = (eos-format)+1;
-                    }
-                  }
-                }
-              }
-            }
-          break; /* end case '[' */
-
-          default:
-            //PyErr_SetObject (PyExc_ValueError, Py_BuildValue ("si", "unknown format character", ch));
-            PyErr_SetString (PyExc_ValueError, "unknown format character");
-            Py_DECREF (result);
-            return NULL;
-            break;
-          }
-        }
-      }
+/* bit_stream_writer ([lsb_first]) */
+
+static
+PyObject  *
+bit_stream_writer (PyObject * self, PyObject * arg_list)
+{
+  int lsb_first = 0;
+  Writer_object * writer;
+
+  if (!PyArg_ParseTuple (arg_list, "|i", &lsb_first)) {
+    return NULL;
+  }
+  writer = PyObject_New (Writer_object, &Writer_Type);
+  if (writer) {
+    writer->data = NULL;
+    writer->len = 0;
+    writer->pos = 0;
+    writer->lsb_first = lsb_first;
+  }
+  return (PyObject *) writer;
+}
+
+/* lzw_decode (data, offset, code_size, out[, width[, interlace]])
+ *   decode the GIF image data sub-blocks at data[offset:] into the
+ *   writable buffer <out>.  returns (pixels written, bytes of data used) */
+
+static
+PyObject  *
+lzw_decode (PyObject * self, PyObject * arg_list)
+{
+  Py_buffer view;
+  int offset;
+  int code_size;
+  PyObject * out_object;
+  int width = 0;
+  int interlace = 0;
+  Py_buffer out_view;
+  int have_out_view;
+  unsigned char * out;
+  int out_len;
+  lzw_input in;
+  int height;
+  int * rows;
+  int written;
+
+  if (!PyArg_ParseTuple (arg_list, "s*iiO|ii", &view, &offset, &code_size, &out_object, &width, &interlace)) {
+    return NULL;
+  } else if ((code_size < 2) || (code_size > 8)) {
+    PyErr_SetString (PyExc_ValueError, "bad lzw code size");
+    PyBuffer_Release (&view);
+    return NULL;
+  } else if ((offset < 0) || (offset > view.len) || (width < 0)) {
+    PyErr_SetString (PyExc_ValueError, "offset out of range");
+    PyBuffer_Release (&view);
+    return NULL;
+  } else if (get_write_buffer (out_object, &out_view, &have_out_view, &out, &out_len) == -1) {
+    PyBuffer_Release (&view);
+    return NULL;
+  }
+  in.data = (unsigned char *) view.buf;
+  in.len = view.len;
+  in.pos = offset;
+  in.block_left = 0;
+  in.done = 0;
+  in.bits = 0;
+  in.num_bits = 0;
+  in.error = NULL;
+  if (!width) {
+    /* one long row */
+    width = out_len;
+    height = out_len ? 1 : 0;
+  } else {
+    height = out_len / width;
+  }
+  rows = interlace_rows (height, interlace);
+  if (!rows) {
+    written = -1;
+  } else if (has_export (PyTuple_GET_ITEM (arg_list, 0)) && has_export (out_object)) {
+    Py_BEGIN_ALLOW_THREADS
+    written = lzw_decode_data (&in, code_size, out, width, height, rows);
+    Py_END_ALLOW_THREADS
+  } else {
+    written = lzw_decode_data (&in, code_size, out, width, height, rows);
+  }
+  PyMem_Free (rows);
+  PyBuffer_Release (&view);
+  if (have_out_view) {
+    PyBuffer_Release (&out_view);
+  }
+  if (written == -1) {
+    if (in.error) {
+      PyErr_SetString (PyExc_ValueError, in.error);
     }
-    {
-      PyObject * tuple_result;
-      PyObject * final_result;
-      /* convert to a tuple */
-      tuple_result = PyList_AsTuple (result);
-      /* combine with data position into a new tuple */
-      final_result = Py_BuildValue ("Oi", tuple_result, (int)(data_pos - original_data_pos));
-      Py_DECREF (tuple_result);
-      return (final_result);
+    return NULL;
+  } else {
+    return Py_BuildValue ("ii", written, in.pos - offset);
+  }
+}
+
+/* lzw_encode (pixels, code_size[, width[, interlace]])
+ *   compress palette indices into GIF image data sub-blocks */
+
+static
+PyObject  *
+lzw_encode (PyObject * self, PyObject * arg_list)
+{
+  Py_buffer view;
+  int code_size;
+  int width = 0;
+  int interlace = 0;
+  PyObject * result;
+
+  if (!PyArg_ParseTuple (arg_list, "s*i|ii", &view, &code_size, &width, &interlace)) {
+    return NULL;
+  } else if ((code_size < 2) || (code_size > 8) || (width < 0)) {
+    PyErr_SetString (PyExc_ValueError, "bad lzw code size");
+    PyBuffer_Release (&view);
+    return NULL;
+  }
+  result = lzw_encode_data ((unsigned char *) view.buf, view.len, code_size, width, interlace);
+  PyBuffer_Release (&view);
+  return result;
+}
+
+/* skip_sub_blocks (data, offset)
+ *   hop over the chain of GIF sub-blocks at data[offset:], reading only
+ *   the size bytes.  returns (blocks, bytes of payload, position just
+ *   past the terminator) */
+
+static
+PyObject  *
+skip_sub_blocks (PyObject * self, PyObject * arg_list)
+{
+  Py_buffer view;
+  Py_ssize_t pos;
+  Py_ssize_t count = 0;
+  Py_ssize_t length = 0;
+  unsigned char * data;
+  unsigned char size;
+
+  if (!PyArg_ParseTuple (arg_list, "s*n", &view, &pos)) {
+    return NULL;
+  } else if ((pos < 0) || (pos > view.len)) {
+    PyErr_SetString (PyExc_ValueError, "offset out of range");
+    PyBuffer_Release (&view);
+    return NULL;
+  }
+  data = (unsigned char *) view.buf;
+  while (1) {
+    if (pos >= view.len) {
+      PyErr_SetString (PyExc_ValueError, "truncated data blocks");
+      PyBuffer_Release (&view);
+      return NULL;
     }
+    size = data[pos];
+    pos += 1 + size;
+    if (!size) {
+      break;
+    }
+    count++;
+    length += size;
+  }
+  PyBuffer_Release (&view);
+  if (pos > view.len) {
+    PyErr_SetString (PyExc_ValueError, "truncated data blocks");
+    return NULL;
+  }
+  return Py_BuildValue ("nnn", count, length, pos);
+}
+
+/* set_profiling (flag)
+ *   turn the counting of procfield calls on or off, returning the old setting */
+
+static
+PyObject  *
+set_profiling (PyObject * self, PyObject * arg_list)
+{
+  int flag;
+  int old = profiling;
+
+  if (!PyArg_ParseTuple (arg_list, "i", &flag)) {
+    return NULL;
+  }
+  profiling = flag;
+  return PyInt_FromLong (old);
+}
+
+/* reset_profile ()
+ *   forget the counts collected so far */
+
+static
+PyObject  *
+reset_profile (PyObject * self, PyObject * arg_list)
+{
+  if (!PyArg_ParseTuple (arg_list, "")) {
+    return NULL;
+  }
+  PyDict_Clear (profile_data);
+  Py_INCREF (Py_None);
+  return Py_None;
+}
+
+/* profile_counts ()
+ *   a dict of (kind, function) -> (calls, bytes, seconds) */
+
+static
+PyObject  *
+profile_counts (PyObject * self, PyObject * arg_list)
+{
+  if (!PyArg_ParseTuple (arg_list, "")) {
+    return NULL;
   }
+  return PyDict_Copy (profile_data);
 }
-    
+
 static struct PyMethodDef npstruct_module_methods[] = {
   {"pack",                  pack,                       1},
   {"unpack",                unpack,                     1},
+  {"pack_into",             pack_into,                  1},
+  {"unpack_from",           unpack_from,                1},
+  {"iter_unpack",           iter_unpack,                1},
+  {"bit_stream_reader",     bit_stream_reader,          1},
+  {"bit_stream_writer",     bit_stream_writer,          1},
+  {"lzw_decode",            lzw_decode,                 1},
+  {"lzw_encode",            lzw_encode,                 1},
+  {"skip_sub_blocks",       skip_sub_blocks,            1},
+  {"compile",               compile,                    1},
+  {"set_profiling",         set_profiling,              1},
+  {"reset_profile",         reset_profile,              1},
+  {"profile_counts",        profile_counts,             1},
   {NULL, NULL}              /* sentinel */
 };
 
@@ -1047,6 +3937,24 @@ void
 initnpstruct (void)
 {
   PyObject *m, *d;
+
+  Struct_Type.ob_type = &PyType_Type;
+  if (PyType_Ready (&Struct_Type) < 0) {
+    return;
+  }
+  Iter_Type.ob_type = &PyType_Type;
+  if (PyType_Ready (&Iter_Type) < 0) {
+    return;
+  }
+  Reader_Type.ob_type = &PyType_Type;
+  if (PyType_Ready (&Reader_Type) < 0) {
+    return;
+  }
+  Writer_Type.ob_type = &PyType_Type;
+  if (PyType_Ready (&Writer_Type) < 0) {
+    return;
+  }
+
   m = Py_InitModule ("npstruct", npstruct_module_methods);
   d = PyModule_GetDict(m);
 
@@ -1055,9 +3963,14 @@ initnpstruct (void)
     "endian",
     PyString_FromString (big_endian() ? "big" : "little")
     );
-    
+
+  Py_INCREF (&Struct_Type);
+  PyDict_SetItemString (d, "Struct", (PyObject *) &Struct_Type);
+
+  format_cache = PyDict_New();
+  profile_data = PyDict_New();
+
   if (PyErr_Occurred()) {
     Py_FatalError ("Can't initialize module npstruct");
   }
 }
-
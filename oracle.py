@@ -6,13 +6,15 @@
 
 import string
 
-from npstruct import pack, unpack
+import npstruct
+from npstruct import pack, unpack, compile
 
 converter = {
     'b':1,
     'c':1,
     'h':2,
-    'l':4
+    'l':4,
+    'm':0       # variable-sized
     }   
 
 def calcsize (format):
@@ -45,6 +47,140 @@ def calcsize (format):
         i = i + 1
     return size
 
+def split_format (format):
+    # the byte order, and the format of each field in front of the
+    # first procfield or mpi.  ('Lh3c(4 4)[x]b' => 'L', ['h', '3c', '(4 4)'])
+    if format[:1] in ('L', 'B', 'N'):
+        byte_order, i = format[0], 1
+    else:
+        byte_order, i = 'N', 0
+    fields = []
+    while i < len(format):
+        start = i
+        while format[i] in string.digits:
+            i = i + 1
+        if format[i] == '[' or format[i] == 'm':
+            break
+        elif format[i] == '(':
+            i = string.find (format, ')', i)
+        i = i + 1
+        fields.append (format[start:i])
+    return byte_order, fields
+
+# ---------------------------------------------------------------------------
+# numpy arrays
+# ---------------------------------------------------------------------------
+# Oracle.unpack_array decodes a run of fixed-size records into a numpy
+# record array, with Struct.unpack_native (which lets other threads run
+# while it works); pack_array goes back the other way.  The array has a
+# field per value, in native byte order: see 'native conversion' in
+# npstructmodule.c.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+native_typecode = {'b':'u1', 'c':'S1', 'h':'=u2', 'l':'=u4', 'f':'=f4', 'd':'=f8'}
+
+def bit_typecode (length):
+    if length <= 8:
+        return 'u1'
+    elif length <= 16:
+        return 'u2'
+    elif length <= 32:
+        return 'u4'
+    else:
+        return 'u8'
+
+def native_dtype (format, names):
+    if numpy is None:
+        raise ValueError, 'numpy is not available'
+    elif compile (format).variable:
+        raise ValueError, 'numpy arrays need a fixed-size format'
+    byte_order, fields = split_format (format)
+    dtype = []
+    i = 0
+    for field in fields:
+        j = 0
+        while field[j] in string.digits:
+            j = j + 1
+        code = field[j:]
+        if j:
+            count = string.atoi (field[:j])
+        else:
+            count = None
+        if code[0] == '(':
+            # (bitfields can't be repeated)
+            for b in map (string.atoi, string.split (code[1:-1])):
+                dtype.append ((names[i], bit_typecode (b)))
+                i = i + 1
+        elif code == 'x':
+            if count is not None:
+                # an empty tuple
+                i = i + 1
+        elif code == 'c' and count is not None:
+            dtype.append ((names[i], 'S%d' % count))
+            i = i + 1
+        elif count is not None:
+            dtype.append ((names[i], native_typecode[code], (count,)))
+            i = i + 1
+        else:
+            dtype.append ((names[i], native_typecode[code]))
+            i = i + 1
+    if i != len(names):
+        raise ValueError, 'format has %d fields, got %d names' % (i, len(names))
+    return numpy.dtype (dtype)
+
+# ---------------------------------------------------------------------------
+# profiling
+# ---------------------------------------------------------------------------
+# The C module counts procfield calls itself (see 'profiling' in
+# npstructmodule.c); Oracle.unpack calls are counted here, and the
+# two are reported together, by the helpers in npcommon.py.
+
+import npcommon
+from npcommon import profile_clock, profile_count
+
+profiling = 0
+profile_data = {}
+
+def set_profiling (flag):
+    global profiling
+    old, profiling = profiling, flag
+    npstruct.set_profiling (flag)
+    return old
+
+def reset_profile ():
+    profile_data.clear()
+    npstruct.reset_profile()
+
+def profile_counts ():
+    return npcommon.profile_counts (profile_data, npstruct.profile_counts())
+
+def profile (reset=1):
+    "turns profiling on for a 'with' block, starting from zero unless <reset> is false"
+    return npcommon.profile (set_profiling, reset_profile, reset)
+
+def profile_stats (counts=None):
+    # a list of profile_entry records, the most time first
+    if counts is None:
+        counts = profile_counts()
+    return npcommon.profile_stats (counts)
+
+def profile_report (file=None, counts=None):
+    if counts is None:
+        counts = profile_counts()
+    npcommon.profile_report (counts, file)
+
+# ---------------------------------------------------------------------------
+# records
+# ---------------------------------------------------------------------------
+# Oracle.unpack returns a record, and Oracle.view a record_view; both
+# are in npcommon.py, which is shared with npstruct.py.
+
+from npcommon import identifier, record, record_view, make_record_class, profile_entry
+
 # ---------------------------------------------------------------------------
 # an Oracle can be used to divine the contents of mysterious block
 # data, using struct-module-like format strings.  an Oracle can also
@@ -65,7 +201,9 @@ def calcsize (format):
 #    'pixel aspect ratio'))
 # 
 # >>> logical_screen_descriptor.unpack (strange_data)
-# ({'width':100, 'height':100, 'global color table flag':1 ...}, <size_of_struct>)
+# (Logical_Screen_Descriptor(width=100, height=100, global_color_table_flag=1 ...), <size_of_struct>)
+# >>> _[0]['width'], _[0].global_color_table_flag
+# (100, 1)
 
 # 'functions' values are optionally a tuple of two functions,
 # one for unpacking, and one for packing.  Otherwise, this expects
@@ -92,7 +230,12 @@ class Oracle:
         self.names = names
         self.functions = functions
         (self.read_functions, self.write_functions) = get_functions (functions)
-        self.size = calcsize (format)
+        self.reader = compile (format, self.read_functions)
+        self.writer = compile (format, self.write_functions)
+        self.size = self.reader.size
+        self.record = make_record_class (name, names)
+        self.variable = self.reader.variable
+        self.fixed_fields = self.fixed_layout()
 
     def __repr__ (self):
         return '<%s oracle>' % self.name
@@ -104,11 +247,58 @@ class Oracle:
         return self.unpack (self.new_raw())[0]
 
     def unpack (self, data, offset=0):
-        members, length = unpack (self.format, data, offset, self.read_functions)
-        result = {}
-        for i in range(len(self.names)):
-            result[self.names[i]] = members[i]
-        return result, length
+        if profiling:
+            start = profile_clock()
+            members, length = self.reader.unpack_from (data, offset)
+            profile_count (profile_data, 'oracle', self, length, profile_clock() - start)
+        else:
+            members, length = self.reader.unpack_from (data, offset)
+        return self.record (members), length
+
+    def iter_unpack (self, data, offset=0):
+        for members in self.reader.iter_unpack (data, offset):
+            yield self.record (members)
+
+    def unpack_array (self, data, count=None, offset=0):
+        dtype = native_dtype (self.format, self.names)
+        if count is None:
+            count, extra = divmod (len(data) - offset, self.size)
+            if extra:
+                raise ValueError, 'not enough data'
+        result = numpy.empty (count, dtype)
+        self.reader.unpack_native (data, result, count, offset)
+        return result
+
+    def pack_array (self, records):
+        # <records> is a record array, or a dict of columns
+        dtype = native_dtype (self.format, self.names)
+        count = len (records[dtype.names[0]])
+        native = numpy.empty (count, dtype)
+        for name in dtype.names:
+            native[name] = records[name]
+        return self.writer.pack_native (native)
+
+    def view (self, data, offset=0):
+        return record_view (self, data, offset)
+
+    def fixed_layout (self):
+        # {value index: (struct, position, index of its first value)}
+        # for each field in front of the first procfield.
+        byte_order, fields = split_format (self.format)
+        layout = {}
+        pos = first = 0
+        for field in fields:
+            struct = compile (byte_order + field)
+            num_values = len (struct.unpack ('\000' * struct.size)[0])
+            for i in range(num_values):
+                layout[first + i] = (struct, pos, first)
+            pos = pos + struct.size
+            first = first + num_values
+        return layout
+
+    def decode_field (self, field, data, offset):
+        struct, pos, first = field
+        return struct.unpack_from (data, offset + pos)[0]
 
     def procfield_function (self, results, data, offset):
         return self.unpack (data, offset)
@@ -120,8 +310,10 @@ class Oracle:
         return self.pack (dict)
 
     def pack (self, dict):
-        members = map (lambda x,d=dict: d[x], self.names)
-        return pack (self.format, members, self.write_functions)
+        # a record is already in field order
+        if not isinstance (dict, self.record):
+            dict = tuple (map (lambda x,d=dict: d[x], self.names))
+        return self.writer.pack (dict)
 
     def describe (self, dict):
         print '%s:' % self.name
@@ -13,23 +13,20 @@
 
 import npstruct
 import string
+import array
+import sys
+import zlib
 
 # Read a multi-precision integer, which starts with
 # a word bitcount.  The integer is padded with zero
-# MSB's to fit into a byte boundary.
+# MSB's to fit into a byte boundary.  The oracles below
+# use npstruct's 'm' format code for these directly; this
+# gives the bit count as well.
 
 def read_mpi (result, data, pos):
-    values, length = npstruct.unpack ('Bh', data, pos)
-    bitcount = values[0]
-    (d,r) = divmod (bitcount, 8)
-    if r:
-        d = d + 1
-    mpi = data[pos+2:pos+2+d]
-    # hexify it
-    mpi = string.joinfields (map (lambda x: hex(ord(x))[2:], mpi), '')
-    # turn it into a python long
-    mpi = eval ('0x%sL' % mpi)
-    return (bitcount, mpi), d+2
+    (bitcount,), length = npstruct.unpack ('Bh', data, pos)
+    (mpi,), length = npstruct.unpack ('Bm', data, pos)
+    return (bitcount, mpi), length
 
 def read_ctb (result, data, pos):
     dict, length = CTB.unpack (data[pos])
@@ -55,7 +52,7 @@ def read_timestamp (result, data, pos):
 
 RSA = npstruct.Oracle (
     'RSA public-key-encrypted packet',
-    'B[ctb][len]b8bb[mpi]',
+    'B[ctb][len]b8bbm',
     ('ctb',         # CTB for RSA pub-key-encrypted packet
      'length',      # 16-bit length of packet (in bytes?)
      'version',     # == 2.
@@ -65,12 +62,11 @@ RSA = npstruct.Oracle (
      ),
     ctb=read_ctb,
     len=read_ctb_len,
-    mpi=read_mpi
     )
 
 signature_packet = npstruct.Oracle (
     'Signature Packet',
-    'B[ctb][len]bbb[ts]8bbb2b[mpi]',
+    'B[ctb][len]bbb[ts]8bbb2bm',
     ('ctb',
      'packet_length',
      'version',             # == 2, 3 >= PGP2.6 after 9/1/94
@@ -85,7 +81,6 @@ signature_packet = npstruct.Oracle (
      ),
     ctb=read_ctb,
     len=read_ctb_len,
-    mpi=read_mpi,
     ts=read_timestamp
     )
 
@@ -132,8 +127,92 @@ conventional_packet = npstruct.Oracle (
     ed=read_encrypted_data
     )
 
+# Compressed data packets run to the end of the data, and hold a raw
+# deflate stream of more packets.  Rather than inflating all of it, the
+# 'data' field is a Compressed_Data, which can hand out the contents a
+# chunk at a time through an Inflater (a read-only file).  The
+# inflated size is limited (by <decompressed_size_limit>, unless a
+# limit is given), so a small packet can't expand without bound.
+
+decompressed_size_limit = 64 * 1024 * 1024
+
+class Inflater:
+
+    def __init__ (self, data, pos=0, end=None, limit=None, chunk_size=65536):
+        if end is None:
+            end = len(data)
+        if limit is None:
+            limit = decompressed_size_limit
+        self.data = data
+        self.pos = pos
+        self.end = end
+        self.limit = limit
+        self.chunk_size = chunk_size
+        self.inflater = zlib.decompressobj (-15)
+        self.size = 0
+        self.done = 0
+
+    def read (self, n=-1):
+        # returns at most <n> bytes (all of them if <n> is negative),
+        # and '' only at the end, or when <n> is 0
+        if n == 0:
+            # (a max_length of 0 would mean no limit to decompress)
+            return ''
+        elif n < 0:
+            chunks = []
+            while 1:
+                chunk = self.read (self.chunk_size)
+                if not chunk:
+                    return string.join (chunks, '')
+                chunks.append (chunk)
+        while not self.done:
+            input = self.inflater.unconsumed_tail
+            if not input:
+                input = self.data[self.pos:min (self.pos + self.chunk_size, self.end)]
+                self.pos = self.pos + len(input)
+            try:
+                if input:
+                    output = self.inflater.decompress (input, n)
+                else:
+                    output = self.inflater.flush()
+                    self.done = 1
+            except zlib.error, why:
+                raise TypeError, 'bad compressed data: %s' % why
+            if self.inflater.unused_data:
+                # the end of the deflate stream
+                self.done = 1
+            self.size = self.size + len(output)
+            if self.size > self.limit:
+                raise TypeError, 'compressed data expands past %d bytes' % self.limit
+            if output:
+                return output
+        return ''
+
+class Compressed_Data:
+
+    def __init__ (self, data, pos, length):
+        self.data = data
+        self.pos = pos
+        self.length = length
+
+    def __repr__ (self):
+        return '<compressed data: %d bytes>' % self.length
+
+    def open (self, limit=None):
+        return Inflater (self.data, self.pos, self.pos + self.length, limit)
+
+    def read (self, limit=None):
+        return self.open (limit).read()
+
+    def packets (self, types=(), limit=None):
+        # the packets inside, with offsets into the inflated data
+        return iter_packets (self.open (limit), types)
+
 def read_compressed_data (result, data, offset):
-    raise TypeError, "can't read compressed data yet!!!"
+    if result[-1] != 1:
+        raise TypeError, 'unknown compression algorithm %d' % result[-1]
+    length = len(data) - offset
+    return Compressed_Data (data, offset, length), length
 
 compressed_packet = npstruct.Oracle (
     'Compressed data packet',
@@ -193,7 +272,7 @@ def read_cipher_initial_value (results, data, pos):
 
 secret_key_certificate = npstruct.Oracle (
     'secret key certificate',
-    'B[ctb][len]b[ts]hb[mpi][mpi]b[civ][mpi][mpi][mpi][mpi]h',
+    'B[ctb][len]b[ts]hbmmb[civ]mmmmh',
     ('ctb',
      'packet_length',
      'version',
@@ -214,13 +293,12 @@ secret_key_certificate = npstruct.Oracle (
     ctb=read_ctb,
     len=read_ctb_len,
     civ=read_cipher_initial_value,
-    mpi=read_mpi,
     ts=read_timestamp
     )
 
 public_key_certificate = npstruct.Oracle (
     'public key certificate',
-    'B[ctb][len]b[ts]hb[mpi][mpi]',
+    'B[ctb][len]b[ts]hbmm',
     ('ctb',
      'length',
      'version',     # 3 == PGP2.6 or later
@@ -233,7 +311,6 @@ public_key_certificate = npstruct.Oracle (
      ),
     ctb=read_ctb,
     len=read_ctb_len,
-    mpi=read_mpi,
     ts=read_timestamp
     )
 
@@ -288,20 +365,13 @@ CTB = npstruct.Oracle (
     )
 
 def decode_ctb_type (char):
-    dict, size = CTB.unpack(char)
-    # sanity check
-    if not (dict['ctb_designator']):
-        raise TypeError, 'not a CTB byte'
+    # returns (type, size of the length field), 0 for a packet that
+    # runs to the end of the data.
+    entry = ctb_table[ord(char)]
+    if type(entry) == type(''):
+        raise TypeError, entry
     else:
-        # get the type field (bits 5-2)
-        type = dict['type']
-        if not ctb_type_table.has_key (type):
-            raise TypeError, 'unknown CTB type'
-        else:
-            length = 1<<(dict['length_of_length'])
-            if length == 8:
-                length = 0
-            return type, length
+        return entry
 
 ctb_type_table = {
     1 :('public-key-encrypted packet', RSA),
@@ -317,24 +387,502 @@ ctb_type_table = {
     14:('Comment packet', comment_packet),
     }
 
-def test (filename):
-    test_data (open(filename, 'rb').read())
+def make_ctb_table ():
+    # decode_ctb_type's answer for every byte: a (type, size of length)
+    # tuple, or an error message
+    table = []
+    for byte in range(256):
+        dict, size = CTB.unpack (chr(byte))
+        # sanity check
+        if not (dict['ctb_designator']):
+            table.append ('not a CTB byte')
+        # get the type field (bits 5-2)
+        elif not ctb_type_table.has_key (dict['type']):
+            table.append ('unknown CTB type')
+        else:
+            length = 1<<(dict['length_of_length'])
+            if length == 8:
+                length = 0
+            table.append ((dict['type'], length))
+    return table
+
+ctb_table = make_ctb_table()
+
+# ---------------------------------------------------------------------------
+# packet streams
+# ---------------------------------------------------------------------------
+# iter_packets walks the packets of a ring or message, yielding a
+# pgp_packet for each.  Only the CTB and length are looked at, unless
+# the packet's type is one of <types>, in which case its Oracle is run
+# over it and the result included.  Data (a string, buffer or mmap) is
+# read in place; a file is read a chunk at a time, and the packets
+# that aren't wanted are skipped over, so a ring of any size can be
+# streamed in a fixed amount of memory.
+
+pgp_packet = npstruct.make_record_class (
+    'PGP Packet',
+    ('type',
+     'offset',
+     'header length',           # the CTB and the length field
+     'body length',
+     'result')                  # None unless the type was asked for
+    )
 
-def test_data (data):
-    pos = 0
+def read_packet_header (data, pos):
+    # returns (type, header length, body length)
+    type, size = decode_ctb_type (data[pos])
+    if type == 12:
+        # see the note on trust packets above
+        size = 1
+    elif size == 0:
+        # the rest of the data
+        return type, 1, len(data) - (pos + 1)
+    header = data[pos+1:pos+1+size]
+    if len(header) != size:
+        raise TypeError, 'truncated packet'
+    length = 0
+    for ch in header:
+        length = (length << 8) | ord(ch)
+    return type, 1 + size, length
+
+def decode_packet (type, data, pos):
+    entry = ctb_type_table[type]
+    if len(entry) < 2:
+        raise TypeError, "can't read %s" % entry[0]
+    result, length = entry[1].unpack (data, pos)
+    return result
+
+class Packet_File:
+
+    # buffered reading and skipping over a file object
+
+    def __init__ (self, file, chunk_size=65536):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+
+    def read (self, n):
+        avail = len(self.buffer) - self.pos
+        if avail < n:
+            chunks = [self.buffer[self.pos:]]
+            while avail < n:
+                chunk = self.file.read (max (self.chunk_size, n - avail))
+                if not chunk:
+                    break
+                chunks.append (chunk)
+                avail = avail + len(chunk)
+            self.buffer = string.join (chunks, '')
+            self.pos = 0
+        data = self.buffer[self.pos:self.pos+n]
+        self.pos = self.pos + len(data)
+        return data
+
+    def read_all (self):
+        data = self.buffer[self.pos:] + self.file.read()
+        self.buffer = ''
+        self.pos = 0
+        return data
+
+    def skip (self, n):
+        # returns the number of bytes skipped, less than <n> at the end
+        avail = len(self.buffer) - self.pos
+        if n <= avail:
+            self.pos = self.pos + n
+            return n
+        self.buffer = ''
+        self.pos = 0
+        skipped = avail
+        while skipped < n:
+            chunk = self.file.read (min (n - skipped, self.chunk_size))
+            if not chunk:
+                break
+            skipped = skipped + len(chunk)
+        return skipped
+
+    def skip_all (self):
+        return self.skip (sys.maxint)
+
+def iter_packets (source, types=(), offset=0, chunk_size=65536):
+    # <source> is data, or a file object; <offset> is where it starts (for
+    # data) or the file position it's at (for a file, to report offsets).
+    if type(source) == type(bytearray()):
+        source = buffer (source)
+    if hasattr (source, '__len__'):
+        return iter_data_packets (source, types, offset)
+    else:
+        return iter_file_packets (Packet_File (source, chunk_size), types, offset)
+
+def iter_data_packets (data, types, pos):
+    end = len(data)
+    while pos < end:
+        type, header, length = read_packet_header (data, pos)
+        if pos + header + length > end:
+            raise TypeError, 'truncated packet'
+        if type in types:
+            result = decode_packet (type, data, pos)
+        else:
+            result = None
+        yield pgp_packet ((type, pos, header, length, result))
+        pos = pos + header + length
+
+def iter_file_packets (stream, types, pos):
     while 1:
-        if pos == len(data):
+        ctb = stream.read (1)
+        if not ctb:
             break
+        type, size = decode_ctb_type (ctb)
+        if type == 12:
+            size = 1
+        if size == 0:
+            length = None
+        else:
+            header = stream.read (size)
+            if len(header) != size:
+                raise TypeError, 'truncated packet'
+            length = 0
+            for ch in header:
+                length = (length << 8) | ord(ch)
+            ctb = ctb + header
+        if type in types:
+            if length is None:
+                body = stream.read_all()
+                length = len(body)
+            else:
+                body = stream.read (length)
+                if len(body) != length:
+                    raise TypeError, 'truncated packet'
+            result = decode_packet (type, ctb + body, 0)
+        else:
+            if length is None:
+                length = stream.skip_all()
+            elif stream.skip (length) != length:
+                raise TypeError, 'truncated packet'
+            result = None
+        yield pgp_packet ((type, pos, len(ctb), length, result))
+        pos = pos + len(ctb) + length
+
+# ---------------------------------------------------------------------------
+# keyring index
+# ---------------------------------------------------------------------------
+# A Keyring_Index records where each key in a keyring starts, and the
+# offsets of the packets (user ids, signatures, trust) that follow it,
+# so that a key can be looked up by KeyID or user id without walking
+# the whole ring.  Building one only decodes the key certificates (for
+# the KeyID, the low 64 bits of the modulus) and the user ids.  An index can be
+# saved next to the ring; keyring_index() uses it as long as the ring
+# hasn't changed.
+
+keyring_key = npstruct.make_record_class (
+    'PGP Keyring Key',
+    ('key id',                  # 64 bits, the user-visible KeyID is the low 32
+     'offset',                  # of the key certificate
+     'size',                    # through the last packet belonging to the key
+     'user ids',
+     'packets')                 # (type, offset, size) for each packet, in order
+    )
+
+keyring_index_header = npstruct.Oracle (
+    'PGP Keyring Index Header',
+    'B4cllll',
+    ('magic',                   # 'PGX2' (version 2, with the user id lengths)
+     'ring size',               # size and modification time of the ring,
+     'ring mtime',              #   to spot a stale index
+     'key count',
+     'packet count')
+    )
+
+keyring_index_key = npstruct.Oracle (
+    'PGP Keyring Index Key',
+    'Blllll',
+    ('key id high',
+     'key id low',
+     'offset',
+     'size',
+     'packet count')
+    )
+
+# the key entries are followed by the packets of all the keys, and then
+# the text of the user id packets.  the packet header in front of a user
+# id can be two or three bytes long, so the length of its text is kept.
+keyring_index_packet = npstruct.Oracle (
+    'PGP Keyring Index Packet',
+    'Bblll',
+    ('type',
+     'offset',
+     'size',
+     'text length')             # of the user id, 0 for other packets
+    )
+
+def parse_key_id (key_id):
+    # <key_id> is a number, or hex digits (with or without '0x').
+    # returns (key id, bits) - 32 bits for short ids, otherwise 64.
+    if type(key_id) == type(''):
+        digits = string.strip (key_id)
+        if string.lower (digits[:2]) == '0x':
+            digits = digits[2:]
+        try:
+            value = string.atol (digits, 16)
+        except ValueError:
+            raise ValueError, 'bad KeyID "%s"' % key_id
+        if len(digits) <= 8:
+            return value, 32
+        else:
+            return value, 64
+    elif key_id <= 0xffffffffL:
+        return key_id, 32
+    else:
+        return key_id, 64
+
+class Keyring_Index:
+
+    def __init__ (self, keys, ring_size, ring_mtime=0):
+        import bisect
+        self.keys = keys
+        self.ring_size = ring_size
+        self.ring_mtime = ring_mtime
+        self.by_id = {}
+        self.by_short_id = {}
+        # all the user ids, lowered and separated by newlines, for
+        # substring searches; <user_id_starts> is where each begins,
+        # and <user_id_keys> the key it belongs to.
+        text = []
+        self.user_id_starts = starts = array.array ('l')
+        self.user_id_keys = array.array ('l')
+        pos = 0
+        for i in range(len(keys)):
+            key = keys[i]
+            self.by_id.setdefault (key['key id'], []).append (key)
+            self.by_short_id.setdefault (key['key id'] & 0xffffffffL, []).append (key)
+            for user_id in key['user ids']:
+                starts.append (pos)
+                self.user_id_keys.append (i)
+                text.append (string.lower (user_id))
+                pos = pos + len(user_id) + 1
+        self.user_id_text = string.join (text, '\n')
+        self.bisect = bisect.bisect_right
+
+    def __repr__ (self):
+        return '<PGP keyring index: %d keys>' % len(self.keys)
+
+    def __len__ (self):
+        return len(self.keys)
+
+    def __getitem__ (self, n):
+        return self.keys[n]
+
+    def find_key_id (self, key_id):
+        # a list of the keys with <key_id>: short (32 bit) ids can match more
+        # than one.
+        key_id, bits = parse_key_id (key_id)
+        if bits == 32:
+            return self.by_short_id.get (key_id, [])[:]
+        else:
+            return self.by_id.get (key_id, [])[:]
+
+    def find_user_id (self, text):
+        # a list of the keys with a user id containing <text> (in any case)
+        text = string.lower (text)
+        if not text or '\n' in text:
+            return []
+        keys = []
+        found = {}
+        pos = 0
+        while 1:
+            pos = string.find (self.user_id_text, text, pos)
+            if pos == -1:
+                break
+            n = self.bisect (self.user_id_starts, pos) - 1
+            i = self.user_id_keys[n]
+            if not found.has_key (i):
+                found[i] = 1
+                keys.append (self.keys[i])
+            # carry on from the next user id
+            if n + 1 < len(self.user_id_starts):
+                pos = self.user_id_starts[n+1]
+            else:
+                break
+        return keys
+
+    def read_key (self, file, key):
+        # a list of (description, result) for the packets of <key>, read
+        # from the (seekable) ring <file>
+        file.seek (key['offset'])
+        data = file.read (key['size'])
+        if len(data) != key['size']:
+            raise TypeError, 'truncated keyring'
+        packets = []
+        for type, offset, size in key['packets']:
+            desc, oracle = ctb_type_table[type][:2]
+            result, length = oracle.unpack (data, offset - key['offset'])
+            packets.append ((desc, result))
+        return packets
+
+    def save (self, file):
+        packets = []
+        user_ids = []
+        for key in self.keys:
+            i = 0
+            for type, offset, size in key['packets']:
+                if type == 13:
+                    user_id = key['user ids'][i]
+                    i = i + 1
+                    packets.append ((type, offset, size, len(user_id)))
+                    user_ids.append (user_id)
+                else:
+                    packets.append ((type, offset, size, 0))
+        file.write (
+            keyring_index_header.pack ({
+                'magic':'PGX2',
+                'ring size':self.ring_size,
+                'ring mtime':self.ring_mtime,
+                'key count':len(self.keys),
+                'packet count':len(packets)
+                })
+            )
+        for key in self.keys:
+            file.write (
+                keyring_index_key.pack ({
+                    'key id high':key['key id'] >> 32,
+                    'key id low':key['key id'] & 0xffffffffL,
+                    'offset':key['offset'],
+                    'size':key['size'],
+                    'packet count':len(key['packets'])
+                    })
+                )
+        for packet in packets:
+            file.write (keyring_index_packet.pack (keyring_index_packet.record (packet)))
+        file.write (string.join (user_ids, ''))
+
+def build_keyring_index (data, ring_mtime=0):
+    # <data> is the whole ring, as a string or mmap
+    keys = []
+    key = None
+    for type, pos, header, length, result in iter_packets (data, (5, 6)):
+        if type in (5, 6):
+            if type == 6:
+                modulus = result['mpi_rsa_pub_mod_n']
+            else:
+                modulus = result['rsa_pub_mod_n']
+            key = [modulus & 0xffffffffffffffffL, pos, 0, [], []]
+            keys.append (key)
+        elif key is None:
+            raise TypeError, 'keyring does not start with a key certificate'
+        elif type == 13:
+            key[3].append (data[pos+header:pos+header+length])
+        key[4].append ((type, pos, header + length))
+        key[2] = pos + header + length - key[1]
+    return Keyring_Index (map (keyring_key, keys), len(data), ring_mtime)
+
+def load_keyring_index (file, ring_size=None, ring_mtime=None):
+    # read an index saved by Keyring_Index.save.  if the size or
+    # modification time of the ring is given, it has to match the
+    # one the index was built from.
+    data = file.read()
+    if len(data) < keyring_index_header.size:
+        raise ValueError, 'not a PGP keyring index'
+    header, pos = keyring_index_header.unpack (data, 0)
+    if string.join (header['magic'], '') != 'PGX2':
+        raise ValueError, 'not a PGP keyring index'
+    elif ((ring_size is not None and ring_size != header['ring size'])
+          or (ring_mtime is not None and ring_mtime != header['ring mtime'])):
+        raise ValueError, 'stale PGP keyring index'
+    end = pos + header['key count'] * keyring_index_key.size
+    entries = list (keyring_index_key.iter_unpack (data[pos:end]))
+    pos, end = end, end + header['packet count'] * keyring_index_packet.size
+    packets = map (tuple, keyring_index_packet.iter_unpack (data[pos:end]))
+    if len(entries) != header['key count'] or len(packets) != header['packet count']:
+        raise ValueError, 'truncated PGP keyring index'
+    pos = end
+    keys = []
+    first = 0
+    for entry in entries:
+        count = entry['packet count']
+        key_packets = packets[first:first+count]
+        first = first + count
+        if len(key_packets) != count:
+            raise ValueError, 'corrupt PGP keyring index'
+        user_ids = []
+        for type, offset, size, text_length in key_packets:
+            if type == 13:
+                user_ids.append (data[pos:pos+text_length])
+                pos = pos + text_length
+        keys.append (
+            keyring_key ((
+                (long (entry['key id high']) << 32) | entry['key id low'],
+                entry['offset'], entry['size'], user_ids,
+                map (lambda packet: packet[:3], key_packets)
+                ))
+            )
+    if pos != len(data):
+        raise ValueError, 'truncated PGP keyring index'
+    return Keyring_Index (keys, header['ring size'], header['ring mtime'])
+
+def keyring_index (ring_filename, index_filename=None):
+    # the index for the ring in <ring_filename>, loaded from <index_filename>
+    # (by default, the ring's name with '.idx' added) if it's up to date,
+    # or else built and saved there.
+    import os
+    import mmap
+    if index_filename is None:
+        index_filename = ring_filename + '.idx'
+    info = os.stat (ring_filename)
+    ring_size, ring_mtime = info.st_size, int (info.st_mtime)
+    try:
+        file = open (index_filename, 'rb')
+    except IOError:
+        pass
+    else:
+        try:
+            try:
+                return load_keyring_index (file, ring_size, ring_mtime)
+            except (ValueError, npstruct.error):
+                pass
+        finally:
+            file.close()
+    file = open (ring_filename, 'rb')
+    try:
+        if ring_size:
+            data = mmap.mmap (file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = ''
+        try:
+            index = build_keyring_index (data, ring_mtime)
+        finally:
+            if ring_size:
+                data.close()
+    finally:
+        file.close()
+    try:
+        file = open (index_filename, 'wb')
+        try:
+            index.save (file)
+        finally:
+            file.close()
+    except IOError:
+        # the index is only a cache
+        pass
+    return index
+
+def test (filename):
+    test_data (open(filename, 'rb'))
+
+def test_data (data):
+    # <data> can also be a file
+    types = []
+    for type, entry in ctb_type_table.items():
+        if len(entry) > 1:
+            types.append (type)
+    for packet in iter_packets (data, types):
+        print '='*50
+        #print 'position: %d' % packet[1]
+        #print 'found "%s"' % ctb_type_table[packet[0]][0]
+        if packet[4] is None:
+            print ctb_type_table[packet[0]][0]
         else:
-            ctb_type, length = decode_ctb_type (data[pos])
-            desc, oracle = ctb_type_table[ctb_type]
-            print '='*50
-            #print 'position: %d' % pos
-            #print 'found "%s"' % desc
-            result_data, length = oracle.unpack (data, pos)
-            #print 'length: %d' % length
-            pos = pos + length
-            oracle.describe (result_data)
+            ctb_type_table[packet[0]][1].describe (packet[4])
+            if packet[0] == 8:
+                test_data (packet[4]['data'].open())
 
 if __name__ == '__main__':
     import sys